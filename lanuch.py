@@ -16,8 +16,8 @@ from fastapi import FastAPI
 # 实例化引擎
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # 整个进程生命周期内只运行这一次
-    await engine_manager.init_all()
+    # 整个进程生命周期内只运行这一次；引擎在后台预热，服务立即开始接收请求
+    engine_manager.start_warmup()
     yield
 
 
@@ -1,17 +1,47 @@
-from fastapi import APIRouter
-import json
-from modules.api.api_params import  ChatWithTranslationParams
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Request
+import asyncio
+import hmac
+import time
+from modules.api.api_params import  ChatWithTranslationParams, ProfilingParams
+from modules.api.api_func import process_history
+from modules.api.stream_protocol import build_stream_encoder
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse, FileResponse
 
-from modules.engine.engine_factory import engine_manager
+from modules.engine.engine_factory import engine_manager, CONFIG
+from modules.engine.admission import QueueFullError
+from modules.engine.dual_perspective import DualPerspective
+from modules.utils.cancellation import CancellationToken
+from modules.utils.metrics import activate, metrics, tracer
+from modules.utils.profiling import profiler
 
-from modules.prompts.prompt_map import prod_prompt,dev_prompt
+from modules.prompts.prompt_map import prod_prompt,dev_prompt,prod_refusal,dev_refusal
 
 
 
 router = APIRouter()
 
 
+async def watch_disconnect(request: Request, cancel_token: CancellationToken, interval=0.5):
+    """ 轮询客户端连接状态，断开后置位取消令牌（覆盖排队 / prefill 等尚未输出 token 的阶段） """
+    while not cancel_token.cancelled:
+        if await request.is_disconnected():
+            cancel_token.cancel("client_disconnected")
+            return
+        await asyncio.sleep(interval)
+
+
+async def wait_admitted(ticket, watcher):
+    """ 排队等待准入，同时监听客户端断开（watcher 结束）；断开先发生时返回 False，调用方释放凭证即取消排队、让出位置 """
+    if ticket is None or ticket.admitted:
+        return True
+    admitted = asyncio.create_task(ticket.wait())
+    try:
+        await asyncio.wait({admitted, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        admitted.cancel()
+    return ticket.admitted
+
+
 
 
 # =======================
@@ -19,132 +49,305 @@ router = APIRouter()
 # =======================
 
 
+def queue_full_response(e: QueueFullError, event: ChatWithTranslationParams):
+    """ 队列已满时立即拒绝，不再占用连接排队 """
+    return JSONResponse(
+        status_code=429,
+        headers={"Retry-After": str(e.retry_after)},
+        content={
+            "status_code": 429,
+            "msg": "failed",
+            "data": {
+                "retry_after": e.retry_after,
+                "queued": e.queued
+            },
+            "error": {
+                "msg": str(e)
+            },
+            "parameters": event.model_dump()
+        }
+    )
+
+
+def unavailable_response(key, event: ChatWithTranslationParams):
+    return JSONResponse(
+        status_code=503,
+        headers={"Retry-After": "30"},
+        content={
+            "status_code": 503,
+            "msg": "failed",
+            "data": {},
+            "error": {
+                "msg": f"{event.engine_type} 引擎未就绪: {engine_manager.engine_errors.get(key, '')}"
+            },
+            "parameters": event.model_dump()
+        }
+    )
+
+
+def queue_time(decision):
+    """ 自动路由切换引擎后准入凭证随之更换（见 EngineRouter.failover），排队时间按当前凭证读取 """
+    return decision.ticket.queue_wait_time if decision.ticket is not None else 0.0
+
+
 _all_roles = ["to_product","to_dev"]
+ROLE_PROMPTS = {"to_product": prod_prompt, "to_dev": dev_prompt}
+ROLE_REFUSALS = {"to_product": prod_refusal, "to_dev": dev_refusal}
+# 同时生成两个视角
+BOTH_PERSPECTIVES = "both"
+# 按意图识别结果选择翻译方向：业务描述译给开发，技术方案译给产品
+AUTO_ROLE = "auto"
+INTENT_ROLES = {"business": "to_dev", "technical": "to_product"}
+
+
+def intent_rejected_response(event: ChatWithTranslationParams, request: Request, intent, role):
+    """ 意图识别判定为非领域输入：不经过引擎，直接返回该角色的固定回复（流式时同样按协商的协议输出） """
+    trace = tracer.start("chat_with_translation_agent", entry="api", role=role, engine="intent", stream=event.stream)
+    trace.set(intent=intent.label, intent_confidence=round(intent.confidence, 4))
+    response = ROLE_REFUSALS[role]
+    tracer.finish(trace, "off_topic")
+
+    if not event.stream:
+        return {
+            "status_code": 200,
+            "msg": "success",
+            "data": {
+                "response": response,
+                "timing": {
+                    "queue_time": 0.0,
+                    "generation_time": round(intent.elapsed, 4)
+                },
+                "served_by": "intent",
+                "intent": intent.to_dict()
+            },
+            "error": {
+                "msg": ""
+            },
+            "parameters": event.model_dump()
+        }
+
+    encoder = build_stream_encoder(event.stream_format, request.headers.get("accept", ""))
+
+    async def generate_streaming_response():
+        yield encoder.start(event.model_dump())
+        yield encoder.event("intent", {"role": role, **intent.to_dict()})
+        yield encoder.chunk(response, 1)
+        yield encoder.end(1, {"queue_time": 0.0, "generation_time": round(intent.elapsed, 4), "served_by": "intent"})
+
+    return StreamingResponse(
+        generate_streaming_response(),
+        media_type=encoder.media_type,
+        headers=encoder.headers
+    )
+
 @router.post(
     "/chat_with_translation_agent",
     summary="与翻译分身进行对话"
 )
 async def chat_with_translation(
-        event: ChatWithTranslationParams
+        event: ChatWithTranslationParams,
+        request: Request
 ):
     """
     与不同翻译agent进行对话。
     支持多轮对话，通过 `history` 参数传递对话历史。
+    流式输出格式由 `stream_format` 或 Accept 头协商：legacy(默认，累计全文) / delta(NDJSON 增量) / sse。
+    `role` 为 both 时同时生成 to_product 与 to_dev 两个视角，流式输出中两路 token 交错、以 role 字段区分。
+    `role` 为 auto 时按意图识别结果选择方向；开启意图识别（INTENT_MODEL_PATH）后，明显无关的输入直接返回固定回复。
     """
 
-    engine = engine_manager.local_engine  if event.engine_type == "local" else engine_manager.openai_engine
-
     role = event.role
 
-    if role not in _all_roles :
+    if role not in _all_roles + [BOTH_PERSPECTIVES, AUTO_ROLE]:
         return {
             "status_code": 500,
             "msg": "failed",
             "data": {},
             "error": {
-                "msg": f"role must be one of {_all_roles}, can't be {role}"
+                "msg": f"role must be one of {_all_roles + [BOTH_PERSPECTIVES, AUTO_ROLE]}, can't be {role}"
             },
             "parameters": event.model_dump()
         }
 
+    # 轻量意图识别（CPU，亚毫秒）：置信度足够时拦截无关输入；不确定时交给大模型按提示词自行判断
+    intent = engine_manager.intent.decide(event.user_question, has_history=bool(event.history))
+    if role == AUTO_ROLE:
+        role = INTENT_ROLES.get(intent.domain_label, "to_product")
+    if intent.rejected:
+        return intent_rejected_response(event, request, intent, role if role in ROLE_REFUSALS else INTENT_ROLES[intent.domain_label])
+
+    if role == BOTH_PERSPECTIVES:
+        return await chat_with_both_perspectives(event, request)
+
     # todo 后续可增加其他的角色
-    prompt = prod_prompt if event.role == "to_product" else  dev_prompt
+    prompt = ROLE_PROMPTS[role]
+
+    # 请求级 trace：引擎内部的各阶段耗时记录到同一个 trace，结束时汇总为指标
+    trace = tracer.start(
+        "chat_with_translation_agent",
+        entry="api",
+        role=role,
+        engine=event.engine_type if event.engine_type == "auto" else engine_manager.engine_key(event.engine_type),
+        stream=event.stream
+    )
+    if intent.label is not None:
+        trace.set(intent=intent.label, intent_confidence=round(intent.confidence, 4))
+
+    # 引擎按需加载（首次使用时在此等待加载完成）+ 准入控制；auto 时按路由策略选择引擎
+    try:
+        decision = await engine_manager.router.acquire(event.engine_type, event.priority)
+    except QueueFullError as e:
+        tracer.finish(trace, "rejected")
+        return queue_full_response(e, event)
+
+    if decision.engine is None:
+        tracer.finish(trace, "unavailable")
+        return unavailable_response(decision.key, event)
 
     try:
 
         stream = event.stream
-        history = list(event.history)
+        # 统一历史格式，token 预算裁剪在引擎外层按实际服务的引擎进行
+        history = process_history(event.history)
 
 
         user_question = event.user_question
+        cancel_token = CancellationToken()
         # ==================== 流式响应处理 ====================
         if stream:
-            # 获取真正的流式生成器
-            token_stream = engine.generate_response(
+            # 获取异步流式生成器（生成在后台线程 / 异步客户端中进行，不阻塞事件循环）
+            token_stream = engine_manager.router.astream(
+                decision,
                 user_query=user_question,
                 history=history,
                 sys_prompt=prompt,
-                stream=True
+                priority=event.priority,
+                session_id=event.session_id or None,
+                cancel_token=cancel_token,
+                coalesce=event.coalesce
             )
 
-            # 创建流式生成器，添加开始/结束标记
-            def generate_streaming_response():
-                # 1. 发送流开始标记
-                yield json.dumps({
-                    "status_code": 200,
-                    "msg": "stream_start",
-                    "data": {
-                        "response": "",
-                        "message": "流式响应开始",
-                        "token_count": 0,
-                        "state":"start"
-                    },
-                    "error": {
-                        "msg": ""
-                    },
-                    "parameters": event.model_dump()
-                }, ensure_ascii=False) + "\n"
+            # 按协商的协议编码：legacy 保持旧的累计格式，delta / sse 每个事件只发送新增 token
+            encoder = build_stream_encoder(
+                event.stream_format,
+                request.headers.get("accept", "")
+            )
 
-                full_response = ""
+            # 创建流式生成器，添加开始/结束标记
+            async def generate_streaming_response():
+                activate(trace)
+                watcher = asyncio.create_task(watch_disconnect(request, cancel_token))
+                completed = False
+                failed = False
                 token_count = 0
+                # 开启流量记录时保留完整回复，供意图识别模型重新训练
+                answer_parts = [] if engine_manager.intent.log_path else None
+                try:
+                    # 1. 发送流开始标记（请求参数只在此处编码一次）
+                    yield encoder.start(event.model_dump())
+                    if event.role == AUTO_ROLE:
+                        yield encoder.event("intent", {"role": role, **intent.to_dict()})
 
-                # 2. 处理流式数据
-                for token in token_stream:
-                    token_count += 1
-                    full_response += token
-
-                    # 实时返回部分响应，保持原有结构
-                    yield json.dumps({
-                        "status_code": 200,
-                        "msg": "stream_chunk",
-                        "data": {
-                            "response": full_response,
-                            "token_count": token_count,
-                            "message": "流式响应生成中",
-                            "state":"process"
-                        },
-                        "error": {
-                            "msg": ""
-                        },
-                        "parameters": event.model_dump()
-                    }, ensure_ascii=False) + "\n"
-
-                # 3. 发送流结束标记
-                yield json.dumps({
-                    "status_code": 200,
-                    "msg": "stream_end",
-                    "data": {
-                        "response": full_response,
-                        "token_count": token_count,
-                        "message": "流式响应完成",
-                        "state":"end"
-                    },
-                    "error": {
-                        "msg": ""
-                    },
-                    "parameters": event.model_dump()
-                }, ensure_ascii=False) + "\n"
+                    # 排队期间反馈排队位置
+                    if decision.ticket is not None:
+                        async for position in decision.ticket.positions():
+                            if cancel_token.cancelled:
+                                return
+                            yield encoder.event("queue_position", {
+                                "position": position,
+                                "message": f"排队中，前面还有 {position - 1} 个请求",
+                                "state": "queued"
+                            })
+                    generation_start = time.time()
+
+                    # 2. 处理流式数据（每个 token 只计数与累加写出耗时）
+                    async for token in token_stream:
+                        if cancel_token.cancelled:
+                            break
+                        token_count += 1
+                        if token_count == 1:
+                            trace.mark_first_token()
+                        if token[:1] == "❌":
+                            failed = True
+                        if answer_parts is not None:
+                            answer_parts.append(token)
+                        write_start = time.perf_counter()
+                        yield encoder.chunk(token, token_count)
+                        trace.accumulate("stream_write", time.perf_counter() - write_start)
+                    else:
+                        completed = True
+
+                    # 3. 发送流结束标记（排队时间与生成时间分开统计）
+                    if completed:
+                        yield encoder.end(token_count, {
+                            "queue_time": round(queue_time(decision), 4),
+                            "generation_time": round(time.time() - generation_start, 4),
+                            "served_by": decision.served_by
+                        })
+                finally:
+                    # 客户端断开时 StreamingResponse 会取消本生成器，此处把取消传递给引擎
+                    watcher.cancel()
+                    if not completed:
+                        cancel_token.cancel("client_disconnected")
+                    await token_stream.aclose()
+                    # 自动路由切换引擎后准入凭证随之更换
+                    decision.release()
+                    trace.completion_tokens = token_count
+                    trace.set(engine=decision.served_by or decision.key, queue_time=queue_time(decision))
+                    tracer.finish(trace, "error" if failed else ("ok" if completed else "cancelled"))
+                    if completed and answer_parts is not None:
+                        await engine_manager.intent.alog_traffic(user_question, role, "".join(answer_parts), intent, bool(history), "api")
 
             # 返回流式响应
             return StreamingResponse(
                 generate_streaming_response(),
-                media_type="application/json"
+                media_type=encoder.media_type,
+                headers=encoder.headers
             )
 
         else:
             # --------------- 非流式响应 ------------------- #
-            response = engine.generate_response(
-                    user_query=user_question,
-                    history=history,
-                    sys_prompt=prompt,
-                    stream=False
-            )
+            watcher = asyncio.create_task(watch_disconnect(request, cancel_token))
+            response = None
+            try:
+                if await wait_admitted(decision.ticket, watcher):
+                    generation_start = time.time()
+                    response = await engine_manager.router.agenerate(
+                            decision,
+                            user_query=user_question,
+                            history=history,
+                            sys_prompt=prompt,
+                            priority=event.priority,
+                            session_id=event.session_id or None,
+                            cancel_token=cancel_token,
+                            coalesce=event.coalesce
+                    )
+            finally:
+                watcher.cancel()
+                decision.release()
+                trace.set(
+                    engine=decision.served_by or decision.key,
+                    queue_time=queue_time(decision)
+                )
+            if response is None:
+                # 排队期间客户端已断开：凭证已取消，不再生成
+                tracer.finish(trace, "cancelled")
+                return {"status_code": 499, "msg": "cancelled", "data": {}, "error": {"msg": "客户端已断开"}, "parameters": event.model_dump()}
+            tracer.finish(trace, "error" if response.startswith("❌") else "ok")
+            await engine_manager.intent.alog_traffic(user_question, role, response, intent, bool(history), "api")
 
             return {
                 "status_code": 200,
                 "msg": "success",
                 "data": {
-                    "response": response
+                    "response": response,
+                    "timing": {
+                        "queue_time": round(queue_time(decision), 4),
+                        "generation_time": round(time.time() - generation_start, 4)
+                    },
+                    "served_by": decision.served_by,
+                    "role": role,
+                    "intent": intent.to_dict()
                 },
                 "error": {
                     "msg": ""
@@ -152,6 +355,8 @@ async def chat_with_translation(
                 "parameters": event.model_dump()
             }
     except Exception as e:
+        decision.release()
+        tracer.finish(trace, "error")
         return {
             "status_code": 500,
             "msg": "failed",
@@ -161,3 +366,238 @@ async def chat_with_translation(
             },
             "parameters": event.model_dump()
     }
+
+
+async def chat_with_both_perspectives(event: ChatWithTranslationParams, request: Request):
+    """
+    双视角：两个角色各占一个准入名额、同时生成（本地引擎为同一 batch 中的两个序列，在线引擎为两路并发请求），名额不足时先后生成。
+    开启回复缓存时两路回答都会缓存，之后以相同历史请求另一个角色时直接回放。
+    """
+    trace = tracer.start(
+        "chat_with_translation_agent",
+        entry="api",
+        role=BOTH_PERSPECTIVES,
+        engine=event.engine_type if event.engine_type == "auto" else engine_manager.engine_key(event.engine_type),
+        stream=event.stream
+    )
+    try:
+        pair = await DualPerspective.acquire(engine_manager.router, event.engine_type, _all_roles, event.priority)
+    except QueueFullError as e:
+        tracer.finish(trace, "rejected")
+        return queue_full_response(e, event)
+
+    if pair.unavailable is not None:
+        pair.release()
+        tracer.finish(trace, "unavailable")
+        return unavailable_response(pair.unavailable, event)
+
+    history = process_history(event.history)
+    cancel_token = CancellationToken()
+    generation_kwargs = dict(
+        user_query=event.user_question,
+        prompts=ROLE_PROMPTS,
+        history=history,
+        priority=event.priority,
+        session_id=event.session_id or None,
+        cancel_token=cancel_token,
+        coalesce=event.coalesce
+    )
+
+    def finish(status, completion_tokens=0):
+        pair.release()
+        trace.completion_tokens = completion_tokens
+        trace.set(engine=",".join(f"{role}:{key}" for role, key in pair.served_by.items()))
+        tracer.finish(trace, status)
+
+    if not event.stream:
+        watcher = asyncio.create_task(watch_disconnect(request, cancel_token))
+        try:
+            generation_start = time.time()
+            responses = await pair.agenerate(**generation_kwargs)
+            trace.set(queue_time=pair.queue_wait_time)
+        except Exception as e:
+            finish("error")
+            return {"status_code": 500, "msg": "failed", "data": {}, "error": {"msg": str(e)}, "parameters": event.model_dump()}
+        finally:
+            watcher.cancel()
+        finish("error" if any(answer.startswith("❌") for answer in responses.values()) else "ok")
+        return {
+            "status_code": 200,
+            "msg": "success",
+            "data": {
+                "responses": responses,
+                "timing": {
+                    "queue_time": round(pair.queue_wait_time, 4),
+                    "generation_time": round(time.time() - generation_start, 4)
+                },
+                "served_by": pair.served_by
+            },
+            "error": {
+                "msg": ""
+            },
+            "parameters": event.model_dump()
+        }
+
+    encoder = build_stream_encoder(event.stream_format, request.headers.get("accept", ""))
+
+    async def generate_streaming_response():
+        activate(trace)
+        watcher = asyncio.create_task(watch_disconnect(request, cancel_token))
+        token_stream = pair.astream(**generation_kwargs)
+        completed = False
+        failed = False
+        token_counts = {role: 0 for role in _all_roles}
+        try:
+            yield encoder.start(event.model_dump())
+
+            if not pair.admitted:
+                async for position in pair.positions():
+                    if cancel_token.cancelled:
+                        return
+                    yield encoder.event("queue_position", {
+                        "position": position,
+                        "message": f"排队中，前面还有 {position - 1} 个请求",
+                        "state": "queued"
+                    })
+            generation_start = time.time()
+            trace.set(queue_time=pair.queue_wait_time)
+
+            # 两路 token 按到达顺序交错写出，token_count 按角色分别计数
+            async for role, token in token_stream:
+                if cancel_token.cancelled:
+                    break
+                token_counts[role] += 1
+                trace.mark_first_token()
+                if token[:1] == "❌":
+                    failed = True
+                write_start = time.perf_counter()
+                yield encoder.chunk(token, token_counts[role], role=role)
+                trace.accumulate("stream_write", time.perf_counter() - write_start)
+            else:
+                completed = True
+
+            if completed:
+                yield encoder.end(sum(token_counts.values()), {
+                    "queue_time": round(pair.queue_wait_time, 4),
+                    "generation_time": round(time.time() - generation_start, 4),
+                    "token_counts": token_counts,
+                    "served_by": pair.served_by
+                })
+        finally:
+            watcher.cancel()
+            if not completed:
+                cancel_token.cancel("client_disconnected")
+            await token_stream.aclose()
+            finish("error" if failed else ("ok" if completed else "cancelled"), sum(token_counts.values()))
+
+    return StreamingResponse(
+        generate_streaming_response(),
+        media_type=encoder.media_type,
+        headers=encoder.headers
+    )
+
+
+
+@router.get(
+    "/ready",
+    summary="服务就绪检查"
+)
+async def ready():
+    """
+    返回各引擎加载状态（unloaded / loading / ready / failed）。
+    预热列表（ENGINE_WARMUP）中的引擎全部就绪时返回 200，否则返回 503。
+    """
+    readiness = engine_manager.readiness()
+    return JSONResponse(
+        status_code=200 if readiness["ready"] else 503,
+        content=readiness
+    )
+
+
+@router.get(
+    "/metrics",
+    summary="服务指标（Prometheus 文本格式）"
+)
+async def get_metrics():
+    """
+    请求数 / 首 token 延迟 / 排队时间 / 输出速度 / 输入输出 token 数 / 各阶段耗时（按引擎、角色、入口区分），
+    以及批处理、KV cache、准入、回复缓存、请求合并、路由、历史裁剪等组件的实时统计。
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@router.get(
+    "/traces",
+    summary="最近请求的阶段耗时"
+)
+async def get_traces(limit: int = 50):
+    """ 最近请求的 trace：历史整理、对话模板、分词、prefill、decode、流式写出等阶段的耗时 """
+    return {"traces": tracer.traces(limit)}
+
+
+# =======================
+# 管理接口（请求头 X-Admin-Token 须与 ADMIN_TOKEN 一致）
+# =======================
+
+
+def admin_denied(request: Request):
+    """ 未配置 ADMIN_TOKEN 或令牌不符时返回 403 响应，否则返回 None """
+    token = CONFIG["admin_token"]
+    if not token:
+        return JSONResponse(status_code=403, content={"status_code": 403, "msg": "failed", "error": {"msg": "未配置 ADMIN_TOKEN，管理接口已关闭"}})
+    if not hmac.compare_digest(request.headers.get("x-admin-token", ""), token):
+        return JSONResponse(status_code=403, content={"status_code": 403, "msg": "failed", "error": {"msg": "管理令牌无效"}})
+    return None
+
+
+@router.post(
+    "/admin/profiling",
+    summary="开启性能剖析"
+)
+async def start_profiling(params: ProfilingParams, request: Request):
+    """
+    对接下来 `requests` 个本地生成请求（或 `duration` 秒内的请求）逐个采集 torch profiler 与 Python 调用栈采样，
+    结果按引擎 / 角色 / 输入长度 / batch 大小命名保存在 PROFILE_DIR 下。
+    """
+    denied = admin_denied(request)
+    if denied is not None:
+        return denied
+    return profiler.arm(requests=params.requests, duration=params.duration, kinds=params.kinds, interval=params.interval)
+
+
+@router.delete(
+    "/admin/profiling",
+    summary="关闭性能剖析"
+)
+async def stop_profiling(request: Request):
+    """ 停止后续采集，进行中的采集在该请求结束时保存 """
+    denied = admin_denied(request)
+    if denied is not None:
+        return denied
+    return profiler.disarm()
+
+
+@router.get(
+    "/admin/profiling",
+    summary="性能剖析状态与结果列表"
+)
+async def list_profiling(request: Request):
+    denied = admin_denied(request)
+    if denied is not None:
+        return denied
+    return {"status": profiler.status(), "profiles": profiler.list_profiles()}
+
+
+@router.get(
+    "/admin/profiling/{name}",
+    summary="下载性能剖析结果"
+)
+async def download_profiling(name: str, request: Request):
+    """ 打包为 zip：torch_trace.json(chrome://tracing / Perfetto)、torch_ops.txt、sampling.folded(speedscope)、meta.json """
+    denied = admin_denied(request)
+    if denied is not None:
+        return denied
+    path = await asyncio.get_running_loop().run_in_executor(None, profiler.archive, name)
+    if path is None:
+        return JSONResponse(status_code=404, content={"status_code": 404, "msg": "failed", "error": {"msg": f"{name} 不存在"}})
+    return FileResponse(path, media_type="application/zip", filename=f"{name}.zip")
@@ -2,15 +2,18 @@
 
 
 
+_role_map = {"user": "user", "assistant": "assistant", "answer": "assistant"}
+
+
 def process_history(raw_history:list):
-    """ 处理原始history数据 """
+    """ 处理原始history数据：只保留 user / assistant（answer 视为 assistant）且内容非空的消息 """
     result = []
     for item in raw_history:
         if not isinstance(item,dict):
             item = dict(item)
 
-        role = item.get("role",None)
-        if role and role in ["user","answer"]:
+        role = _role_map.get(item.get("role",None))
+        if role and item.get("content"):
             std_msg = {
                 "role": role,
                 "content":item.get("content")
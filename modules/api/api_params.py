@@ -11,8 +11,19 @@ class HistoryMessageParams(BaseModel):
 
 
 class ChatWithTranslationParams(BaseModel):
-    engine_type: str = "openAI"
-    role: str = "to_product"
+    engine_type: str = "openAI"   # local / openai / auto(按负载与健康状况自动选择，失败时切换)
+    role: str = "to_product"   # to_product / to_dev / both(同时生成两个视角，流式输出中以 role 字段区分) / auto(按意图识别选择方向)
     user_question: str = ""     # 输入问题
     stream: bool = False  # 新增流式输出开关
     history: List[HistoryMessageParams] = []
+    session_id: str = ""        # 可选：会话 id，本地引擎据此复用上一轮对话的 KV cache
+    stream_format: str = ""     # 可选：legacy / delta / sse，为空时按 Accept 头协商，默认 legacy
+    priority: str = "batch"     # 排队优先级：interactive(交互) / batch(批量)
+    coalesce: bool = False      # 可选：与正在进行的相同请求共享同一次生成（采样解码时需显式开启）
+
+
+class ProfilingParams(BaseModel):
+    requests: int = 1           # 采集接下来的本地生成请求数，<=0 且设置了 duration 时不限个数
+    duration: float = 0         # 可选：采集时间窗口(秒)，0 表示只按请求数
+    kinds: List[str] = ["torch", "sampling"]    # torch(算子耗时与内存) / sampling(Python 调用栈采样)
+    interval: float = 0.005     # 调用栈采样间隔(秒)
@@ -0,0 +1,200 @@
+import json
+
+
+""" 
+流式响应协议
+    - legacy : 旧格式，每个 chunk 携带累计的完整回复与全部请求参数（兼容老客户端）
+    - delta  : NDJSON，每个 chunk 只携带新增的 token，请求参数只在 stream_start 中发送一次
+    - sse    : 与 delta 相同的负载，使用 server-sent events 帧格式（text/event-stream）
+双视角模式（role=both）下两个角色的 token 交错发送，chunk 额外携带 role 字段，客户端按角色分别拼接
+"""
+
+
+STREAM_FORMATS = ["legacy", "delta", "sse"]
+
+
+class LegacyStreamEncoder:
+    """ 旧版累计格式 """
+    media_type = "application/json"
+    headers = {}
+
+    def __init__(self):
+        self.parameters = {}
+        self.full_response = ""
+        self.responses = {}     # 双视角模式：按角色累计
+
+    def encode(self, payload):
+        return json.dumps(payload, ensure_ascii=False) + "\n"
+
+    def start(self, parameters):
+        self.parameters = parameters
+        return self.encode({
+            "status_code": 200,
+            "msg": "stream_start",
+            "data": {
+                "response": "",
+                "message": "流式响应开始",
+                "token_count": 0,
+                "state": "start"
+            },
+            "error": {
+                "msg": ""
+            },
+            "parameters": self.parameters
+        })
+
+    def chunk(self, token, token_count, role=None):
+        data = {
+            "response": "",
+            "token_count": token_count,
+            "message": "流式响应生成中",
+            "state": "process"
+        }
+        if role is None:
+            self.full_response += token
+            data["response"] = self.full_response
+        else:
+            self.responses[role] = self.responses.get(role, "") + token
+            data.update(response=self.responses[role], role=role)
+        return self.encode({
+            "status_code": 200,
+            "msg": "stream_chunk",
+            "data": data,
+            "error": {
+                "msg": ""
+            },
+            "parameters": self.parameters
+        })
+
+    def event(self, msg, data):
+        """ 附加事件（如排队位置），沿用旧格式结构，response 保持为当前累计内容 """
+        return self.encode({
+            "status_code": 200,
+            "msg": msg,
+            "data": {
+                "response": self.full_response,
+                **data
+            },
+            "error": {
+                "msg": ""
+            },
+            "parameters": self.parameters
+        })
+
+    def end(self, token_count, timing=None):
+        data = {
+            "response": self.full_response,
+            "token_count": token_count,
+            "message": "流式响应完成",
+            "state": "end",
+            "timing": timing or {}
+        }
+        if self.responses:
+            data["responses"] = self.responses
+        return self.encode({
+            "status_code": 200,
+            "msg": "stream_end",
+            "data": data,
+            "error": {
+                "msg": ""
+            },
+            "parameters": self.parameters
+        })
+
+
+class DeltaStreamEncoder:
+    """ 增量格式：每个事件只携带新增 token，客户端自行拼接 """
+    media_type = "application/x-ndjson"
+    headers = {}
+
+    def encode(self, payload, event_name=None):
+        return json.dumps(payload, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+    def start(self, parameters):
+        return self.encode({
+            "status_code": 200,
+            "msg": "stream_start",
+            "data": {
+                "message": "流式响应开始",
+                "token_count": 0,
+                "state": "start"
+            },
+            "error": {
+                "msg": ""
+            },
+            "parameters": parameters
+        }, "stream_start")
+
+    def chunk(self, token, token_count, role=None):
+        data = {
+            "delta": token,
+            "token_count": token_count
+        }
+        if role is not None:
+            data["role"] = role
+        return self.encode({
+            "msg": "stream_chunk",
+            "data": data
+        }, "stream_chunk")
+
+    def event(self, msg, data):
+        return self.encode({
+            "msg": msg,
+            "data": data
+        }, msg)
+
+    def end(self, token_count, timing=None):
+        return self.encode({
+            "status_code": 200,
+            "msg": "stream_end",
+            "data": {
+                "message": "流式响应完成",
+                "token_count": token_count,
+                "state": "end",
+                "timing": timing or {}
+            },
+            "error": {
+                "msg": ""
+            }
+        }, "stream_end")
+
+
+class SseStreamEncoder(DeltaStreamEncoder):
+    """ server-sent events 帧格式 """
+    media_type = "text/event-stream"
+    headers = {
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    }
+
+    def encode(self, payload, event_name=None):
+        data = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+        if event_name:
+            return f"event: {event_name}\ndata: {data}\n\n"
+        return f"data: {data}\n\n"
+
+
+_ENCODERS = {
+    "legacy": LegacyStreamEncoder,
+    "delta": DeltaStreamEncoder,
+    "sse": SseStreamEncoder,
+}
+
+
+def negotiate_stream_format(stream_format="", accept=""):
+    """ 显式参数优先，其次按 Accept 头协商；都未指定时保持旧格式 """
+    if stream_format:
+        if stream_format not in _ENCODERS:
+            raise ValueError(f"stream_format must be one of {STREAM_FORMATS}, can't be {stream_format}")
+        return stream_format
+
+    accept = (accept or "").lower()
+    if "text/event-stream" in accept:
+        return "sse"
+    if "application/x-ndjson" in accept:
+        return "delta"
+    return "legacy"
+
+
+def build_stream_encoder(stream_format="", accept=""):
+    return _ENCODERS[negotiate_stream_format(stream_format, accept)]()
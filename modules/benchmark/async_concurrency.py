@@ -0,0 +1,150 @@
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from modules.benchmark.fake_engine import FakeEngine
+
+
+""" 
+并发基准：在若干条长生成进行的同时，测量事件循环上其他请求的响应延迟。
+    - sync  : 旧路径，在 async 处理函数中直接迭代阻塞的 generate_response
+    - async : 新路径，使用 astream / agenerate
+    - http  : 通过真实路由发起长流式请求，同时请求一个轻量接口
+用法: python -m modules.benchmark.async_concurrency --generations 4 --tokens 100
+"""
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(q * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(latencies):
+    return {
+        "count": len(latencies),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "max_ms": round(max(latencies) * 1000, 2) if latencies else 0.0,
+        "mean_ms": round(statistics.mean(latencies) * 1000, 2) if latencies else 0.0,
+    }
+
+
+async def probe_loop(stop_event, interval, latencies):
+    """ 模拟其他轻量请求：期望每 interval 秒被调度一次，记录实际延迟 """
+    while not stop_event.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        latencies.append(time.perf_counter() - start - interval)
+
+
+async def run_engine_mode(mode, engine, generations, interval):
+    async def sync_generation(i):
+        # 旧实现：阻塞迭代器直接在事件循环上消费
+        for _ in engine.generate_response(f"question {i}", [], "", stream=True):
+            await asyncio.sleep(0)
+
+    async def async_generation(i):
+        async for _ in engine.astream(f"question {i}", [], ""):
+            pass
+
+    worker = sync_generation if mode == "sync" else async_generation
+
+    latencies = []
+    stop_event = asyncio.Event()
+    probe = asyncio.create_task(probe_loop(stop_event, interval, latencies))
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(i) for i in range(generations)])
+    elapsed = time.perf_counter() - start
+
+    stop_event.set()
+    await probe
+
+    return {
+        "mode": mode,
+        "generations": generations,
+        "elapsed_s": round(elapsed, 3),
+        "probe_lag": summarize(latencies),
+    }
+
+
+async def run_http_mode(engine, generations, interval):
+    """ 通过真实 FastAPI 路由发起长流式请求，同时测量轻量接口延迟 """
+    import httpx
+    from fastapi import FastAPI
+    from modules.api.api import router
+    from modules.engine.engine_factory import engine_manager
+
+    engine_manager.openai_engine = engine
+    engine_manager.local_engine = engine
+
+    app = FastAPI()
+    app.include_router(router, prefix="/api")
+
+    @app.get("/ping")
+    async def ping():
+        return {"ok": True}
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+
+        async def long_stream(i):
+            await client.post(
+                "/api/chat_with_translation_agent",
+                json={"engine_type": "local", "role": "to_dev", "user_question": f"question {i}", "stream": True}
+            )
+
+        latencies = []
+        done = asyncio.Event()
+
+        async def ping_loop():
+            while not done.is_set():
+                start = time.perf_counter()
+                await client.get("/ping")
+                latencies.append(time.perf_counter() - start)
+                await asyncio.sleep(interval)
+
+        pinger = asyncio.create_task(ping_loop())
+        start = time.perf_counter()
+        await asyncio.gather(*[long_stream(i) for i in range(generations)])
+        elapsed = time.perf_counter() - start
+        done.set()
+        await pinger
+
+    return {
+        "mode": "http",
+        "generations": generations,
+        "elapsed_s": round(elapsed, 3),
+        "ping_latency": summarize(latencies),
+    }
+
+
+def cli_default_args():
+    parser = argparse.ArgumentParser(description="事件循环并发基准")
+    parser.add_argument("--generations", type=int, default=4, help="同时进行的长生成数量")
+    parser.add_argument("--tokens", type=int, default=100, help="每条生成的 token 数")
+    parser.add_argument("--token_latency", type=float, default=0.01, help="每个 token 的生成耗时(秒)")
+    parser.add_argument("--interval", type=float, default=0.01, help="探测请求间隔(秒)")
+    parser.add_argument("--skip_http", action="store_true", help="不运行 http 模式")
+    return parser.parse_args()
+
+
+async def main(args):
+    engine = FakeEngine(num_tokens=args.tokens, token_latency=args.token_latency)
+    results = [
+        await run_engine_mode("sync", engine, args.generations, args.interval),
+        await run_engine_mode("async", engine, args.generations, args.interval),
+    ]
+    if not args.skip_http:
+        results.append(await run_http_mode(engine, args.generations, args.interval))
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    return results
+
+
+if __name__ == "__main__":
+    asyncio.run(main(cli_default_args()))
@@ -0,0 +1,137 @@
+import argparse
+import difflib
+import gc
+import json
+import time
+
+
+"""
+CPU 推理模式对比：在 README 的示例问题上比较 fp32 / bf16 / int8 的加载耗时、内存、生成延迟与准确度
+准确度以第一个模式（默认 fp32）的贪心输出为参考：
+    - top1_agreement : 参考输出 teacher forcing 下逐位置 argmax 与参考 token 一致的比例
+    - text_similarity: 生成文本与参考文本的 difflib 相似度
+用法: python -m modules.benchmark.cpu_quantization --model_path modules/checkpoints/Qwen2.5-7B-Instruct --modes fp32,bf16,int8
+"""
+
+
+# README「example question」中的测试示范问题
+EXAMPLE_QUESTIONS = [
+    "我们需要实现一个类似抖音的短视频信息流，支持千万级日活。",
+    "我们将数据库从 MySQL 迁移到了 TiDB，解决了长尾延迟问题。",
+    "如何做一个电商类的推荐系统项目。",
+]
+
+
+def build_input_ids(tokenizer, sys_prompt, question):
+    text = tokenizer.apply_chat_template(
+        [
+            {"role": "system", "content": sys_prompt},
+            {"role": "user", "content": question},
+        ],
+        tokenize=False,
+        add_generation_prompt=True
+    )
+    return tokenizer(text, return_tensors="pt")["input_ids"]
+
+
+def top1_agreement(model, input_ids, reference_ids):
+    """ 以参考输出做 teacher forcing，统计每个位置的 argmax 是否与参考 token 一致 """
+    import torch
+    if not reference_ids:
+        return 1.0
+    full_ids = torch.cat([input_ids, torch.tensor([reference_ids])], dim=-1)
+    with torch.inference_mode():
+        logits = model(input_ids=full_ids).logits[0]
+    start = input_ids.shape[-1] - 1
+    predicted = logits[start:start + len(reference_ids)].argmax(dim=-1).tolist()
+    return sum(p == r for p, r in zip(predicted, reference_ids)) / len(reference_ids)
+
+
+def run_mode(args, mode, sys_prompt, references):
+    import torch
+    from modules.llm.model_loader import ModelLoader
+    from modules.llm.quantization import cpu_mode_dtype
+
+    loader = ModelLoader(
+        args.model_path,
+        device="cpu",
+        dtype=cpu_mode_dtype(mode),
+        strategy=args.load_strategy,
+        num_threads=args.load_threads,
+        quantize="int8" if mode == "int8" else None
+    )
+    model, tokenizer = loader.load()
+
+    results = []
+    for index, question in enumerate(EXAMPLE_QUESTIONS):
+        input_ids = build_input_ids(tokenizer, sys_prompt, question)
+        start = time.perf_counter()
+        with torch.inference_mode():
+            output = model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                max_new_tokens=args.max_new_tokens,
+                do_sample=False
+            )
+        latency = time.perf_counter() - start
+        output_ids = output[0, input_ids.shape[-1]:].tolist()
+        text = tokenizer.decode(output_ids, skip_special_tokens=True)
+
+        if index not in references:
+            references[index] = (output_ids, text)
+        reference_ids, reference_text = references[index]
+
+        results.append({
+            "question": question,
+            "latency_s": round(latency, 3),
+            "new_tokens": len(output_ids),
+            "tokens_per_s": round(len(output_ids) / latency, 2) if latency else 0.0,
+            "top1_agreement": round(top1_agreement(model, input_ids, reference_ids), 4),
+            "text_similarity": round(difflib.SequenceMatcher(None, text, reference_text).ratio(), 4),
+            "answer": text if args.show_answers else text[:80],
+        })
+
+    report = {
+        "mode": mode,
+        "load": loader.stats(),
+        "avg_latency_s": round(sum(r["latency_s"] for r in results) / len(results), 3),
+        "avg_tokens_per_s": round(sum(r["tokens_per_s"] for r in results) / len(results), 2),
+        "avg_top1_agreement": round(sum(r["top1_agreement"] for r in results) / len(results), 4),
+        "avg_text_similarity": round(sum(r["text_similarity"] for r in results) / len(results), 4),
+        "questions": results,
+    }
+
+    del model
+    gc.collect()
+    return report
+
+
+def cli_default_args():
+    parser = argparse.ArgumentParser(description="CPU 推理模式（fp32 / bf16 / int8）准确度与延迟对比")
+    parser.add_argument("--model_path", type=str, required=True)
+    parser.add_argument("--modes", type=str, default="fp32,bf16,int8", help="第一个模式作为准确度参考")
+    parser.add_argument("--role", type=str, default="to_dev", choices=["to_dev", "to_product"])
+    parser.add_argument("--max_new_tokens", type=int, default=128)
+    parser.add_argument("--load_strategy", type=str, default="fast")
+    parser.add_argument("--load_threads", type=int, default=4)
+    parser.add_argument("--show_answers", action="store_true")
+    parser.add_argument("--output", type=str, default="", help="结果另存为 JSON 文件")
+    return parser.parse_args()
+
+
+def main():
+    args = cli_default_args()
+    from modules.prompts.prompt_map import prod_prompt, dev_prompt
+    sys_prompt = prod_prompt if args.role == "to_product" else dev_prompt
+
+    references = {}
+    reports = [run_mode(args, mode, sys_prompt, references) for mode in args.modes.split(",")]
+
+    print(json.dumps(reports, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
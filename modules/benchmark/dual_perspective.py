@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import time
+
+from modules.benchmark.async_concurrency import percentile
+from modules.benchmark.cpu_quantization import EXAMPLE_QUESTIONS
+from modules.benchmark.load_test import setup_backend
+from modules.prompts.prompt_map import prod_prompt, dev_prompt
+
+
+"""
+双视角生成对比：先后生成两个视角（旧的 switch_and_retry 流程） vs 同时生成（DualPerspective）
+统计两个视角都完成的总耗时，以及第二个视角首 token 的等待时间（用户切换视角时实际感受到的延迟）。
+本地引擎下可观察两个序列是否进入同一 batch（batch_stats 中的 avg_batch_size）。
+用法: python -m modules.benchmark.dual_perspective --backend fake --requests 10
+      python -m modules.benchmark.dual_perspective --backend real --engine_type local
+"""
+
+
+PROMPTS = {"to_dev": dev_prompt, "to_product": prod_prompt}
+
+
+async def consume(router, decision, question, sys_prompt, start):
+    """ 消费一路流式输出，返回 (首 token 时间, 结束时间)，均相对 start """
+    first = None
+    stream = router.astream(decision, user_query=question, history=[], sys_prompt=sys_prompt)
+    try:
+        async for token in stream:
+            if first is None and token:
+                first = time.perf_counter() - start
+    finally:
+        await stream.aclose()
+    return first, time.perf_counter() - start
+
+
+async def run_sequential(engine_manager, args, question):
+    """ 旧流程：当前视角生成完后，再以另一视角重新生成 """
+    router = engine_manager.router
+    start = time.perf_counter()
+    timings = []
+    for role, sys_prompt in PROMPTS.items():
+        decision = await router.acquire(args.engine_type, "interactive")
+        try:
+            if decision.ticket is not None:
+                await decision.ticket.wait()
+            timings.append(await consume(router, decision, question, sys_prompt, start))
+        finally:
+            decision.release()
+    return timings
+
+
+async def run_dual(engine_manager, args, question):
+    from modules.engine.dual_perspective import DualPerspective
+    pair = await DualPerspective.acquire(engine_manager.router, args.engine_type, list(PROMPTS), "interactive")
+    start = time.perf_counter()
+    first = {}
+    try:
+        async for role, token in pair.astream(question, PROMPTS, history=[], priority="interactive"):
+            if token and role not in first:
+                first[role] = time.perf_counter() - start
+        end = time.perf_counter() - start
+    finally:
+        pair.release()
+    return [(first.get(role), end) for role in PROMPTS]
+
+
+async def run(args):
+    from modules.engine.engine_factory import engine_manager
+
+    reports = []
+    with contextlib.ExitStack() as stack:
+        setup_backend(args, stack)
+        if args.backend == "real":
+            await engine_manager.aget_engine(args.engine_type)
+        for mode, runner in (("sequential", run_sequential), ("dual", run_dual)):
+            totals, second_first = [], []
+            for i in range(args.requests):
+                question = EXAMPLE_QUESTIONS[i % len(EXAMPLE_QUESTIONS)] + f" ({mode} {i})"
+                timings = await runner(engine_manager, args, question)
+                totals.append(max(end for _, end in timings))
+                second_first.append(max(first for first, _ in timings if first is not None))
+            report = {
+                "mode": mode,
+                "backend": args.backend,
+                "engine_type": args.engine_type,
+                "requests": args.requests,
+                "both_done_p50_s": round(percentile(totals, 0.5), 3),
+                "both_done_max_s": round(max(totals), 3),
+                "second_view_first_token_p50_s": round(percentile(second_first, 0.5), 3),
+            }
+            local = engine_manager.local_engine
+            if args.engine_type == "local" and hasattr(local, "batch_stats"):
+                report["batch"] = local.batch_stats()
+            reports.append(report)
+    return reports
+
+
+def cli_default_args():
+    parser = argparse.ArgumentParser(description="双视角同时生成 vs 先后生成")
+    parser.add_argument("--backend", type=str, default="fake", choices=["fake", "stub", "real"])
+    parser.add_argument("--engine_type", type=str, default="local", help="local / openai / auto")
+    parser.add_argument("--requests", type=int, default=10)
+    parser.add_argument("--tokens", type=int, default=64, help="fake / stub 每次回复的 token 数")
+    parser.add_argument("--token_latency", type=float, default=0.01, help="fake / stub 每个 token 的耗时(秒)")
+    parser.add_argument("--prefill_latency", type=float, default=0.05, help="fake / stub 首 token 前的耗时(秒)")
+    parser.add_argument("--stub_port", type=int, default=8901)
+    parser.add_argument("--concurrency", type=int, default=2, help="stub 客户端连接数")
+    parser.add_argument("--keep_cache", action="store_true", help="保留回复缓存（默认关闭以测量真实生成）")
+    parser.add_argument("--output", type=str, default="", help="结果另存为 JSON 文件")
+    return parser.parse_args()
+
+
+def main():
+    args = cli_default_args()
+    reports = asyncio.run(run(args))
+    print(json.dumps(reports, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import asyncio
+import time
+from functools import partial
+
+from modules.utils.async_tool import iterate_in_thread
+from modules.utils.cancellation import CancellationToken
+
+
+class FakeEngine:
+    """
+    确定性假引擎：按固定延迟吐出固定 token，接口与 LocalModelChat / OpenAIModel 一致，
+    用于在无 GPU、无网络的环境下进行基准测试
+    """
+    def __init__(
+            self,
+            num_tokens=64,
+            token_latency=0.01,
+            prefill_latency=0.0,
+            name="fake"
+    ):
+        self.num_tokens = num_tokens
+        self.token_latency = token_latency
+        self.prefill_latency = prefill_latency
+        self.name = name
+
+    def tokens(self, user_query):
+        """ 由问题确定性地生成回复 token """
+        seed = sum(ord(c) for c in user_query or "")
+        return [f"tok{(seed + i) % 1000} " for i in range(self.num_tokens)]
+
+    def _stream(self, user_query, cancel_token=None):
+        # 与本地模型一样，生成过程是阻塞的
+        time.sleep(self.prefill_latency)
+        for token in self.tokens(user_query):
+            if cancel_token is not None and cancel_token.cancelled:
+                return
+            time.sleep(self.token_latency)
+            yield token
+
+    def generate_response(self, user_query, history=None, sys_prompt=None, stream=False, session_id=None, cancel_token=None):
+        if stream:
+            return self._stream(user_query, cancel_token)
+        return "".join(self._stream(user_query, cancel_token))
+
+    async def agenerate(self, user_query, history=None, sys_prompt=None, session_id=None, cancel_token=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None,
+            partial(self.generate_response, user_query, history, sys_prompt, False, session_id, cancel_token)
+        )
+
+    async def astream(self, user_query, history=None, sys_prompt=None, session_id=None, cancel_token=None):
+        cancel_token = cancel_token or CancellationToken()
+        completed = False
+        try:
+            async for token in iterate_in_thread(self._stream(user_query, cancel_token)):
+                yield token
+            completed = True
+        finally:
+            if not completed:
+                cancel_token.cancel("consumer_closed")
@@ -0,0 +1,443 @@
+import argparse
+import asyncio
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+
+from modules.benchmark.async_concurrency import percentile
+from modules.benchmark.cpu_quantization import EXAMPLE_QUESTIONS
+from modules.benchmark.fake_engine import FakeEngine
+
+
+"""
+吞吐 / 延迟压测：以固定并发（闭环）或固定到达速率（开环）发起请求，统计首 token 延迟(TTFT)、token 间隔(ITL)、
+端到端延迟、tokens/s 的 p50/p95/p99 与错误率，结果输出为 JSON，可与基线结果对比（--compare）
+    target  : engine(直接调用引擎层，经过路由 / 历史裁剪 / 准入) / http(调用 /api/chat_with_translation_agent)
+    backend : fake(确定性假引擎) / stub(本地 OpenAI 兼容桩服务 + 在线引擎) / real(使用 .env 中配置的真实引擎)
+    --url   : 压测已启动的服务（此时 backend 由服务端决定）
+问题集为 README 示例问题 + 按比例混入的合成长问题，历史轮数从 --history_turns 中随机选取，随机数种子固定
+用法:
+    python -m modules.benchmark.load_test --target http --stream both --concurrency 8 --requests 200 --output bench.json
+    python -m modules.benchmark.load_test --target http --backend stub --compare bench.json
+"""
+
+
+LONG_PARAGRAPH = (
+    "我们的订单系统目前采用单体架构，高峰期下单接口 P99 延迟超过 2 秒，数据库主库 CPU 长期在 80% 以上，"
+    "运营希望在大促期间支持十倍流量，同时要求库存不超卖、优惠券可叠加、订单状态实时同步给商家后台。"
+)
+
+
+def build_question(rng, long_ratio, long_chars):
+    if rng.random() < long_ratio:
+        return (LONG_PARAGRAPH * (long_chars // len(LONG_PARAGRAPH) + 1))[:long_chars]
+    return rng.choice(EXAMPLE_QUESTIONS)
+
+
+def build_history(turns):
+    history = []
+    for i in range(turns):
+        history.append({"role": "user", "content": EXAMPLE_QUESTIONS[i % len(EXAMPLE_QUESTIONS)]})
+        history.append({"role": "assistant", "content": "业务场景定性：高并发信息流推荐。技术实现路径：召回 + 排序 + 缓存。" * 3})
+    return history
+
+
+def build_workload(args):
+    """ 预先生成全部请求，保证同一种子下各次压测的负载一致 """
+    rng = random.Random(args.seed)
+    turns = [int(t) for t in str(args.history_turns).split(",") if t != ""] or [0]
+    workload = []
+    for i in range(args.requests):
+        workload.append({
+            "index": i,
+            "role": rng.choice(["to_dev", "to_product"]),
+            "question": build_question(rng, args.long_ratio, args.long_chars),
+            "history": build_history(rng.choice(turns)),
+        })
+    return workload
+
+
+class RequestResult:
+    def __init__(self, index, stream):
+        self.index = index
+        self.stream = stream
+        self.start = time.perf_counter()
+        self.first_token = None
+        self.token_times = []
+        self.tokens = 0
+        self.end = None
+        self.error = None
+        self.served_by = None
+
+    def on_token(self, count=1):
+        now = time.perf_counter()
+        if self.first_token is None:
+            self.first_token = now
+        self.token_times.append(now)
+        self.tokens += count
+
+    def finish(self, error=None):
+        self.end = time.perf_counter()
+        self.error = error
+
+    @property
+    def ttft(self):
+        return None if self.first_token is None else self.first_token - self.start
+
+    @property
+    def latency(self):
+        return self.end - self.start
+
+    @property
+    def inter_token_latencies(self):
+        return [b - a for a, b in zip(self.token_times, self.token_times[1:])]
+
+
+# ============ 请求发送 ============ #
+
+
+async def run_engine_request(item, result, args, priority="batch"):
+    """ 直接调用引擎层：与 API 相同的路由 / 准入 / 历史裁剪路径，不经过 HTTP """
+    from modules.engine.engine_factory import engine_manager
+    from modules.prompts.prompt_map import prod_prompt, dev_prompt
+
+    prompt = prod_prompt if item["role"] == "to_product" else dev_prompt
+    decision = await engine_manager.router.acquire(args.engine_type, priority)
+    if decision.engine is None:
+        return result.finish("engine_not_ready")
+    try:
+        if decision.ticket is not None:
+            await decision.ticket.wait()
+        if result.stream:
+            error = None
+            async for token in engine_manager.router.astream(
+                    decision, item["question"], item["history"], prompt, priority=priority
+            ):
+                if token.startswith("❌"):
+                    error = token[:120]
+                    break
+                result.on_token()
+        else:
+            answer = await engine_manager.router.agenerate(decision, item["question"], item["history"], prompt, priority=priority)
+            error = answer[:120] if answer.startswith("❌") else None
+        result.served_by = decision.served_by
+        result.finish(error)
+    finally:
+        decision.release()
+
+
+async def run_http_request(client, item, result, args):
+    body = {
+        "engine_type": args.engine_type,
+        "role": item["role"],
+        "user_question": item["question"],
+        "history": item["history"],
+        "stream": result.stream,
+        "stream_format": "delta",
+        "priority": "batch",
+    }
+    if not result.stream:
+        response = await client.post("/api/chat_with_translation_agent", json=body)
+        payload = response.json() if response.headers.get("content-type", "").startswith("application/json") else {}
+        if response.status_code != 200 or payload.get("status_code", 200) != 200:
+            return result.finish(f"http_{response.status_code}: {str(payload.get('error', ''))[:100]}")
+        answer = payload["data"]["response"] or ""
+        result.served_by = payload["data"].get("served_by")
+        return result.finish(answer[:120] if answer.startswith("❌") else None)
+
+    error = None
+    async with client.stream("POST", "/api/chat_with_translation_agent", json=body) as response:
+        if response.status_code != 200:
+            await response.aread()
+            return result.finish(f"http_{response.status_code}")
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            if event.get("status_code", 200) != 200:
+                error = str(event.get("error", {}).get("msg", ""))[:120]
+                break
+            msg = event.get("msg")
+            if msg == "stream_chunk":
+                delta = event["data"].get("delta", "")
+                if delta.startswith("❌"):
+                    error = delta[:120]
+                    break
+                result.on_token()
+            elif msg == "stream_end":
+                result.served_by = event["data"].get("timing", {}).get("served_by")
+    result.finish(error)
+
+
+# ============ 负载生成 ============ #
+
+
+async def drive(workload, send, stream, concurrency, rate, seed):
+    """ rate > 0 时按泊松到达（开环）发起请求，否则以固定并发（闭环）发起 """
+    results = []
+
+    async def one(item):
+        result = RequestResult(item["index"], stream)
+        results.append(result)
+        try:
+            await send(item, result)
+        except Exception as e:
+            result.finish(f"{type(e).__name__}: {str(e)[:100]}")
+
+    if rate > 0:
+        rng = random.Random(seed)
+        tasks = []
+        for item in workload:
+            tasks.append(asyncio.create_task(one(item)))
+            await asyncio.sleep(rng.expovariate(rate))
+        await asyncio.gather(*tasks)
+    else:
+        queue = asyncio.Queue()
+        for item in workload:
+            queue.put_nowait(item)
+
+        async def worker():
+            while not queue.empty():
+                await one(queue.get_nowait())
+
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return results
+
+
+def distribution(values, scale=1000.0):
+    if not values:
+        return {"count": 0, "mean": None, "p50": None, "p95": None, "p99": None, "max": None}
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values) * scale, 3),
+        "p50": round(percentile(values, 0.5) * scale, 3),
+        "p95": round(percentile(values, 0.95) * scale, 3),
+        "p99": round(percentile(values, 0.99) * scale, 3),
+        "max": round(max(values) * scale, 3),
+    }
+
+
+def summarize_results(name, results, elapsed):
+    ok = [r for r in results if r.error is None]
+    errors = {}
+    for r in results:
+        if r.error is not None:
+            errors[r.error] = errors.get(r.error, 0) + 1
+    served = {}
+    for r in ok:
+        served[r.served_by] = served.get(r.served_by, 0) + 1
+
+    # 非流式请求无法区分 token，tokens/s 只统计流式请求
+    streamed = [r for r in ok if r.stream]
+    total_tokens = sum(r.tokens for r in streamed)
+    per_request_tps = [
+        (r.tokens - 1) / (r.end - r.first_token)
+        for r in ok if r.stream and r.tokens > 1 and r.end > r.first_token
+    ]
+    return {
+        "scenario": name,
+        "requests": len(results),
+        "succeeded": len(ok),
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else 0.0,
+        "errors": errors,
+        "served_by": served,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(ok) / elapsed, 3) if elapsed else 0.0,
+        "throughput_tokens_per_s": round(total_tokens / elapsed, 2) if elapsed and streamed else None,
+        "ttft_ms": distribution([r.ttft for r in ok if r.stream and r.ttft is not None]),
+        "itl_ms": distribution([gap for r in ok if r.stream for gap in r.inter_token_latencies]),
+        "latency_ms": distribution([r.latency for r in ok]),
+        "tokens_per_s_per_request": distribution(per_request_tps, scale=1.0),
+    }
+
+
+# ============ 后端准备 ============ #
+
+
+def setup_backend(args, stack):
+    """ 注入假引擎 / 桩服务引擎，关闭回复缓存（除非 --keep_cache）避免重复问题直接命中 """
+    from modules.engine.engine_factory import engine_manager
+
+    if args.backend == "fake":
+        engine = FakeEngine(
+            num_tokens=args.tokens,
+            token_latency=args.token_latency,
+            prefill_latency=args.prefill_latency,
+            name="fake"
+        )
+        engine_manager.local_engine = engine
+        engine_manager.openai_engine = engine
+    elif args.backend == "stub":
+        from modules.benchmark.openai_stub import StubServer
+        from modules.llm.online_model import OpenAIModel
+        stub = stack.enter_context(StubServer(
+            port=args.stub_port,
+            num_tokens=args.tokens,
+            token_latency=args.token_latency,
+            first_token_delay=args.prefill_latency
+        ))
+        engine = OpenAIModel(api_key="stub", base_url=stub.base_url, model="stub", max_connections=max(100, args.concurrency * 2))
+        engine_manager.local_engine = engine
+        engine_manager.openai_engine = engine
+
+    if not args.keep_cache:
+        engine_manager.response_cache = None
+    engine_manager._wrapped_engines = {}
+
+
+async def run_scenarios(args):
+    import contextlib
+    workload = build_workload(args)
+    modes = {"both": [True, False], "stream": [True], "nonstream": [False]}[args.stream]
+    reports = []
+
+    with contextlib.ExitStack() as stack:
+        client = None
+        if args.target == "http":
+            import httpx
+            if args.url:
+                client = httpx.AsyncClient(base_url=args.url, timeout=None, limits=httpx.Limits(max_connections=args.concurrency * 2 + 10))
+            else:
+                setup_backend(args, stack)
+                # 在后台线程中启动真实的 uvicorn 服务（ASGITransport 会缓冲整个响应体，无法测量流式的 TTFT / ITL）
+                from fastapi import FastAPI
+                from modules.api.api import router
+                from modules.benchmark.openai_stub import AppServer
+                app = FastAPI()
+                app.include_router(router, prefix="/api")
+                server = stack.enter_context(AppServer(app, port=args.api_port))
+                limits = httpx.Limits(max_connections=args.concurrency * 2 + 10)
+                client = httpx.AsyncClient(base_url=server.base_url, timeout=None, limits=limits)
+        else:
+            setup_backend(args, stack)
+
+        try:
+            for stream in modes:
+                if client is not None:
+                    send = lambda item, result: run_http_request(client, item, result, args)
+                else:
+                    send = lambda item, result: run_engine_request(item, result, args)
+                name = f"{args.target}/{args.backend if not args.url else 'remote'}/{'stream' if stream else 'nonstream'}"
+
+                # 预热：不计入统计
+                if args.warmup:
+                    await drive(workload[:args.warmup], send, stream, args.concurrency, 0, args.seed)
+
+                start = time.perf_counter()
+                results = await drive(workload, send, stream, args.concurrency, args.rate, args.seed)
+                reports.append(summarize_results(name, results, time.perf_counter() - start))
+        finally:
+            if client is not None:
+                await client.aclose()
+    return reports
+
+
+# ============ 结果对比 ============ #
+
+
+COMPARED_METRICS = [
+    ("ttft_ms", "p95", "lower"),
+    ("itl_ms", "p95", "lower"),
+    ("latency_ms", "p50", "lower"),
+    ("latency_ms", "p99", "lower"),
+    ("throughput_rps", None, "higher"),
+    ("throughput_tokens_per_s", None, "higher"),
+    ("error_rate", None, "lower"),
+]
+
+
+def metric_value(report, metric, stat):
+    value = report.get(metric)
+    return value.get(stat) if stat else value
+
+
+def compare(current, baseline, tolerance):
+    """ 与基线逐场景对比关键指标，变差超过 tolerance（比例）记为回归 """
+    baseline_by_name = {r["scenario"]: r for r in baseline["scenarios"]}
+    rows, regressions = [], []
+    for report in current["scenarios"]:
+        base = baseline_by_name.get(report["scenario"])
+        if base is None:
+            continue
+        for metric, stat, better in COMPARED_METRICS:
+            new, old = metric_value(report, metric, stat), metric_value(base, metric, stat)
+            if new is None or old is None:
+                continue
+            label = f"{metric}.{stat}" if stat else metric
+            change = (new - old) / old if old else (0.0 if new == old else float("inf"))
+            worse = change > tolerance if better == "lower" else change < -tolerance
+            if metric == "error_rate":
+                worse = new > old + tolerance * 0.1
+            row = {"scenario": report["scenario"], "metric": label, "baseline": old, "current": new,
+                   "change": round(change, 4) if change != float("inf") else None, "regression": worse}
+            rows.append(row)
+            if worse:
+                regressions.append(row)
+    return {"tolerance": tolerance, "rows": rows, "regressions": regressions}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def cli_default_args():
+    parser = argparse.ArgumentParser(description="翻译助手吞吐 / 延迟压测")
+    parser.add_argument("--target", type=str, default="http", choices=["http", "engine"])
+    parser.add_argument("--backend", type=str, default="fake", choices=["fake", "stub", "real"])
+    parser.add_argument("--url", type=str, default="", help="压测已启动的服务，如 http://127.0.0.1:8000")
+    parser.add_argument("--engine_type", type=str, default="local", help="请求中的 engine_type: local / openai / auto")
+    parser.add_argument("--stream", type=str, default="both", choices=["both", "stream", "nonstream"])
+    parser.add_argument("--concurrency", type=int, default=8, help="闭环并发数")
+    parser.add_argument("--rate", type=float, default=0.0, help="开环到达速率(请求/秒)，>0 时忽略 concurrency")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=0, help="预热请求数，不计入统计")
+    parser.add_argument("--history_turns", type=str, default="0,2,8", help="历史轮数候选，逗号分隔")
+    parser.add_argument("--long_ratio", type=float, default=0.2, help="合成长问题占比")
+    parser.add_argument("--long_chars", type=int, default=2000, help="合成长问题字数")
+    parser.add_argument("--tokens", type=int, default=64, help="fake / stub 每次回复的 token 数")
+    parser.add_argument("--token_latency", type=float, default=0.01, help="fake / stub 每个 token 的耗时(秒)")
+    parser.add_argument("--prefill_latency", type=float, default=0.05, help="fake / stub 首 token 前的耗时(秒)")
+    parser.add_argument("--stub_port", type=int, default=8901)
+    parser.add_argument("--api_port", type=int, default=8902, help="--target http 且未指定 --url 时，进程内 API 服务的端口")
+    parser.add_argument("--keep_cache", action="store_true", help="保留回复缓存（默认关闭以测量真实生成）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="", help="结果另存为 JSON 文件")
+    parser.add_argument("--compare", type=str, default="", help="基线结果 JSON，对比后有回归时以非 0 状态码退出")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="对比时允许的变差比例")
+    return parser.parse_args()
+
+
+def main():
+    args = cli_default_args()
+    scenarios = asyncio.run(run_scenarios(args))
+    result = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "args": vars(args),
+        },
+        "scenarios": scenarios,
+    }
+
+    exit_code = 0
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            result["comparison"] = compare(result, json.load(f), args.tolerance)
+        exit_code = 1 if result["comparison"]["regressions"] else 0
+
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import argparse
+import json
+import subprocess
+import sys
+
+
+"""
+模型加载基准：每种加载方式在独立子进程中运行（峰值 RSS 互不影响），并测量 release 后重新加载的耗时
+用法: python -m modules.benchmark.model_loading --model_path modules/checkpoints/Qwen2.5-7B-Instruct --strategies default,fast
+"""
+
+
+def child_main(model_path, strategy, threads, device):
+    import gc
+    import torch
+    from modules.llm.model_loader import ModelLoader
+
+    dtype = torch.float16 if str(device).startswith("cuda") else torch.float32
+    loader = ModelLoader(model_path, device=device, dtype=dtype, strategy=strategy, num_threads=threads)
+
+    model, _ = loader.load()
+    first = loader.stats()
+
+    # 模拟 release_memory 后重新加载
+    del model
+    gc.collect()
+    if str(device).startswith("cuda"):
+        torch.cuda.empty_cache()
+    model, _ = loader.load()
+    reload = loader.stats()
+
+    return {"strategy": strategy, "threads": threads, "first_load": first, "reload": reload}
+
+
+def cli_default_args():
+    parser = argparse.ArgumentParser(description="模型加载基准")
+    parser.add_argument("--model_path", type=str, required=True)
+    parser.add_argument("--strategies", type=str, default="default,fast")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--device", type=str, default="", help="为空时有 GPU 用 cuda:0，否则用 cpu")
+    parser.add_argument("--child", type=str, default="", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = cli_default_args()
+    device = args.device
+    if not device:
+        import torch
+        device = "cuda:0" if torch.cuda.is_available() else "cpu"
+
+    if args.child:
+        result = child_main(args.model_path, args.child, args.threads, device)
+        print(json.dumps(result, ensure_ascii=False))
+        return
+
+    results = []
+    for strategy in args.strategies.split(","):
+        command = [
+            sys.executable, "-m", "modules.benchmark.model_loading",
+            "--model_path", args.model_path,
+            "--threads", str(args.threads),
+            "--device", device,
+            "--child", strategy
+        ]
+        output = subprocess.run(command, capture_output=True, text=True)
+        lines = [line for line in output.stdout.splitlines() if line.startswith("{")]
+        if output.returncode != 0 or not lines:
+            results.append({"strategy": strategy, "error": output.stderr.strip().splitlines()[-1:]})
+            continue
+        results.append(json.loads(lines[-1]))
+
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
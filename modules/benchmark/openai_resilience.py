@@ -0,0 +1,122 @@
+import argparse
+import asyncio
+import json
+import time
+
+from modules.benchmark.async_concurrency import summarize
+from modules.benchmark.openai_stub import DEFAULT_BEHAVIOUR, StubServer
+
+
+"""
+在线引擎容错测试：对本地 OpenAI 兼容桩服务依次运行以下场景，输出首 token 延迟、结果与重试 / 对冲 / 熔断统计
+    - baseline  : 正常响应
+    - transient : 前 2 个请求返回 503，首 token 前重试后成功
+    - tail      : 部分请求首 token 长尾延迟，对比开启 / 关闭对冲的 p95
+    - hang      : 上游挂起，首 token 超时后报错而不是一直等待
+    - midstream : 输出部分 token 后断流，不重试（避免重复输出），直接报错
+    - outage    : 上游持续失败，熔断后快速失败
+用法: python -m modules.benchmark.openai_resilience --port 8900
+"""
+
+
+def build_model(base_url, **kwargs):
+    from modules.llm.online_model import OpenAIModel
+    options = dict(
+        api_key="stub",
+        base_url=base_url,
+        model="stub",
+        first_token_timeout=1.0,
+        total_timeout=10.0,
+        max_retries=2,
+        retry_backoff=0.05,
+    )
+    options.update(kwargs)
+    return OpenAIModel(**options)
+
+
+async def run_requests(model, num_requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            start = time.perf_counter()
+            first_token = None
+            chunks = []
+            async for chunk in model.astream(f"question {i}", [], "stub"):
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                chunks.append(chunk)
+            text = "".join(chunks)
+            return {
+                "ttft": first_token,
+                "elapsed": time.perf_counter() - start,
+                "ok": not text.startswith("❌") and "❌" not in text,
+                "text": text,
+            }
+
+    return await asyncio.gather(*[one(i) for i in range(num_requests)])
+
+
+def report(name, results, model, stub):
+    errors = sorted({r["text"][r["text"].index("❌"):][:80] for r in results if not r["ok"]})
+    return {
+        "scenario": name,
+        "requests": len(results),
+        "succeeded": sum(r["ok"] for r in results),
+        "ttft": summarize([r["ttft"] for r in results if r["ok"] and r["ttft"] is not None]),
+        "elapsed": summarize([r["elapsed"] for r in results]),
+        "upstream_requests": stub.state.requests,
+        "errors": errors,
+        "client": model.resilience_stats(),
+    }
+
+
+async def scenario(stub, name, behaviour, num_requests, concurrency, **model_kwargs):
+    # 每个场景从默认行为开始
+    stub.configure(**{**DEFAULT_BEHAVIOUR, **behaviour})
+    model = build_model(stub.base_url, **model_kwargs)
+    try:
+        results = await run_requests(model, num_requests, concurrency)
+        return report(name, results, model, stub)
+    finally:
+        await model.aclose()
+
+
+async def run(args):
+    reports = []
+    with StubServer(port=args.port) as stub:
+        n, c = args.requests, args.concurrency
+        reports.append(await scenario(stub, "baseline", {}, n, c))
+        reports.append(await scenario(stub, "transient", {"fail_first": 2}, n, c))
+        tail = {"slow_rate": 0.2, "slow_delay": 1.5, "seed": 7}
+        reports.append(await scenario(stub, "tail(no hedge)", tail, n, c, first_token_timeout=5.0))
+        reports.append(await scenario(stub, "tail(hedge 0.3s)", tail, n, c, first_token_timeout=5.0, hedge_after=0.3))
+        reports.append(await scenario(stub, "hang", {"hang_rate": 1.0}, 2, c, first_token_timeout=0.5, max_retries=1))
+        reports.append(await scenario(stub, "midstream", {"drop_after": 5}, 2, c))
+        reports.append(await scenario(
+            stub, "outage", {"error_rate": 1.0}, n, 1,
+            max_retries=0, breaker_threshold=3, breaker_cooldown=30
+        ))
+    return reports
+
+
+def cli_default_args():
+    parser = argparse.ArgumentParser(description="在线引擎超时 / 重试 / 对冲 / 熔断测试（本地桩服务）")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=5)
+    parser.add_argument("--output", type=str, default="", help="结果另存为 JSON 文件")
+    return parser.parse_args()
+
+
+def main():
+    args = cli_default_args()
+    reports = asyncio.run(run(args))
+    print(json.dumps(reports, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
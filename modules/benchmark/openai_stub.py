@@ -0,0 +1,218 @@
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+
+
+"""
+本地 OpenAI 兼容桩服务（/v1/chat/completions，支持 stream），用于在无网络环境下测试在线引擎的超时、重试、对冲与熔断。
+行为可在启动时指定，也可运行中通过 POST /stub/config 修改：
+    num_tokens / token_latency   : 回复 token 数与逐 token 间隔
+    first_token_delay            : 首 token 前的固定延迟
+    slow_rate / slow_delay       : 按比例让部分请求的首 token 额外延迟（模拟长尾，用于观察对冲效果）
+    fail_first / error_rate      : 前 N 个请求 / 按比例返回 error_status
+    hang_rate                    : 按比例在首 token 前挂起（模拟上游无响应）
+    drop_after                   : 输出该数量的 token 后断开连接（模拟流中断），0 关闭
+用法: python -m modules.benchmark.openai_stub --port 8900 --token_latency 0.02
+"""
+
+
+DEFAULT_BEHAVIOUR = {
+    "num_tokens": 32,
+    "token_latency": 0.01,
+    "first_token_delay": 0.05,
+    "slow_rate": 0.0,
+    "slow_delay": 2.0,
+    "fail_first": 0,
+    "error_rate": 0.0,
+    "error_status": 503,
+    "hang_rate": 0.0,
+    "drop_after": 0,
+    "seed": 0,
+}
+
+
+class StubState:
+    def __init__(self, **behaviour):
+        self.behaviour = dict(DEFAULT_BEHAVIOUR)
+        self.configure(**behaviour)
+
+    def configure(self, **behaviour):
+        self.behaviour.update({k: v for k, v in behaviour.items() if k in DEFAULT_BEHAVIOUR})
+        self.random = random.Random(self.behaviour["seed"])
+        self.counter = itertools.count()
+        self.requests = 0
+        self.cancelled = 0
+
+    def plan(self):
+        """ 决定本次请求的行为: ok / error / hang，以及首 token 延迟 """
+        b = self.behaviour
+        index = next(self.counter)
+        self.requests += 1
+        roll = self.random.random()
+        if index < b["fail_first"] or roll < b["error_rate"]:
+            return "error", 0.0
+        if self.random.random() < b["hang_rate"]:
+            return "hang", 0.0
+        delay = b["first_token_delay"]
+        if self.random.random() < b["slow_rate"]:
+            delay += b["slow_delay"]
+        return "ok", delay
+
+
+def chunk_payload(completion_id, model, content=None, role=None, finish_reason=None):
+    delta = {}
+    if role:
+        delta["role"] = role
+    if content is not None:
+        delta["content"] = content
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def create_app(state):
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, StreamingResponse
+
+    app = FastAPI()
+
+    @app.post("/stub/config")
+    async def configure(request: Request):
+        state.configure(**(await request.json()))
+        return state.behaviour
+
+    @app.get("/stub/stats")
+    async def stats():
+        return {"requests": state.requests, "cancelled": state.cancelled}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        model = body.get("model", "stub")
+        b = state.behaviour
+        outcome, delay = state.plan()
+
+        if outcome == "error":
+            return JSONResponse(
+                status_code=b["error_status"],
+                content={"error": {"message": "stub upstream error", "type": "server_error"}}
+            )
+        if outcome == "hang":
+            # 挂起直到客户端断开
+            while not await request.is_disconnected():
+                await asyncio.sleep(0.1)
+            state.cancelled += 1
+            return JSONResponse(status_code=499, content={})
+
+        question = body["messages"][-1]["content"]
+        seed = sum(ord(c) for c in question)
+        tokens = [f"tok{(seed + i) % 1000} " for i in range(b["num_tokens"])]
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+
+        if not body.get("stream"):
+            await asyncio.sleep(delay + b["token_latency"] * len(tokens))
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)},
+            }
+
+        async def events():
+            try:
+                yield f"data: {json.dumps(chunk_payload(completion_id, model, role='assistant'))}\n\n"
+                await asyncio.sleep(delay)
+                for i, token in enumerate(tokens):
+                    if b["drop_after"] and i >= b["drop_after"]:
+                        # 流中途断开：不发送结束标记直接抛错，连接被服务端中止
+                        raise ConnectionResetError("stub dropped stream")
+                    yield f"data: {json.dumps(chunk_payload(completion_id, model, content=token))}\n\n"
+                    await asyncio.sleep(b["token_latency"])
+                yield f"data: {json.dumps(chunk_payload(completion_id, model, finish_reason='stop'))}\n\n"
+                yield "data: [DONE]\n\n"
+            except asyncio.CancelledError:
+                state.cancelled += 1
+                raise
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+class AppServer:
+    """ 在后台线程中用 uvicorn 运行 ASGI 应用，with 语句内可用 """
+    def __init__(self, app, host="127.0.0.1", port=8900):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.server = None
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+        import uvicorn
+        config = uvicorn.Config(self.app, host=self.host, port=self.port, log_level="critical")
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.thread.start()
+        deadline = time.time() + 10
+        while not self.server.started:
+            if time.time() > deadline or not self.thread.is_alive():
+                raise RuntimeError("服务启动失败")
+            time.sleep(0.05)
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.should_exit = True
+            self.thread.join(timeout=5)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class StubServer(AppServer):
+    """ 在后台线程中运行桩服务 """
+    def __init__(self, host="127.0.0.1", port=8900, **behaviour):
+        self.state = StubState(**behaviour)
+        super().__init__(create_app(self.state), host, port)
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/v1"
+
+    def configure(self, **behaviour):
+        self.state.configure(**behaviour)
+
+
+def cli_default_args():
+    parser = argparse.ArgumentParser(description="OpenAI 兼容桩服务")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    for name, value in DEFAULT_BEHAVIOUR.items():
+        parser.add_argument(f"--{name}", type=type(value), default=value)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import uvicorn
+    args = cli_default_args()
+    behaviour = {name: getattr(args, name) for name in DEFAULT_BEHAVIOUR}
+    uvicorn.run(create_app(StubState(**behaviour)), host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,160 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from modules.benchmark.async_concurrency import summarize
+from modules.benchmark.fake_engine import FakeEngine
+
+
+"""
+自动路由测试：用假引擎替换 local / openai，按 engine_type=auto 发起请求，观察路由分布、切换次数与延迟
+    - latency    : 本地慢、在线快，路由应逐渐偏向在线引擎
+    - saturation : 本地准入上限很小，排队已满时切换到在线引擎
+    - failover   : 在线引擎持续报错，首 token 前失败切换到本地，随后在线引擎被标记为不健康
+用法: python -m modules.benchmark.routing --requests 40 --policy latency
+"""
+
+
+class FlakyEngine(FakeEngine):
+    """ 按比例在首 token 前返回错误信息的假引擎 """
+    def __init__(self, error_rate=0.0, seed=0, **kwargs):
+        super().__init__(**kwargs)
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+    async def astream(self, user_query, history=None, sys_prompt=None, session_id=None, cancel_token=None):
+        if self.random.random() < self.error_rate:
+            await asyncio.sleep(self.prefill_latency)
+            yield f"❌ {self.name} 引擎调用失败: 模拟上游错误"
+            return
+        async for token in super().astream(user_query, history, sys_prompt, session_id, cancel_token):
+            yield token
+
+
+def reset_manager(policy, local, openai, local_max_in_flight=8, local_max_queued=32):
+    """ 用假引擎与新的统计重置全局引擎管理器 """
+    from modules.engine.admission import AdmissionController
+    from modules.engine.engine_factory import engine_manager, ENGINE_KEYS
+    from modules.engine.router import EngineHealth, EngineRouter, build_policy
+
+    engine_manager.local_engine = local
+    engine_manager.openai_engine = openai
+    engine_manager._wrapped_engines = {}
+    engine_manager.response_cache = None
+    engine_manager.admission = {
+        "local": AdmissionController("local", max_in_flight=local_max_in_flight, max_queued=local_max_queued)
+    }
+    engine_manager.health = {key: EngineHealth(key) for key in ENGINE_KEYS}
+    engine_manager.router = EngineRouter(engine_manager, build_policy(policy), ["local", "openai"])
+    return engine_manager
+
+
+async def one_request(manager, i):
+    from modules.engine.admission import QueueFullError
+    start = time.perf_counter()
+    try:
+        decision = await manager.router.acquire("auto", "batch")
+    except QueueFullError:
+        return {"served_by": "rejected", "ttft": None, "elapsed": time.perf_counter() - start, "ok": False}
+
+    first_token = None
+    text = ""
+    try:
+        if decision.ticket is not None:
+            await decision.ticket.wait()
+        async for token in manager.router.astream(decision, f"routing question {i}", [], "", priority="batch"):
+            if first_token is None:
+                first_token = time.perf_counter() - start
+            text += token
+    finally:
+        decision.release()
+    return {
+        "served_by": decision.served_by,
+        "failovers": decision.failovers,
+        "ttft": first_token,
+        "elapsed": time.perf_counter() - start,
+        "ok": not text.startswith("❌"),
+    }
+
+
+async def run_scenario(name, manager, num_requests, concurrency, interval=0.0):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(i):
+        async with semaphore:
+            result = await one_request(manager, i)
+            await asyncio.sleep(interval)
+            return result
+
+    results = await asyncio.gather(*[limited(i) for i in range(num_requests)])
+    served = {}
+    for r in results:
+        served[r["served_by"]] = served.get(r["served_by"], 0) + 1
+    stats = manager.router.stats()
+    return {
+        "scenario": name,
+        "requests": num_requests,
+        "succeeded": sum(r["ok"] for r in results),
+        "served_by": served,
+        "served_by_last_10": [r["served_by"] for r in results[-10:]],
+        "failovers": stats["failovers"],
+        "ttft": summarize([r["ttft"] for r in results if r["ttft"] is not None]),
+        "elapsed": summarize([r["elapsed"] for r in results]),
+        "ranking": stats["ranking"],
+        "health": stats["health"],
+    }
+
+
+async def run(args):
+    reports = []
+
+    manager = reset_manager(
+        args.policy,
+        local=FakeEngine(num_tokens=args.tokens, token_latency=0.02, prefill_latency=0.2, name="local"),
+        openai=FakeEngine(num_tokens=args.tokens, token_latency=0.005, prefill_latency=0.05, name="openai"),
+    )
+    reports.append(await run_scenario("latency", manager, args.requests, 1))
+
+    manager = reset_manager(
+        args.policy,
+        local=FakeEngine(num_tokens=args.tokens, token_latency=0.005, name="local"),
+        openai=FakeEngine(num_tokens=args.tokens, token_latency=0.01, prefill_latency=0.05, name="openai"),
+        local_max_in_flight=2,
+        local_max_queued=1
+    )
+    reports.append(await run_scenario("saturation", manager, args.requests, args.concurrency))
+
+    manager = reset_manager(
+        args.policy,
+        local=FakeEngine(num_tokens=args.tokens, token_latency=0.01, name="local"),
+        openai=FlakyEngine(error_rate=1.0, num_tokens=args.tokens, token_latency=0.002, prefill_latency=0.01, name="openai"),
+    )
+    # 在线引擎优先，观察首 token 前失败的切换
+    manager.router.engines = ["openai", "local"]
+    reports.append(await run_scenario("failover", manager, args.requests, 1))
+    return reports
+
+
+def cli_default_args():
+    parser = argparse.ArgumentParser(description="自动路由（engine_type=auto）假引擎测试")
+    parser.add_argument("--policy", type=str, default="latency", help="latency / priority")
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--tokens", type=int, default=32)
+    parser.add_argument("--output", type=str, default="", help="结果另存为 JSON 文件")
+    return parser.parse_args()
+
+
+def main():
+    args = cli_default_args()
+    reports = asyncio.run(run(args))
+    print(json.dumps(reports, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+"""
+启动耗时基准：在独立子进程中测量冷启动
+    - lazy  : 新路径，服务立即可用，ENGINE_WARMUP 中的引擎在后台预热，其余首次使用时加载
+    - eager : 旧路径，启动时 init_all 同步加载全部引擎后才开始服务
+每个场景记录：导入耗时、可接收请求的时间、/api/ready 就绪时间，以及是否导入了 torch / transformers
+用法: python -m modules.benchmark.startup --scenarios lazy,eager --warmup openai
+"""
+
+
+HEAVY_MODULES = ["torch", "transformers"]
+
+
+async def child_main(scenario, timeout):
+    start = time.perf_counter()
+    from fastapi import FastAPI
+    from modules.api.api import router
+    from modules.engine.engine_factory import engine_manager
+    app = FastAPI()
+    app.include_router(router, prefix="/api")
+    import_s = time.perf_counter() - start
+
+    if scenario == "eager":
+        await engine_manager.init_all()
+    else:
+        engine_manager.start_warmup()
+    serving_s = time.perf_counter() - start
+
+    # 与 /api/ready 相同的判定，轮询直到预热引擎全部就绪或失败
+    readiness = engine_manager.readiness()
+    while not readiness["ready"] and time.perf_counter() - start < timeout:
+        if all(engine["state"] == "failed" for engine in readiness["engines"].values() if engine["warmup"]):
+            break
+        await asyncio.sleep(0.01)
+        readiness = engine_manager.readiness()
+    ready_s = time.perf_counter() - start
+
+    return {
+        "scenario": scenario,
+        "import_s": round(import_s, 3),
+        "serving_s": round(serving_s, 3),
+        "ready_s": round(ready_s, 3),
+        "ready": readiness["ready"],
+        "engines": readiness["engines"],
+        "heavy_modules": [name for name in HEAVY_MODULES if name in sys.modules],
+    }
+
+
+def run_scenario(scenario, warmup, timeout):
+    env = dict(os.environ)
+    env["ENGINE_WARMUP"] = warmup if scenario == "lazy" else "openai,local"
+    # 构造客户端不发起网络请求，缺省时填充占位 key 以便测量
+    env.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-m", "modules.benchmark.startup", "--child", scenario, "--timeout", str(timeout)],
+        env=env,
+        capture_output=True,
+        text=True
+    )
+    wall_s = time.perf_counter() - start
+
+    lines = [line for line in output.stdout.splitlines() if line.startswith("{")]
+    if output.returncode != 0 or not lines:
+        return {"scenario": scenario, "error": output.stderr.strip().splitlines()[-1:] or output.stdout}
+    result = json.loads(lines[-1])
+    # 含解释器启动时间的进程总耗时
+    result["process_wall_s"] = round(wall_s, 3)
+    return result
+
+
+def cli_default_args():
+    parser = argparse.ArgumentParser(description="启动耗时基准")
+    parser.add_argument("--scenarios", type=str, default="lazy,eager")
+    parser.add_argument("--warmup", type=str, default="openai", help="lazy 场景后台预热的引擎")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--child", type=str, default="", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = cli_default_args()
+    if args.child:
+        print(json.dumps(asyncio.run(child_main(args.child, args.timeout)), ensure_ascii=False))
+        return
+
+    results = [
+        run_scenario(scenario, args.warmup, args.timeout)
+        for scenario in args.scenarios.split(",")
+    ]
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
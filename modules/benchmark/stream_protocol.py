@@ -0,0 +1,75 @@
+import argparse
+import json
+import time
+
+from modules.api.stream_protocol import build_stream_encoder
+
+
+"""
+流式协议基准：对比 legacy / delta / sse 三种格式下单次响应的传输字节数与编码 CPU 耗时
+用法: python -m modules.benchmark.stream_protocol --tokens 1000 --history_turns 10
+"""
+
+
+def build_parameters(history_turns, message_chars):
+    """ 模拟 event.model_dump()：history 越长，legacy 格式每个 chunk 重复发送的负担越重 """
+    history = []
+    for i in range(history_turns):
+        history.append({"timestamp": "", "role": "user", "content": "我们需要实现一个类似抖音的短视频信息流。" * (message_chars // 20 + 1)})
+        history.append({"timestamp": "", "role": "assistant", "content": "业务场景定性：高并发信息流推荐。" * (message_chars // 16 + 1)})
+    return {
+        "engine_type": "local",
+        "role": "to_dev",
+        "user_question": "如何做一个电商类的推荐系统项目。",
+        "stream": True,
+        "history": history,
+        "session_id": "",
+        "stream_format": "",
+    }
+
+
+def build_tokens(num_tokens):
+    text = "技术实现路径：推荐使用 Flink 实时计算用户行为特征，召回层采用双塔模型，排序层使用 DeepFM。"
+    return [text[i % len(text)] for i in range(num_tokens)]
+
+
+def run_format(stream_format, tokens, parameters):
+    encoder = build_stream_encoder(stream_format)
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+
+    total_bytes = len(encoder.start(parameters).encode("utf-8"))
+    events = 1
+    for index, token in enumerate(tokens, start=1):
+        total_bytes += len(encoder.chunk(token, index).encode("utf-8"))
+        events += 1
+    total_bytes += len(encoder.end(len(tokens)).encode("utf-8"))
+    events += 1
+
+    return {
+        "format": stream_format,
+        "events": events,
+        "bytes": total_bytes,
+        "cpu_ms": round((time.process_time() - cpu_start) * 1000, 2),
+        "wall_ms": round((time.perf_counter() - wall_start) * 1000, 2),
+    }
+
+
+def cli_default_args():
+    parser = argparse.ArgumentParser(description="流式协议字节数 / CPU 基准")
+    parser.add_argument("--tokens", type=int, default=1000, help="单次响应的 token 数")
+    parser.add_argument("--history_turns", type=int, default=10, help="请求携带的历史轮数")
+    parser.add_argument("--message_chars", type=int, default=200, help="每条历史消息的大致字数")
+    return parser.parse_args()
+
+
+def main(args):
+    tokens = build_tokens(args.tokens)
+    parameters = build_parameters(args.history_turns, args.message_chars)
+    results = [run_format(fmt, tokens, parameters) for fmt in ["legacy", "delta", "sse"]]
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    return results
+
+
+if __name__ == "__main__":
+    main(cli_default_args())
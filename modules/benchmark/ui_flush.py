@@ -0,0 +1,118 @@
+import argparse
+import asyncio
+import json
+import time
+
+from modules.benchmark.async_concurrency import percentile
+from modules.benchmark.fake_engine import FakeEngine
+from modules.webui.token_flusher import TokenFlusher
+
+
+"""
+界面流式输出对比：逐 token 写出 + 固定 sleep（旧实现） vs 按时间窗口 / 字节数合并写出（TokenFlusher）
+用模拟的 websocket 写出（每帧固定开销 + 按字节的传输耗时）统计端到端耗时、首 token 延迟与写出帧数，
+同时与界面并发的多个会话共享一个事件循环，观察写出对引擎消费的影响。
+用法: python -m modules.benchmark.ui_flush --tokens 1000 --sessions 4
+"""
+
+
+class FakeSocket:
+    """ 模拟 websocket：每帧固定开销 + 按字节耗时，记录帧数与字节数 """
+    def __init__(self, frame_overhead=0.0005, per_kb=0.0001):
+        self.frame_overhead = frame_overhead
+        self.per_kb = per_kb
+        self.frames = 0
+        self.bytes = 0
+        self.first_frame_at = None
+
+    async def send(self, text):
+        size = len(text.encode("utf-8"))
+        await asyncio.sleep(self.frame_overhead + self.per_kb * size / 1024)
+        if self.first_frame_at is None:
+            self.first_frame_at = time.perf_counter()
+        self.frames += 1
+        self.bytes += size
+
+
+async def legacy_session(engine, socket, question, sleep_time):
+    """ 旧实现：每个 token 单独写出并 sleep """
+    async for token in engine.astream(question):
+        if token:
+            await socket.send(token)
+            await asyncio.sleep(sleep_time)
+
+
+async def flushed_session(engine, socket, question, interval, max_bytes):
+    flusher = TokenFlusher(socket.send, interval=interval, max_bytes=max_bytes).start()
+    try:
+        async for token in engine.astream(question):
+            if token:
+                flusher.push(token)
+        await flusher.aclose()
+    finally:
+        flusher.abort()
+
+
+async def run_mode(mode, args, token_latency):
+    engine = FakeEngine(num_tokens=args.tokens, token_latency=token_latency, prefill_latency=args.prefill_latency)
+    sockets = [FakeSocket(args.frame_overhead, args.per_kb) for _ in range(args.sessions)]
+
+    async def one(i):
+        start = time.perf_counter()
+        if mode == "legacy":
+            await legacy_session(engine, sockets[i], f"question {i}", args.sleep_time)
+        else:
+            await flushed_session(engine, sockets[i], f"question {i}", args.interval, args.max_bytes)
+        return start, time.perf_counter()
+
+    results = await asyncio.gather(*[one(i) for i in range(args.sessions)])
+    e2e = [end - start for start, end in results]
+    first = [s.first_frame_at - start for s, (start, _) in zip(sockets, results) if s.first_frame_at is not None]
+    return {
+        "mode": mode,
+        "token_latency": token_latency,
+        "sessions": args.sessions,
+        "tokens_per_session": args.tokens,
+        "e2e_p50_s": round(percentile(e2e, 0.5), 3),
+        "e2e_max_s": round(max(e2e), 3),
+        "first_frame_p50_ms": round(percentile(first, 0.5) * 1000, 2) if first else None,
+        "frames_per_session": sum(s.frames for s in sockets) / args.sessions,
+        "avg_frame_bytes": round(sum(s.bytes for s in sockets) / max(sum(s.frames for s in sockets), 1), 1),
+    }
+
+
+async def run(args):
+    reports = []
+    # 0: 回复缓存回放 / 已生成完的文本；其余为本地 / 在线引擎的典型逐 token 耗时
+    for token_latency in [float(x) for x in args.token_latencies.split(",")]:
+        for mode in ("legacy", "flushed"):
+            reports.append(await run_mode(mode, args, token_latency))
+    return reports
+
+
+def cli_default_args():
+    parser = argparse.ArgumentParser(description="界面流式输出合并写出对比")
+    parser.add_argument("--tokens", type=int, default=1000)
+    parser.add_argument("--sessions", type=int, default=4, help="同时进行的会话数")
+    parser.add_argument("--token_latencies", type=str, default="0,0.005,0.02", help="引擎逐 token 耗时(秒)，逗号分隔")
+    parser.add_argument("--prefill_latency", type=float, default=0.05)
+    parser.add_argument("--sleep_time", type=float, default=0.005, help="旧实现每个 token 后的 sleep（本地 0.005 / 在线 0.01）")
+    parser.add_argument("--interval", type=float, default=0.05, help="合并窗口(秒)")
+    parser.add_argument("--max_bytes", type=int, default=1024, help="缓冲达到该字节数时立即写出")
+    parser.add_argument("--frame_overhead", type=float, default=0.0005, help="模拟每帧写出开销(秒)")
+    parser.add_argument("--per_kb", type=float, default=0.0001, help="模拟每 KB 传输耗时(秒)")
+    parser.add_argument("--output", type=str, default="", help="结果另存为 JSON 文件")
+    return parser.parse_args()
+
+
+def main():
+    args = cli_default_args()
+    reports = asyncio.run(run(args))
+    print(json.dumps(reports, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
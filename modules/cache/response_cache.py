@@ -0,0 +1,363 @@
+import asyncio
+import hashlib
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+
+from modules.utils.cancellation import CancellationToken
+
+
+"""
+回复缓存：在 engine.agenerate / astream 之前拦截重复问题
+    - 精确命中：按 (引擎, 模型, 角色提示词哈希, 归一化历史, 归一化问题, 采样参数) 计算键
+    - 近似命中（可选）：同一作用域（除问题外其余均相同）内，问题向量余弦相似度超过阈值
+    - 两级存储：内存 LRU + SQLite 磁盘，均带 TTL
+    - 命中后按真实 token 节奏回放为流式输出
+"""
+
+
+def normalize_text(text):
+    """ 全半角统一、去除首尾与多余空白 """
+    text = unicodedata.normalize("NFKC", text or "")
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def _digest(payload):
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def engine_identity(engine):
+    """ 引擎所用模型及采样参数，参与缓存键计算 """
+    model = getattr(engine, "base_model_path", None) or getattr(engine, "model", None)
+    if not isinstance(model, str):
+        model = type(engine).__name__
+    sampling = {
+        name: getattr(engine, name)
+        for name in ["temperature", "top_p", "max_new_tokens", "repetition_penalty"]
+        if isinstance(getattr(engine, name, None), (int, float))
+    }
+    return model, sampling
+
+
+class CacheKey:
+    """ exact 为精确键，scope 为除问题以外的上下文键（近似查找只在同一 scope 内进行） """
+    def __init__(self, engine_type, model, sys_prompt, history, question, sampling):
+        self.question = normalize_text(question)
+        self.scope = _digest({
+            "engine": engine_type,
+            "model": model,
+            "prompt": hashlib.sha256((sys_prompt or "").encode("utf-8")).hexdigest(),
+            "history": [
+                [h.get("role"), normalize_text(h.get("content"))]
+                for h in (history or [])
+            ],
+            "sampling": sampling,
+        })
+        self.exact = _digest({"scope": self.scope, "question": self.question})
+
+
+class CacheEntry:
+    def __init__(self, answer, chunks=None, created_at=None, scope="", question=""):
+        self.answer = answer
+        # 原始流式 chunk 边界，回放时按此切分；非流式写入时为空
+        self.chunks = chunks or []
+        self.created_at = created_at or time.time()
+        self.scope = scope
+        self.question = question
+
+    @property
+    def token_count(self):
+        return len(self.chunks) if self.chunks else max(1, len(self.answer) // 2)
+
+
+class HashingEmbedder:
+    """ 轻量问题向量：字符 1/2-gram 哈希到固定维度并 L2 归一化，无额外依赖 """
+    def __init__(self, dim=1024):
+        self.dim = dim
+
+    def __call__(self, text):
+        vector = {}
+        grams = list(text) + [text[i:i + 2] for i in range(len(text) - 1)]
+        for gram in grams:
+            index = zlib.crc32(gram.encode("utf-8")) % self.dim
+            vector[index] = vector.get(index, 0.0) + 1.0
+        norm = math.sqrt(sum(v * v for v in vector.values())) or 1.0
+        return {k: v / norm for k, v in vector.items()}
+
+
+def cosine(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(k, 0.0) for k, v in a.items())
+
+
+class SqliteCacheTier:
+    """ 磁盘缓存层 """
+    def __init__(self, db_path, max_entries=100000):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            " key TEXT PRIMARY KEY, scope TEXT, question TEXT, answer TEXT, chunks TEXT,"
+            " embedding TEXT, created_at REAL, accessed_at REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_accessed ON response_cache(accessed_at)")
+        self._conn.commit()
+
+    def get(self, key, ttl):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT answer, chunks, created_at, scope, question FROM response_cache WHERE key = ?",
+                (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if ttl and time.time() - row[2] > ttl:
+                self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE response_cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+        return CacheEntry(row[0], json.loads(row[1] or "[]"), row[2], row[3], row[4])
+
+    def put(self, key, entry: CacheEntry, embedding=None):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key, entry.scope, entry.question, entry.answer,
+                    json.dumps(entry.chunks, ensure_ascii=False),
+                    json.dumps(embedding) if embedding is not None else None,
+                    entry.created_at, now
+                )
+            )
+            # 超出容量时按最近访问时间淘汰
+            self._conn.execute(
+                "DELETE FROM response_cache WHERE key IN ("
+                " SELECT key FROM response_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._conn.commit()
+
+    def load_embeddings(self, ttl):
+        """ 启动时重建近似查找索引 """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, scope, embedding, created_at FROM response_cache WHERE embedding IS NOT NULL"
+            ).fetchall()
+        now = time.time()
+        return [
+            (key, scope, {int(k): v for k, v in json.loads(embedding).items()})
+            for key, scope, embedding, created_at in rows
+            if not ttl or now - created_at <= ttl
+        ]
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM response_cache")
+            self._conn.commit()
+
+
+class ResponseCache:
+    """
+    内存 LRU + 可选 SQLite 的回复缓存，支持近似问题查找与命中统计
+    """
+    def __init__(
+            self,
+            max_entries=1024,
+            ttl=24 * 3600,
+            db_path="",
+            semantic=False,
+            semantic_threshold=0.92,
+            embedder=None
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.disk = SqliteCacheTier(db_path) if db_path else None
+
+        self.semantic = semantic
+        self.semantic_threshold = semantic_threshold
+        self.embedder = embedder or HashingEmbedder()
+        # scope -> {exact_key: embedding}
+        self._semantic_index = {}
+        if self.semantic and self.disk is not None:
+            for key, scope, embedding in self.disk.load_embeddings(self.ttl):
+                self._semantic_index.setdefault(scope, {})[key] = embedding
+
+        # 统计
+        self.hits = {"memory": 0, "disk": 0, "semantic": 0}
+        self.misses = 0
+        self.saved_tokens = 0
+
+    def make_key(self, engine_type, engine, sys_prompt, history, question):
+        model, sampling = engine_identity(engine)
+        return CacheKey(engine_type, model, sys_prompt, history, question, sampling)
+
+    def _expired(self, entry):
+        return self.ttl and time.time() - entry.created_at > self.ttl
+
+    def _get_exact(self, exact_key):
+        """ 返回 (entry, 命中层) """
+        with self._lock:
+            entry = self._memory.get(exact_key)
+            if entry is not None:
+                if self._expired(entry):
+                    del self._memory[exact_key]
+                else:
+                    self._memory.move_to_end(exact_key)
+                    return entry, "memory"
+
+        if self.disk is not None:
+            entry = self.disk.get(exact_key, self.ttl)
+            if entry is not None:
+                self._put_memory(exact_key, entry)
+                return entry, "disk"
+        return None, None
+
+    def get(self, key: CacheKey):
+        entry, tier = self._get_exact(key.exact)
+
+        if entry is None and self.semantic:
+            candidates = self._semantic_index.get(key.scope, {})
+            if candidates:
+                query = self.embedder(key.question)
+                best_key, best_score = None, 0.0
+                for candidate_key, embedding in candidates.items():
+                    score = cosine(query, embedding)
+                    if score > best_score:
+                        best_key, best_score = candidate_key, score
+                if best_key is not None and best_score >= self.semantic_threshold:
+                    entry, _ = self._get_exact(best_key)
+                    tier = "semantic" if entry is not None else None
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits[tier] += 1
+                self.saved_tokens += entry.token_count
+        return entry
+
+    def _put_memory(self, exact_key, entry):
+        with self._lock:
+            self._memory[exact_key] = entry
+            self._memory.move_to_end(exact_key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def put(self, key: CacheKey, answer, chunks=None):
+        entry = CacheEntry(answer, chunks, scope=key.scope, question=key.question)
+        self._put_memory(key.exact, entry)
+
+        embedding = None
+        if self.semantic:
+            embedding = self.embedder(key.question)
+            with self._lock:
+                self._semantic_index.setdefault(key.scope, {})[key.exact] = embedding
+
+        if self.disk is not None:
+            self.disk.put(key.exact, entry, embedding)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._semantic_index.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self):
+        with self._lock:
+            total_hits = sum(self.hits.values())
+            lookups = total_hits + self.misses
+            return {
+                "entries": len(self._memory),
+                "hits": dict(self.hits),
+                "misses": self.misses,
+                "hit_ratio": total_hits / lookups if lookups else 0.0,
+                "saved_tokens": self.saved_tokens,
+            }
+
+
+async def replay_entry(entry: CacheEntry, token_interval=0.005, chunk_chars=2, cancel_token=None):
+    """ 按原始 chunk 边界（或固定字数）回放缓存回复，模拟真实的流式输出节奏 """
+    chunks = entry.chunks or [
+        entry.answer[i:i + chunk_chars]
+        for i in range(0, len(entry.answer), chunk_chars)
+    ]
+    for chunk in chunks:
+        if cancel_token is not None and cancel_token.cancelled:
+            return
+        yield chunk
+        await asyncio.sleep(token_interval)
+
+
+def is_cacheable(answer, chunks=()):
+    """ 空回复与引擎错误信息不缓存；流式生成中途出错时 ❌ 错误信息是其中一个 chunk """
+    return bool(answer) and not answer.startswith("❌") and not any(chunk.startswith("❌") for chunk in chunks)
+
+
+class ResponseCachedEngine:
+    """
+    回复缓存包装：接口与被包装引擎一致（agenerate / astream），其余属性透传
+    """
+    def __init__(self, engine, cache: ResponseCache, engine_type, replay_interval=0.005):
+        self.engine = engine
+        self.cache = cache
+        self.engine_type = engine_type
+        self.replay_interval = replay_interval
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    async def agenerate(self, user_query, history=None, sys_prompt=None, **kwargs):
+        key = self.cache.make_key(self.engine_type, self.engine, sys_prompt, history, user_query)
+        entry = await asyncio.to_thread(self.cache.get, key)
+        if entry is not None:
+            return entry.answer
+
+        answer = await self.engine.agenerate(user_query, history, sys_prompt, **kwargs)
+
+        cancel_token = kwargs.get("cancel_token")
+        if is_cacheable(answer) and not (cancel_token and cancel_token.cancelled):
+            await asyncio.to_thread(self.cache.put, key, answer)
+        return answer
+
+    async def astream(self, user_query, history=None, sys_prompt=None, **kwargs):
+        key = self.cache.make_key(self.engine_type, self.engine, sys_prompt, history, user_query)
+        entry = await asyncio.to_thread(self.cache.get, key)
+        if entry is not None:
+            async for chunk in replay_entry(entry, self.replay_interval, cancel_token=kwargs.get("cancel_token")):
+                yield chunk
+            return
+
+        cancel_token = kwargs.setdefault("cancel_token", CancellationToken())
+        chunks = []
+        stream = self.engine.astream(user_query, history, sys_prompt, **kwargs)
+        try:
+            async for token in stream:
+                chunks.append(token)
+                yield token
+        finally:
+            await stream.aclose()
+
+        answer = "".join(chunks)
+        if is_cacheable(answer, chunks) and not cancel_token.cancelled:
+            await asyncio.to_thread(self.cache.put, key, answer, chunks)
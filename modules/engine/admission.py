@@ -0,0 +1,190 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+
+
+
+PRIORITY_MAP = {
+    "interactive": 0,       # UI 交互请求优先
+    "batch": 10,            # API 批量请求
+}
+
+
+class QueueFullError(Exception):
+    """ 准入队列已满，调用方应返回 429 并带上 Retry-After """
+    def __init__(self, engine, retry_after, queued):
+        self.engine = engine
+        self.retry_after = retry_after
+        self.queued = queued
+        super().__init__(f"{engine} 引擎排队已满（{queued} 个请求排队中），请 {retry_after} 秒后重试")
+
+
+class AdmissionTicket:
+    """ 单个请求的准入凭证：排队 -> 准入 -> 释放 """
+    def __init__(self, controller, priority, seq):
+        self.controller = controller
+        self.priority = priority
+        self.seq = seq
+        self.enqueue_time = time.time()
+        self.admit_time = None
+        self.release_time = None
+        self.cancelled = False
+        self._admitted = asyncio.Event()
+        self._changed = asyncio.Event()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    @property
+    def admitted(self):
+        return self._admitted.is_set()
+
+    @property
+    def position(self):
+        """ 排队位置，0 表示已准入 """
+        if self.admitted:
+            return 0
+        return self.controller.position(self)
+
+    @property
+    def queue_wait_time(self):
+        end = self.admit_time or time.time()
+        return end - self.enqueue_time
+
+    @property
+    def service_time(self):
+        if self.admit_time is None:
+            return 0.0
+        return (self.release_time or time.time()) - self.admit_time
+
+    async def wait(self):
+        await self._admitted.wait()
+
+    async def positions(self, interval=1.0):
+        """ 逐次产出排队位置，直到被准入 """
+        while not self.admitted:
+            yield self.position
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self):
+        """ 生成结束 / 客户端放弃排队时调用，可重复调用 """
+        if self.release_time is not None:
+            return
+        self.release_time = time.time()
+        if self.admitted:
+            self.controller.on_release(self)
+        else:
+            self.cancelled = True
+            self.controller.on_cancel(self)
+
+
+class AdmissionController:
+    """
+    有界准入队列：
+    限制同时生成的请求数（max_in_flight），其余按优先级排队（数字越小越优先，同优先级先到先得），
+    排队数超过 max_queued 时立即拒绝，由调用方快速返回 429 + Retry-After
+    """
+    def __init__(
+            self,
+            engine,
+            max_in_flight=8,
+            max_queued=32,
+            initial_service_time=10.0
+    ):
+        self.engine = engine
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queued = max(0, max_queued)
+
+        self.in_flight = 0
+        self._queue = []
+        self._seq = itertools.count()
+
+        # 统计（EMA 平滑），排队时间与生成时间分开统计
+        self.avg_service_time = initial_service_time
+        self.avg_queue_wait = 0.0
+        self.admitted_total = 0
+        self.rejected_total = 0
+        self.cancelled_total = 0
+
+    @property
+    def queued(self):
+        return sum(1 for ticket in self._queue if not ticket.cancelled)
+
+    def submit(self, priority="batch"):
+        """ 提交请求；队列已满时抛出 QueueFullError """
+        priority = PRIORITY_MAP.get(priority, priority) if isinstance(priority, str) else priority
+        if not isinstance(priority, int):
+            priority = PRIORITY_MAP["batch"]
+
+        ticket = AdmissionTicket(self, priority, next(self._seq))
+
+        if self.in_flight < self.max_in_flight and not self.queued:
+            self._admit(ticket)
+            return ticket
+
+        if self.queued >= self.max_queued:
+            self.rejected_total += 1
+            raise QueueFullError(self.engine, self.retry_after(), self.queued)
+
+        heapq.heappush(self._queue, ticket)
+        self._notify_all()
+        return ticket
+
+    def retry_after(self):
+        """ 按平均生成时间估算队列腾空所需秒数 """
+        waves = (self.queued + 1) / self.max_in_flight
+        return max(1, int(math.ceil(waves * self.avg_service_time)))
+
+    def position(self, ticket):
+        return 1 + sum(1 for other in self._queue if not other.cancelled and other < ticket)
+
+    def on_release(self, ticket):
+        self.in_flight -= 1
+        self.avg_service_time = 0.8 * self.avg_service_time + 0.2 * ticket.service_time
+        self._dispatch()
+
+    def on_cancel(self, ticket):
+        self.cancelled_total += 1
+        self._queue = [other for other in self._queue if other is not ticket]
+        heapq.heapify(self._queue)
+        self._notify_all()
+
+    def _admit(self, ticket):
+        ticket.admit_time = time.time()
+        self.in_flight += 1
+        self.admitted_total += 1
+        self.avg_queue_wait = 0.8 * self.avg_queue_wait + 0.2 * ticket.queue_wait_time
+        ticket._admitted.set()
+        ticket._changed.set()
+
+    def _dispatch(self):
+        while self._queue and self.in_flight < self.max_in_flight:
+            ticket = heapq.heappop(self._queue)
+            if ticket.cancelled:
+                continue
+            self._admit(ticket)
+        self._notify_all()
+
+    def _notify_all(self):
+        for ticket in self._queue:
+            ticket._changed.set()
+
+    def stats(self):
+        return {
+            "engine": self.engine,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_in_flight": self.max_in_flight,
+            "max_queued": self.max_queued,
+            "avg_queue_wait": round(self.avg_queue_wait, 4),
+            "avg_service_time": round(self.avg_service_time, 4),
+            "admitted_total": self.admitted_total,
+            "rejected_total": self.rejected_total,
+            "cancelled_total": self.cancelled_total,
+        }
@@ -0,0 +1,140 @@
+import asyncio
+
+from modules.engine.admission import QueueFullError
+from modules.utils.async_tool import merge_async_iterables
+
+
+"""
+双视角生成：同一问题同时按两个角色生成，两路 token 交错产出 (role, token)
+    - 每个角色各自路由、各自占用一个准入名额；每一路在自己的名额准入后立即开始，生成结束即释放名额，
+      不会持有一个名额等待另一个（max_in_flight=1 或多个双视角请求并发时不会互相等待而死锁）
+    - 名额充足时两路同时准入：本地引擎的两个序列进入连续批处理调度器的同一 batch 一起解码，在线引擎为两路并发的流式请求；
+      名额不足时退化为先后生成
+    - 两个序列的历史与问题相同、只有系统提示词不同，各自复用已缓存的系统提示词前缀 KV，只需 prefill 历史与问题部分
+    - 会话 KV cache 只留给主角色（会话后续沿主角色的回答继续），另一路不带 session_id，避免两路互相覆盖
+    - 开启回复缓存时两路回答都会写入缓存，之后以相同历史切换角色的请求直接回放
+"""
+
+
+class DualPerspective:
+    def __init__(self, router, decisions, primary):
+        self.router = router
+        self.decisions = decisions      # {role: RouteDecision}
+        self.primary = primary
+
+    @classmethod
+    async def acquire(cls, router, engine_type, roles, priority="batch"):
+        """ 为每个角色提交准入（roles[0] 为主角色）；任一角色排队已满时释放已获得的名额并抛出 QueueFullError """
+        decisions = {}
+        try:
+            for role in roles:
+                decisions[role] = await router.acquire(engine_type, priority)
+        except QueueFullError:
+            for decision in decisions.values():
+                decision.release()
+            raise
+        return cls(router, decisions, roles[0])
+
+    @property
+    def unavailable(self):
+        """ 未就绪的引擎，全部就绪时为 None """
+        for decision in self.decisions.values():
+            if decision.engine is None:
+                return decision.key
+        return None
+
+    @property
+    def tickets(self):
+        return [decision.ticket for decision in self.decisions.values() if decision.ticket is not None]
+
+    @property
+    def admitted(self):
+        """ 至少一路已准入（可以开始输出） """
+        return not self.tickets or any(ticket.admitted for ticket in self.tickets)
+
+    @property
+    def queue_wait_time(self):
+        return max([ticket.queue_wait_time for ticket in self.tickets], default=0.0)
+
+    @property
+    def served_by(self):
+        return {role: decision.served_by for role, decision in self.decisions.items()}
+
+    async def positions(self):
+        """ 产出先提交的名额的排队位置，直到其准入；另一路在生成过程中准入 """
+        if self.tickets and not self.admitted:
+            async for position in self.tickets[0].positions():
+                yield position
+
+    @staticmethod
+    async def wait(decision):
+        if decision.ticket is not None:
+            await decision.ticket.wait()
+
+    async def stream_role(self, role, user_query, prompts, history, priority, session_id, kwargs):
+        """ 单路：等待本路名额准入后生成，结束即释放名额 """
+        decision = self.decisions[role]
+        try:
+            await self.wait(decision)
+            stream = self.router.astream(
+                decision,
+                user_query=user_query,
+                history=history,
+                sys_prompt=prompts[role],
+                priority=priority,
+                **self.stream_kwargs(role, session_id, kwargs)
+            )
+            try:
+                async for token in stream:
+                    yield token
+            finally:
+                await stream.aclose()
+        finally:
+            decision.release()
+
+    async def generate_role(self, role, user_query, prompts, history, priority, session_id, kwargs):
+        decision = self.decisions[role]
+        try:
+            await self.wait(decision)
+            return await self.router.agenerate(
+                decision,
+                user_query=user_query,
+                history=history,
+                sys_prompt=prompts[role],
+                priority=priority,
+                **self.stream_kwargs(role, session_id, kwargs)
+            )
+        finally:
+            decision.release()
+
+    def stream_kwargs(self, role, session_id, kwargs):
+        return {**kwargs, "session_id": session_id if role == self.primary else None}
+
+    async def astream(self, user_query, prompts, history=None, priority="batch", session_id=None, **kwargs):
+        """ prompts: {role: sys_prompt}；每路准入后即开始，按到达顺序交错产出 (role, token) """
+        streams = {
+            role: self.stream_role(role, user_query, prompts, history, priority, session_id, kwargs)
+            for role in self.decisions
+        }
+        merged = merge_async_iterables(streams)
+        try:
+            async for role, token in merged:
+                yield role, token
+        finally:
+            await merged.aclose()
+            for stream in streams.values():
+                await stream.aclose()
+
+    async def agenerate(self, user_query, prompts, history=None, priority="batch", session_id=None, **kwargs):
+        """ 两路并发生成（各自准入后开始），返回 {role: answer} """
+        roles = list(self.decisions)
+        answers = await asyncio.gather(*[
+            self.generate_role(role, user_query, prompts, history, priority, session_id, kwargs)
+            for role in roles
+        ])
+        return dict(zip(roles, answers))
+
+    def release(self):
+        """ 释放全部名额（未准入的取消排队），可重复调用 """
+        for decision in self.decisions.values():
+            decision.release()
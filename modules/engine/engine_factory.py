@@ -1,5 +1,16 @@
 import os
+import asyncio
+import time
 from dotenv import load_dotenv
+from modules.engine.admission import AdmissionController
+from modules.cache.response_cache import ResponseCache, ResponseCachedEngine
+from modules.engine.single_flight import SingleFlightEngine
+from modules.engine.router import EngineHealth, EngineRouter, HealthTrackedEngine, build_policy
+from modules.engine.history import HistoryManager, HistoryManagedEngine
+from modules.intent.classifier import IntentClassifier
+from modules.utils.cancellation import cancellation_stats
+from modules.utils.metrics import metrics, tracer
+from modules.utils.profiling import profiler
 
 
 
@@ -13,39 +24,350 @@ CONFIG = {
     "openai_api_key": os.getenv("OPENAI_API_KEY"),
     "openai_base_url": os.getenv("OPENAI_BASE_URL"),
     "openai_model": os.getenv("OPENAI_MODEL", "gpt-4o"),
+    "openai_connect_timeout": float(os.getenv("OPENAI_CONNECT_TIMEOUT", 5)),        # 建立连接超时(秒)
+    "openai_first_token_timeout": float(os.getenv("OPENAI_FIRST_TOKEN_TIMEOUT", 30)),  # 首 token 超时(秒)，超时后重试
+    "openai_total_timeout": float(os.getenv("OPENAI_TOTAL_TIMEOUT", 120)),          # 单次请求整体超时(秒)，含重试
+    "openai_max_retries": int(os.getenv("OPENAI_MAX_RETRIES", 2)),                  # 首 token 前失败的重试次数(指数退避)
+    "openai_retry_backoff": float(os.getenv("OPENAI_RETRY_BACKOFF", 0.5)),          # 退避基数(秒)
+    "openai_hedge_after": float(os.getenv("OPENAI_HEDGE_AFTER", 0)),                # 超过该秒数无首 token 时发起对冲请求, 0 关闭
+    "openai_max_connections": int(os.getenv("OPENAI_MAX_CONNECTIONS", 100)),        # 连接池上限
+    "openai_max_keepalive": int(os.getenv("OPENAI_MAX_KEEPALIVE", 20)),             # 保持的空闲长连接数
+    "openai_breaker_threshold": int(os.getenv("OPENAI_BREAKER_THRESHOLD", 5)),      # 连续失败多少次后熔断, 0 关闭
+    "openai_breaker_cooldown": float(os.getenv("OPENAI_BREAKER_COOLDOWN", 30)),     # 熔断持续时间(秒)
+    "local_max_batch_size": int(os.getenv("LOCAL_MAX_BATCH_SIZE", 8)),     # 连续批处理最大并发序列数, <=1 关闭
+    "local_prefix_cache_size": int(os.getenv("LOCAL_PREFIX_CACHE_SIZE", 4)),  # 常驻的系统提示词前缀 KV cache 数量, 0 关闭
+    "local_session_cache_mb": int(os.getenv("LOCAL_SESSION_CACHE_MB", 1024)),     # 会话 KV cache 显存预算
+    "local_session_cpu_cache_mb": int(os.getenv("LOCAL_SESSION_CPU_CACHE_MB", 4096)),  # 会话 KV cache 下放到 CPU 的内存预算
+    "local_load_strategy": os.getenv("LOCAL_LOAD_STRATEGY", "fast"),         # 模型加载方式: fast(内存映射直接落到设备) / default(from_pretrained)
+    "local_load_threads": int(os.getenv("LOCAL_LOAD_THREADS", 4)),          # fast 加载时并行读取权重的线程数
+    "local_cpu_mode": os.getenv("LOCAL_CPU_MODE", "fp32"),                   # 无 GPU 时的推理模式: fp32 / bf16 / int8(动态量化，结果持久化)
+    "local_draft_model_name": os.getenv("LOCAL_DRAFT_MODEL_NAME", ""),        # 投机解码草稿模型(同系列小模型，如 Qwen2.5-0.5B-Instruct)，为空关闭
+    "local_draft_lookahead": int(os.getenv("LOCAL_DRAFT_LOOKAHEAD", 5)),     # 草稿模型每步起草的 token 数
+    "local_draft_min_acceptance": float(os.getenv("LOCAL_DRAFT_MIN_ACCEPTANCE", 0.3)),  # 接受率低于该值时回退普通解码
+    "local_idle_timeout_min": float(os.getenv("LOCAL_IDLE_TIMEOUT_MIN", 0)),  # 本地模型空闲多少分钟后卸载, 0 关闭
+    "local_idle_mode": os.getenv("LOCAL_IDLE_MODE", "unload"),              # 空闲处理方式: unload(释放) / offload(权重下放到 CPU，仅 GPU)
+    "local_prewarm_at": os.getenv("LOCAL_PREWARM_AT", ""),                  # 每天定时预热的时间点，如 08:50,13:30
+    "local_replicas": int(os.getenv("LOCAL_REPLICAS", 1)),                  # 本地引擎副本数, 1 为单实例; device 模式下 0 表示每张 GPU 一个
+    "local_replica_mode": os.getenv("LOCAL_REPLICA_MODE", "device"),        # device(每张 GPU 一个进程内副本) / process(CPU 工作进程)
+    "local_worker_threads": int(os.getenv("LOCAL_WORKER_THREADS", 0)),      # 每个 CPU 工作进程的线程数, 0 为按核数平均分配
+    "inference_mode": os.getenv("INFERENCE_MODE", "inproc"),               # inproc(进程内加载) / remote(转发到推理服务) / auto(推理服务不可用时回退进程内)
+    "inference_socket": os.getenv("INFERENCE_SOCKET", "/tmp/translation-assistant-inference.sock"),  # 推理服务 unix socket
+    "local_max_in_flight": int(os.getenv("LOCAL_MAX_IN_FLIGHT", os.getenv("LOCAL_MAX_BATCH_SIZE", 8))),  # 本地引擎同时生成的请求上限
+    "local_max_queued": int(os.getenv("LOCAL_MAX_QUEUED", 32)),            # 本地引擎排队上限，超出立即返回 429
+    "response_cache_enabled": os.getenv("RESPONSE_CACHE_ENABLED", "1") == "1",       # 回复缓存开关
+    "response_cache_max_entries": int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 1024)),  # 内存层条目上限(LRU)
+    "response_cache_ttl": int(os.getenv("RESPONSE_CACHE_TTL", 24 * 3600)),            # 缓存有效期(秒)
+    "response_cache_db": os.getenv("RESPONSE_CACHE_DB", ""),                          # SQLite 磁盘层路径，为空则只用内存
+    "response_cache_semantic": os.getenv("RESPONSE_CACHE_SEMANTIC", "0") == "1",     # 近似问题命中
+    "response_cache_semantic_threshold": float(os.getenv("RESPONSE_CACHE_SEMANTIC_THRESHOLD", 0.92)),
+    "single_flight_mode": os.getenv("SINGLE_FLIGHT_MODE", "deterministic"),  # 相同请求合并: off / deterministic / always
+    "history_budget_local": int(os.getenv("HISTORY_BUDGET_LOCAL", 3072)),     # 本地引擎对话历史 token 预算, 0 不限制
+    "history_budget_openai": int(os.getenv("HISTORY_BUDGET_OPENAI", 12000)),  # 在线引擎对话历史 token 预算, 0 不限制
+    "history_low_watermark": float(os.getenv("HISTORY_LOW_WATERMARK", 0.6)),  # 超出预算时裁剪到预算的比例，留出余量让之后几轮前缀不变
+    "history_summary_engine": os.getenv("HISTORY_SUMMARY_ENGINE", ""),       # 被裁掉的早期对话由该引擎在后台生成摘要: local / openai，为空只裁剪
+    "router_policy": os.getenv("ROUTER_POLICY", "latency"),                # engine_type=auto 的路由策略: latency(预估完成时间最短) / priority(按顺序优先)
+    "router_engines": [name.strip() for name in os.getenv("ROUTER_ENGINES", "local,openai").split(",") if name.strip()],  # 参与自动路由的引擎及偏好顺序
+    "trace_max_recent": int(os.getenv("TRACE_MAX_RECENT", 256)),            # /api/traces 保留的最近请求 trace 数
+    "trace_tensorboard_dir": os.getenv("TRACE_TENSORBOARD_DIR", ""),       # 请求各阶段耗时写入 TensorBoard 的目录，为空不导出
+    "ui_flush_interval": float(os.getenv("UI_FLUSH_INTERVAL", 0.05)),       # 界面流式输出合并窗口(秒)：窗口内到达的 token 合成一帧写出
+    "ui_flush_max_bytes": int(os.getenv("UI_FLUSH_MAX_BYTES", 1024)),        # 缓冲达到该字节数时不等窗口结束立即写出
+    "admin_token": os.getenv("ADMIN_TOKEN", ""),                           # 管理接口(/api/admin/*)令牌，请求头 X-Admin-Token；为空时管理接口关闭
+    "profile_dir": os.getenv("PROFILE_DIR", "profiles"),                   # 性能剖析结果保存目录
+    "intent_model_path": os.getenv("INTENT_MODEL_PATH", ""),               # 意图识别模型(modules.intent.train_intent 训练)，为空关闭
+    "intent_threshold": float(os.getenv("INTENT_THRESHOLD", 0.85)),        # 置信度达到该值才拦截非领域输入，其余交给大模型判断
+    "intent_log_path": os.getenv("INTENT_LOG_PATH", ""),                   # 记录线上流量(JSONL)供重新训练，为空不记录
+    "engine_warmup": [name.strip() for name in os.getenv("ENGINE_WARMUP", "openai,local").split(",") if name.strip()],  # 启动后后台预热的引擎，其余首次使用时加载
 }
 
+ENGINE_KEYS = ["openai", "local"]
+
 class EngineManager:
     _instance = None
     local_engine = None
     openai_engine = None
+    admission = None
+    response_cache = None
+    engine_state = None
+    router = None
+    history = None
+    intent = None
 
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(EngineManager, cls).__new__(cls)
+            # 准入控制：目前只限制本地引擎（显存 / 算力受限），在线引擎不排队
+            cls._instance.admission = {
+                "local": AdmissionController(
+                    engine="local",
+                    max_in_flight=CONFIG["local_max_in_flight"],
+                    max_queued=CONFIG["local_max_queued"]
+                )
+            }
+            # 回复缓存：叠加在引擎之前，重复问题直接回放
+            if CONFIG["response_cache_enabled"]:
+                cls._instance.response_cache = ResponseCache(
+                    max_entries=CONFIG["response_cache_max_entries"],
+                    ttl=CONFIG["response_cache_ttl"],
+                    db_path=CONFIG["response_cache_db"],
+                    semantic=CONFIG["response_cache_semantic"],
+                    semantic_threshold=CONFIG["response_cache_semantic_threshold"]
+                )
+            cls._instance._wrapped_engines = {}
+            # 引擎按需加载：unloaded -> loading -> ready / failed
+            cls._instance.engine_state = {key: "unloaded" for key in ENGINE_KEYS}
+            cls._instance.engine_errors = {}
+            cls._instance.load_times = {}
+            cls._instance._load_tasks = {}
+            # 对话历史：按引擎 token 预算裁剪，可选后台摘要
+            cls._instance.history = HistoryManager(
+                budgets={
+                    "local": CONFIG["history_budget_local"],
+                    "openai": CONFIG["history_budget_openai"],
+                },
+                low_watermark=CONFIG["history_low_watermark"],
+                summarizer=cls._instance.summarize_history if CONFIG["history_summary_engine"] else None
+            )
+            # 自动路由：各引擎实时健康统计 + 可替换的路由策略
+            cls._instance.health = {key: EngineHealth(key) for key in ENGINE_KEYS}
+            cls._instance.router = EngineRouter(
+                cls._instance,
+                build_policy(CONFIG["router_policy"]),
+                [cls._instance.engine_key(name) for name in CONFIG["router_engines"]]
+            )
+            # 意图识别：调用大模型之前拦截明显无关的输入、为自动方向选择角色
+            cls._instance.intent = IntentClassifier.load(
+                CONFIG["intent_model_path"],
+                threshold=CONFIG["intent_threshold"],
+                log_path=CONFIG["intent_log_path"]
+            )
+            # 可观测性：请求级 trace 与 /api/metrics 抓取时汇总的各组件统计
+            cls._instance.single_flight = {}
+            tracer.configure(max_traces=CONFIG["trace_max_recent"], tensorboard_dir=CONFIG["trace_tensorboard_dir"])
+            metrics.add_collector(cls._instance.stats_snapshot)
+            profiler.configure(CONFIG["profile_dir"])
         return cls._instance
 
-    async def init_all(self):
-        """核心加载逻辑：只在第一次调用时生效"""
-        if self.local_engine or self.openai_engine:
-            return "Engines already initialized."
+    @staticmethod
+    def engine_key(engine_type):
+        """ 统一引擎类型：local 为本地引擎，其余均视为在线 OpenAI 引擎 """
+        return "local" if engine_type == "local" else "openai"
+
+    def get_engine(self, engine_type):
+        """ 按引擎类型获取引擎（由外到内依次为历史裁剪、回复缓存、进行中请求合并、健康统计），未就绪时返回 None """
+        key = self.engine_key(engine_type)
+        engine = self.local_engine if key == "local" else self.openai_engine
+        if engine is None:
+            return engine
+
+        cached = self._wrapped_engines.get(key)
+        if cached is None or cached[0] is not engine:
+            wrapped = HealthTrackedEngine(engine, self.health[key])
+            wrapped = SingleFlightEngine(wrapped, key, mode=CONFIG["single_flight_mode"])
+            self.single_flight[key] = wrapped
+            if self.response_cache is not None:
+                wrapped = ResponseCachedEngine(wrapped, self.response_cache, key)
+            wrapped = HistoryManagedEngine(wrapped, self.history, key, engine)
+            cached = (engine, wrapped)
+            self._wrapped_engines[key] = cached
+        return cached[1]
+
+    async def summarize_history(self, text):
+        """ 早期对话摘要（后台执行，不经过准入队列） """
+        from modules.prompts.prompt_map import history_summary_prompt
+        engine = await self.load_engine(CONFIG["history_summary_engine"])
+        if engine is None:
+            raise RuntimeError(f"{CONFIG['history_summary_engine']} 引擎未就绪")
+        return await engine.agenerate(text, [], history_summary_prompt)
 
-        print("正在加载 AI 引擎...")
+    def get_admission(self, engine_type):
+        """ 获取引擎的准入控制器，不限流的引擎返回 None """
+        return self.admission.get(self.engine_key(engine_type))
 
-        # 1. 初始化 OpenAI
+    def build_openai_engine(self):
         from modules.llm.online_model import OpenAIModel
-        self.openai_engine = OpenAIModel(
+        return OpenAIModel(
             api_key=CONFIG["openai_api_key"],
             base_url=CONFIG["openai_base_url"],
-            model=CONFIG["openai_model"]
+            model=CONFIG["openai_model"],
+            connect_timeout=CONFIG["openai_connect_timeout"],
+            first_token_timeout=CONFIG["openai_first_token_timeout"],
+            total_timeout=CONFIG["openai_total_timeout"],
+            max_retries=CONFIG["openai_max_retries"],
+            retry_backoff=CONFIG["openai_retry_backoff"],
+            hedge_after=CONFIG["openai_hedge_after"],
+            max_connections=CONFIG["openai_max_connections"],
+            max_keepalive=CONFIG["openai_max_keepalive"],
+            breaker_threshold=CONFIG["openai_breaker_threshold"],
+            breaker_cooldown=CONFIG["openai_breaker_cooldown"]
         )
 
-        from modules.llm.local_model import LocalModelChat
-        self.local_engine = LocalModelChat(
-            base_model_name=CONFIG["local_model_name"]
+    @staticmethod
+    def local_engine_kwargs():
+        return dict(
+            base_model_name=CONFIG["local_model_name"],
+            max_batch_size=CONFIG["local_max_batch_size"],
+            prefix_cache_size=CONFIG["local_prefix_cache_size"],
+            session_cache_mb=CONFIG["local_session_cache_mb"],
+            session_cpu_cache_mb=CONFIG["local_session_cpu_cache_mb"],
+            load_strategy=CONFIG["local_load_strategy"],
+            load_threads=CONFIG["local_load_threads"],
+            idle_timeout=CONFIG["local_idle_timeout_min"] * 60,
+            idle_mode=CONFIG["local_idle_mode"],
+            prewarm_at=CONFIG["local_prewarm_at"],
+            cpu_mode=CONFIG["local_cpu_mode"],
+            draft_model_name=CONFIG["local_draft_model_name"],
+            draft_lookahead=CONFIG["local_draft_lookahead"],
+            draft_min_acceptance=CONFIG["local_draft_min_acceptance"]
         )
 
-        return "✅ 所有引擎加载完成"
+    def build_local_engine(self):
+        # torch / transformers 在此处才被导入，只用在线引擎或远程推理服务时不加载
+        from modules.prompts.prompt_map import prod_prompt, dev_prompt
+
+        # 独立推理服务：Web 进程不加载模型，请求经 unix socket 转发
+        if CONFIG["inference_mode"] in ("remote", "auto"):
+            from modules.engine.remote_engine import RemoteEngine
+            try:
+                return RemoteEngine(CONFIG["inference_socket"]).connect()
+            except Exception as e:
+                if CONFIG["inference_mode"] == "remote":
+                    raise RuntimeError(f"推理服务不可用({CONFIG['inference_socket']}): {e}")
+                print(f"推理服务不可用，回退到进程内加载: {e}")
+
+        # 多副本：每张 GPU 一个进程内副本，或多个 CPU 工作进程
+        if CONFIG["local_replica_mode"] == "process" or CONFIG["local_replicas"] != 1:
+            from modules.engine.replica_pool import build_local_pool
+            return build_local_pool(
+                mode=CONFIG["local_replica_mode"],
+                num_replicas=CONFIG["local_replicas"],
+                engine_kwargs=self.local_engine_kwargs(),
+                sys_prompts=[dev_prompt, prod_prompt],
+                worker_threads=CONFIG["local_worker_threads"]
+            )
+
+        from modules.llm.local_model import LocalModelChat
+        engine = LocalModelChat(**self.local_engine_kwargs())
+
+        # 预先计算各角色系统提示词的前缀 KV cache
+        engine.register_system_prompts([dev_prompt, prod_prompt])
+        return engine
+
+    async def load_engine(self, engine_type):
+        """ 加载引擎（并发调用共享同一次加载），失败时返回 None，下次调用会重试 """
+        key = self.engine_key(engine_type)
+        if self.state(key) != "ready":
+            task = self._load_tasks.get(key)
+            if task is None:
+                task = asyncio.create_task(self._load(key))
+                self._load_tasks[key] = task
+            # 请求被取消时不中断加载，后续请求仍可复用
+            await asyncio.shield(task)
+        return self.get_engine(key)
+
+    async def _load(self, key):
+        self.engine_state[key] = "loading"
+        print(f"正在加载 {key} 引擎...")
+        start = time.time()
+        builder = self.build_local_engine if key == "local" else self.build_openai_engine
+        try:
+            # 模型加载是阻塞操作，放到线程中执行，服务在此期间照常响应
+            engine = await asyncio.to_thread(builder)
+            setattr(self, f"{key}_engine", engine)
+            self.engine_state[key] = "ready"
+            self.engine_errors.pop(key, None)
+            print(f"✅ {key} 引擎加载完成，耗时 {time.time() - start:.2f}s")
+        except Exception as e:
+            self.engine_state[key] = "failed"
+            self.engine_errors[key] = str(e)
+            print(f"❌ {key} 引擎加载失败: {e}")
+        finally:
+            self.load_times[key] = round(time.time() - start, 3)
+            self._load_tasks.pop(key, None)
+
+    def state(self, engine_type):
+        """ 引擎加载状态；直接赋值的引擎实例（如基准测试注入）视为已就绪 """
+        key = self.engine_key(engine_type)
+        if getattr(self, f"{key}_engine") is not None:
+            return "ready"
+        return self.engine_state[key]
+
+    async def aget_engine(self, engine_type):
+        """ 获取引擎，未加载时先加载（首次使用时加载）；模型因空闲被卸载时请求到达即在后台开始重新加载 """
+        engine = await self.load_engine(engine_type)
+        prewarm = getattr(engine, "prewarm", None) if engine is not None else None
+        if prewarm is not None:
+            prewarm()
+        return engine
+
+    def start_warmup(self, engine_types=None):
+        """ 在后台预热引擎，不阻塞服务启动 """
+        engine_types = CONFIG["engine_warmup"] if engine_types is None else engine_types
+        for engine_type in engine_types:
+            key = self.engine_key(engine_type)
+            if self.state(key) in ("unloaded", "failed") and key not in self._load_tasks:
+                self._load_tasks[key] = asyncio.create_task(self._load(key))
+
+    def readiness(self):
+        """ 各引擎加载状态；预热列表中的引擎全部就绪时 ready 为 True """
+        warmup = {self.engine_key(engine_type) for engine_type in CONFIG["engine_warmup"]}
+        engines = {
+            key: {
+                "state": self.state(key),
+                "warmup": key in warmup,
+                "load_time": self.load_times.get(key),
+                "error": self.engine_errors.get(key),
+            }
+            for key in ENGINE_KEYS
+        }
+        # 本地模型的常驻状态（空闲卸载 / 重新加载耗时）
+        if self.local_engine is not None and hasattr(self.local_engine, "residency_stats"):
+            engines["local"]["residency"] = self.local_engine.residency_stats()
+        # 在线引擎的重试 / 对冲 / 熔断状态
+        if self.openai_engine is not None and hasattr(self.openai_engine, "resilience_stats"):
+            engines["openai"]["resilience"] = self.openai_engine.resilience_stats()
+        # 多副本时各副本的健康状态与负载
+        if self.local_engine is not None and hasattr(self.local_engine, "replica_stats"):
+            engines["local"]["replicas"] = self.local_engine.replica_stats()
+        return {
+            "ready": all(self.state(key) == "ready" for key in warmup),
+            "engines": engines,
+            "router": self.router.stats(),
+            "history": self.history.stats(),
+        }
+
+    def stats_snapshot(self):
+        """ 各组件统计汇总（/api/metrics 展开为 gauge） """
+        engines = {}
+        for key in ENGINE_KEYS:
+            engine = self.local_engine if key == "local" else self.openai_engine
+            stats = {"ready": self.state(key) == "ready", "load_time": self.load_times.get(key)}
+            for name in ("batch_stats", "speculative_stats", "residency_stats", "load_stats", "replica_stats", "resilience_stats"):
+                if engine is not None and hasattr(engine, name):
+                    stats[name[:-len("_stats")]] = getattr(engine, name)()
+            for name in ("prefix_cache", "session_cache"):
+                cache = getattr(engine, name, None)
+                if cache is not None and hasattr(cache, "stats"):
+                    stats[name] = cache.stats()
+            engines[key] = stats
+        router = self.router.stats()
+        router.pop("ranking", None)
+        return {
+            "engine": engines,
+            "admission": {key: admission.stats() for key, admission in self.admission.items()},
+            "response_cache": self.response_cache.stats() if self.response_cache is not None else {},
+            "single_flight": {key: engine.stats() for key, engine in self.single_flight.items()},
+            "cancellation": cancellation_stats.snapshot(),
+            "router": router,
+            "history": self.history.stats(),
+            "intent": self.intent.stats(),
+        }
+
+    async def init_all(self):
+        """ 同步加载全部引擎（旧的启动方式），服务启动默认改用 start_warmup 后台预热 """
+        await asyncio.gather(*[self.load_engine(key) for key in ENGINE_KEYS])
+        if all(self.state(key) == "ready" for key in ENGINE_KEYS):
+            return "✅ 所有引擎加载完成"
+        return f"部分引擎加载失败: {self.engine_errors}"
 
 
 # 创建一个全局唯一的管理对象
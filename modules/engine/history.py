@@ -0,0 +1,270 @@
+import asyncio
+import hashlib
+import math
+import re
+import threading
+from collections import OrderedDict
+
+from modules.utils.metrics import span
+
+
+"""
+多轮对话历史管理：
+    - 按引擎的 token 预算裁剪历史（以完整的 user/assistant 轮次为单位，从最早的开始丢弃）
+    - 每条消息的 token 数按 (分词器, 内容) 缓存，每轮只需为新增消息分词
+    - 超出预算时一次裁到 low_watermark x 预算，并记住会话的裁剪位置：之后几轮前缀保持不变，本地引擎的会话 KV cache 仍可复用
+    - 可选：被裁掉的早期对话由后台任务生成摘要（不阻塞当前请求），后续请求以摘要代替原文
+"""
+
+
+MESSAGE_OVERHEAD = 4            # 每条消息的对话模板标记（<|im_start|>role ... <|im_end|>）
+_CJK = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text):
+    """ 无分词器时的估算：中日韩字符约 1 token / 字，其余约 4 字符 / token """
+    text = text or ""
+    cjk = len(_CJK.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def message_digest(message):
+    raw = f"{message.get('role')}\x00{message.get('content') or ''}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def prefix_digests(messages):
+    """ 各前缀 messages[:i] 的摘要（链式计算），digests[0] 对应空前缀 """
+    digests = [""]
+    for message in messages:
+        digests.append(hashlib.sha1((digests[-1] + message_digest(message)).encode("ascii")).hexdigest())
+    return digests
+
+
+class TokenCountCache:
+    """ 消息 token 数的 LRU 缓存，键为 (计数器, 消息摘要) """
+    def __init__(self, max_entries=8192):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def count(self, counter_id, counter, message):
+        key = (counter_id, message_digest(message))
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+        tokens = counter(message.get("content") or "") + MESSAGE_OVERHEAD
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = tokens
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return tokens
+
+    def stats(self):
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def token_counter(engine):
+    """ 引擎的 token 计数方式：本地引擎用已加载的分词器（模型卸载后仍保留），其余按字符估算 """
+    tokenizer = getattr(getattr(engine, "loader", None), "tokenizer", None)
+    if tokenizer is not None:
+        counter_id = f"tokenizer:{getattr(engine, 'base_model_path', id(tokenizer))}"
+        return counter_id, lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+    return "estimate", estimate_tokens
+
+
+class HistoryManager:
+    def __init__(
+            self,
+            budgets,
+            low_watermark=0.6,
+            summarizer=None,
+            max_summary_tokens=400,
+            max_sessions=1024
+    ):
+        """
+        budgets      : {引擎: 历史 token 预算}，0 或缺省表示不限制
+        summarizer   : async (早期对话文本) -> 摘要，为 None 时只裁剪不摘要
+        """
+        self.budgets = budgets
+        self.low_watermark = min(max(low_watermark, 0.1), 1.0)
+        self.summarizer = summarizer
+        self.max_summary_tokens = max_summary_tokens
+        self.max_sessions = max_sessions
+        self.token_cache = TokenCountCache()
+
+        # 会话的裁剪位置：session_id -> (被裁掉部分的前缀摘要, 裁剪位置)
+        self._cuts = OrderedDict()
+        # 对话摘要按被裁掉部分的内容寻址：prefix_digests(history)[cut] -> 摘要
+        self._summaries = OrderedDict()
+        self._pending = {}
+
+        self.trimmed_requests = 0
+        self.dropped_messages = 0
+        self.summary_hits = 0
+        self.summaries_generated = 0
+        self.summary_failures = 0
+
+    @staticmethod
+    def normalize(history):
+        """ 统一为 {"role", "content"} 字典（兼容 pydantic 模型） """
+        result = []
+        for item in history or []:
+            if not isinstance(item, dict):
+                item = item.model_dump() if hasattr(item, "model_dump") else dict(item)
+            result.append({"role": item.get("role"), "content": item.get("content") or ""})
+        return result
+
+    def count(self, engine, messages):
+        counter_id, counter = token_counter(engine)
+        return [self.token_cache.count(counter_id, counter, message) for message in messages]
+
+    @staticmethod
+    def turn_starts(messages):
+        """ 可裁剪的位置：每轮以 user 消息开始，保证 user/assistant 成对保留 """
+        return [i for i, message in enumerate(messages) if message["role"] == "user"] + [len(messages)]
+
+    @staticmethod
+    def find_cut(counts, starts, limit):
+        """ 保留尽量多的最近轮次，使剩余消息的 token 总数不超过 limit """
+        suffix = sum(counts)
+        position = 0
+        for start in starts:
+            suffix -= sum(counts[position:start])
+            position = start
+            if suffix <= limit:
+                return start
+        return len(counts)
+
+    def prepare(self, engine_type, engine, history, session_id=None):
+        """ 返回按预算裁剪后的历史；被裁掉的部分有可用摘要时以一条 system 消息代替 """
+        history = self.normalize(history)
+        budget = self.budgets.get(engine_type) or 0
+        if budget <= 0 or not history:
+            return history
+
+        counts = self.count(engine, history)
+        if sum(counts) <= budget:
+            return history
+
+        digests = prefix_digests(history)
+        cut = None
+        # 复用会话上次的裁剪位置，前缀不变时本地引擎的会话 KV cache 仍然有效
+        previous = self._cuts.get(session_id) if session_id else None
+        if previous is not None:
+            prefix_key, previous_cut = previous
+            if previous_cut <= len(history) and digests[previous_cut] == prefix_key and sum(counts[previous_cut:]) <= budget:
+                cut = previous_cut
+        if cut is None:
+            cut = self.find_cut(counts, self.turn_starts(history), int(budget * self.low_watermark))
+
+        kept = history[cut:]
+        prefix_key = digests[cut]
+        if session_id:
+            self._remember_cut(session_id, prefix_key, cut)
+
+        self.trimmed_requests += 1
+        self.dropped_messages += cut
+
+        # 摘要：优先使用覆盖全部被裁掉部分的摘要，否则先用覆盖较短前缀的旧摘要，同时在后台生成新摘要
+        covered = next((i for i in range(cut, 0, -1) if digests[i] in self._summaries), 0)
+        summary = self._summaries[digests[covered]] if covered else ""
+        if covered < cut and self.summarizer is not None:
+            self.schedule_summary(prefix_key, summary, history[covered:cut])
+        if covered:
+            summary_message = {"role": "system", "content": f"此前对话摘要：{summary}"}
+            summary_tokens = self.count(engine, [summary_message])[0]
+            if summary_tokens + sum(counts[cut:]) <= budget:
+                self.summary_hits += 1
+                return [summary_message] + kept
+        return kept
+
+    def _remember_cut(self, session_id, prefix_key, cut):
+        self._cuts[session_id] = (prefix_key, cut)
+        self._cuts.move_to_end(session_id)
+        while len(self._cuts) > self.max_sessions:
+            self._cuts.popitem(last=False)
+
+    def forget_session(self, session_id):
+        self._cuts.pop(session_id, None)
+
+    def schedule_summary(self, prefix_key, previous, messages):
+        """ 在后台生成被裁掉部分的摘要（在已有的较短前缀摘要 previous 基础上追加 messages），当前请求不等待 """
+        if prefix_key in self._pending:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        task = loop.create_task(self._summarize(prefix_key, previous, messages))
+        self._pending[prefix_key] = task
+        task.add_done_callback(lambda _: self._pending.pop(prefix_key, None))
+
+    async def _summarize(self, prefix_key, previous, messages):
+        lines = [f"此前对话摘要：{previous}"] if previous else []
+        for message in messages:
+            speaker = "用户" if message["role"] == "user" else "助手"
+            lines.append(f"{speaker}：{message['content']}")
+        try:
+            summary = await self.summarizer("\n".join(lines))
+        except Exception as e:
+            summary = f"❌ {e}"
+        if not summary or summary.startswith("❌"):
+            self.summary_failures += 1
+            print(f"对话摘要生成失败: {summary[:80] if summary else '空回复'}")
+            return
+        # 摘要过长时截断，避免反而挤占上下文
+        summary = summary.strip()
+        if estimate_tokens(summary) > self.max_summary_tokens:
+            summary = summary[:self.max_summary_tokens]
+        self._summaries[prefix_key] = summary
+        self._summaries.move_to_end(prefix_key)
+        while len(self._summaries) > self.max_sessions:
+            self._summaries.popitem(last=False)
+        self.summaries_generated += 1
+
+    def stats(self):
+        return {
+            "budgets": dict(self.budgets),
+            "trimmed_requests": self.trimmed_requests,
+            "dropped_messages": self.dropped_messages,
+            "summaries_generated": self.summaries_generated,
+            "summary_hits": self.summary_hits,
+            "summary_failures": self.summary_failures,
+            "pending_summaries": len(self._pending),
+            "token_cache": self.token_cache.stats(),
+        }
+
+
+class HistoryManagedEngine:
+    """ 引擎最外层：生成前按该引擎的预算整理历史，其余属性透传 """
+    def __init__(self, engine, manager: HistoryManager, engine_type, raw_engine):
+        self.engine = engine
+        self.history_manager = manager
+        self.engine_type = engine_type
+        self.raw_engine = raw_engine
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    def prepare(self, history, session_id=None):
+        with span("history_prep"):
+            return self.history_manager.prepare(self.engine_type, self.raw_engine, history, session_id)
+
+    async def astream(self, user_query, history=None, sys_prompt=None, **kwargs):
+        history = self.prepare(history, kwargs.get("session_id"))
+        stream = self.engine.astream(user_query, history, sys_prompt, **kwargs)
+        try:
+            async for token in stream:
+                yield token
+        finally:
+            await stream.aclose()
+
+    async def agenerate(self, user_query, history=None, sys_prompt=None, **kwargs):
+        history = self.prepare(history, kwargs.get("session_id"))
+        return await self.engine.agenerate(user_query, history, sys_prompt, **kwargs)
@@ -0,0 +1,135 @@
+import argparse
+import asyncio
+import os
+
+from modules.engine.engine_factory import CONFIG, engine_manager
+from modules.engine.remote_engine import encode_frame, decode_frame
+from modules.engine.replica_pool import describe_engine
+from modules.utils.cancellation import CancellationToken
+
+
+"""
+独立推理服务：唯一持有模型的进程，任意数量的 Web 进程通过 unix socket 转发请求（INFERENCE_MODE=remote）
+用法: python -m modules.engine.inference_server --socket /tmp/translation-assistant-inference.sock
+"""
+
+
+async def watch_eof(reader, cancel_token):
+    """ 客户端关闭连接时取消生成 """
+    try:
+        while await reader.read(1024):
+            pass
+    except (OSError, ConnectionError):
+        pass
+    cancel_token.cancel("client_disconnected")
+
+
+async def raw_local_engine():
+    """
+    触发加载后返回未包装的本地引擎：回复缓存、请求合并、历史裁剪与健康统计都在 Web 进程中包在 RemoteEngine 外层，
+    此处不再重复（否则每个请求会被缓存 / 合并 / 裁剪两次，且两侧的 token 估算方式不同）
+    """
+    if await engine_manager.load_engine("local") is None:
+        return None
+    return engine_manager.local_engine
+
+
+async def handle_generate(request, reader, writer):
+    engine = await raw_local_engine()
+    if engine is None:
+        writer.write(encode_frame({"type": "error", "msg": "本地引擎未就绪"}))
+        return
+
+    cancel_token = CancellationToken()
+    watcher = asyncio.create_task(watch_eof(reader, cancel_token))
+    stream = engine.astream(
+        user_query=request["user_query"],
+        history=request.get("history"),
+        sys_prompt=request.get("sys_prompt"),
+        session_id=request.get("session_id"),
+        cancel_token=cancel_token
+    )
+    try:
+        async for token in stream:
+            if cancel_token.cancelled:
+                break
+            writer.write(encode_frame({"type": "token", "text": token}))
+            await writer.drain()
+        if not cancel_token.cancelled:
+            writer.write(encode_frame({"type": "done"}))
+    finally:
+        await stream.aclose()
+        watcher.cancel()
+
+
+async def handle_connection(reader, writer):
+    try:
+        line = await reader.readline()
+        if not line:
+            return
+        request = decode_frame(line)
+        op = request.get("op")
+
+        if op == "generate":
+            await handle_generate(request, reader, writer)
+        elif op == "describe":
+            engine = await raw_local_engine()
+            if engine is None:
+                writer.write(encode_frame({"type": "error", "msg": str(engine_manager.engine_errors.get("local"))}))
+            else:
+                writer.write(encode_frame({
+                    "type": "info",
+                    "info": describe_engine(engine),
+                    "readiness": engine_manager.readiness(),
+                }))
+        elif op == "invalidate":
+            engine = engine_manager.local_engine
+            if engine is not None:
+                engine.invalidate_session(request.get("session_id"))
+            writer.write(encode_frame({"type": "done"}))
+        else:
+            writer.write(encode_frame({"type": "error", "msg": f"unknown op: {op}"}))
+        await writer.drain()
+    except (OSError, ConnectionError):
+        # 客户端已断开
+        pass
+    except Exception as e:
+        try:
+            writer.write(encode_frame({"type": "error", "msg": str(e)}))
+            await writer.drain()
+        except (OSError, ConnectionError):
+            pass
+    finally:
+        writer.close()
+
+
+async def serve(socket_path):
+    # 推理服务自身必须在进程内加载模型
+    CONFIG["inference_mode"] = "inproc"
+
+    engine = await engine_manager.load_engine("local")
+    if engine is None:
+        raise RuntimeError(f"本地引擎加载失败: {engine_manager.engine_errors.get('local')}")
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = await asyncio.start_unix_server(handle_connection, path=socket_path, limit=2 ** 20)
+    print(f"✅ 推理服务已启动: {socket_path}")
+    async with server:
+        await server.serve_forever()
+
+
+def cli_default_args():
+    parser = argparse.ArgumentParser(description="翻译助手推理服务")
+    parser.add_argument(
+        "--socket",
+        type=str,
+        default=CONFIG["inference_socket"],
+        help="unix socket 路径，Web 进程通过 INFERENCE_SOCKET 连接"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = cli_default_args()
+    asyncio.run(serve(args.socket))
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import socket
+
+
+"""
+推理服务客户端：Web 进程（FastAPI / Chainlit）不加载模型，请求经本地 unix socket 转发给独立的推理服务进程。
+协议：每个请求一条连接，双方按行发送 JSON：
+    请求  {"op": "generate" | "describe" | "invalidate", ...}
+    响应  {"type": "token", "text": ...} ... {"type": "done"} / {"type": "error", "msg": ...}
+客户端断开连接即视为取消，服务端停止对应的生成
+"""
+
+
+def encode_frame(frame):
+    return (json.dumps(frame, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def decode_frame(line):
+    return json.loads(line.decode("utf-8"))
+
+
+class RemoteEngine:
+    """ 推理服务中本地引擎的代理，接口与 LocalModelChat 的异步接口一致 """
+    def __init__(self, socket_path, engine_type="local", timeout=10.0):
+        self.socket_path = socket_path
+        self.engine_type = engine_type
+        self.timeout = timeout
+        self.info = {}
+
+    def __getattr__(self, name):
+        # 缓存键、采样参数等属性取自推理服务上报的引擎信息
+        info = self.__dict__.get("info") or {}
+        if name in info:
+            return info[name]
+        raise AttributeError(name)
+
+    def request(self, frame):
+        """ 同步发送一次请求并读取单条响应（describe / invalidate 等轻量操作） """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(self.timeout)
+            client.connect(self.socket_path)
+            client.sendall(encode_frame(frame))
+            with client.makefile("rb") as reader:
+                line = reader.readline()
+        if not line:
+            raise ConnectionError("推理服务连接中断")
+        response = decode_frame(line)
+        if response.get("type") == "error":
+            raise RuntimeError(response.get("msg"))
+        return response
+
+    def connect(self):
+        """ 检查推理服务可用，并获取引擎信息 """
+        self.info = self.request({"op": "describe", "engine_type": self.engine_type})["info"]
+        return self
+
+    def invalidate_session(self, session_id):
+        try:
+            self.request({"op": "invalidate", "engine_type": self.engine_type, "session_id": session_id})
+        except (OSError, RuntimeError) as e:
+            print(f"会话缓存失效通知失败: {e}")
+
+    def prewarm(self):
+        """ 模型的加载与预热由推理服务负责 """
+
+    async def astream(self, user_query, history=None, sys_prompt=None, session_id=None, cancel_token=None):
+        writer = None
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_unix_connection(self.socket_path, limit=2 ** 20),
+                timeout=self.timeout
+            )
+            writer.write(encode_frame({
+                "op": "generate",
+                "engine_type": self.engine_type,
+                "user_query": user_query,
+                "history": history,
+                "sys_prompt": sys_prompt,
+                "session_id": session_id,
+            }))
+            await writer.drain()
+
+            while True:
+                if cancel_token is not None and cancel_token.cancelled:
+                    break
+                try:
+                    line = await asyncio.wait_for(reader.readline(), timeout=0.5)
+                except asyncio.TimeoutError:
+                    continue
+                if not line:
+                    raise ConnectionError("推理服务连接中断")
+
+                frame = decode_frame(line)
+                if frame["type"] == "token":
+                    yield frame["text"]
+                elif frame["type"] == "done":
+                    break
+                elif frame["type"] == "error":
+                    yield f"❌ 本地引擎调用失败: {frame.get('msg')}"
+                    break
+        except (OSError, ConnectionError, asyncio.TimeoutError) as e:
+            yield f"❌ 本地引擎调用失败: 推理服务不可用 ({e})"
+        finally:
+            # 关闭连接即通知服务端取消
+            if writer is not None:
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except (OSError, ConnectionError):
+                    pass
+
+    async def agenerate(self, user_query, history=None, sys_prompt=None, session_id=None, cancel_token=None):
+        chunks = []
+        async for chunk in self.astream(user_query, history, sys_prompt, session_id=session_id, cancel_token=cancel_token):
+            chunks.append(chunk)
+        return "".join(chunks)
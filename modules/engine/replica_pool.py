@@ -0,0 +1,564 @@
+import asyncio
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+"""
+本地引擎副本池：
+    - device  : 每张 GPU 一个进程内副本（LocalModelChat(gpu_index=i)）
+    - process : N 个 CPU 工作进程，每个进程固定线程数并绑定到互不重叠的 CPU 核
+请求按在途数最少的健康副本分发；带 session_id 的请求优先回到上次的副本以复用会话 KV cache。
+工作进程崩溃只影响其在途请求，进程按退避时间自动重启；进程内副本连续失败后重建。
+"""
+
+
+class ReplicaError(Exception):
+    """ 副本不可用或生成过程中崩溃 """
+
+
+# ============ CPU 工作进程 ============ #
+
+
+def describe_engine(engine):
+    """ 父进程需要的引擎属性（缓存键、采样参数等） """
+    return {
+        name: getattr(engine, name, None)
+        for name in ["base_model_path", "device", "temperature", "top_p", "max_new_tokens", "repetition_penalty"]
+    }
+
+
+def worker_main(conn, index, engine_kwargs, sys_prompts, threads, cores):
+    """ 工作进程入口：加载 LocalModelChat，通过管道接收请求、逐 token 回传 """
+    if threads:
+        # 须在导入 torch 之前设置
+        os.environ["OMP_NUM_THREADS"] = str(threads)
+        os.environ["MKL_NUM_THREADS"] = str(threads)
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+    import torch
+    if threads:
+        torch.set_num_threads(threads)
+
+    from modules.llm.local_model import LocalModelChat
+    from modules.utils.cancellation import CancellationToken
+
+    send_lock = threading.Lock()
+
+    def send(*message):
+        with send_lock:
+            conn.send(message)
+
+    try:
+        engine = LocalModelChat(**engine_kwargs)
+        engine.register_system_prompts(sys_prompts or [])
+    except Exception as e:
+        send("fatal", str(e))
+        return
+
+    send("ready", {**describe_engine(engine), "pid": os.getpid(), "threads": torch.get_num_threads()})
+
+    tokens = {}
+
+    def run(request_id, kwargs):
+        cancel_token = tokens[request_id]
+        engine.touch(1)
+        try:
+            streamer = engine.generate_response(stream=True, cancel_token=cancel_token, **kwargs)
+            for text in streamer:
+                if isinstance(text, Exception):
+                    raise text
+                if text:
+                    send("token", request_id, text)
+            send("done", request_id)
+        except Exception as e:
+            send("error", request_id, str(e))
+        finally:
+            engine.touch(-1)
+            tokens.pop(request_id, None)
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+
+        kind = message[0]
+        if kind == "generate":
+            tokens[message[1]] = CancellationToken()
+            threading.Thread(target=run, args=(message[1], message[2]), daemon=True).start()
+        elif kind == "cancel":
+            cancel_token = tokens.get(message[1])
+            if cancel_token is not None:
+                cancel_token.cancel("client_cancelled")
+        elif kind == "invalidate":
+            engine.invalidate_session(message[1])
+        elif kind == "stop":
+            break
+
+    for cancel_token in list(tokens.values()):
+        cancel_token.cancel("worker_stopped")
+    engine.release_memory()
+
+
+# ============ 副本 ============ #
+
+
+class BaseReplica:
+    kind = "base"
+
+    def __init__(self, index):
+        self.index = index
+        self.state = "starting"         # starting / healthy / restarting / dead
+        self.info = {}
+        self.in_flight = 0
+        self.total_requests = 0
+        self.completed = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.restarts = 0
+        self.last_error = None
+        self.avg_latency = None
+        self.busy_time = 0.0
+        self.created_at = time.time()
+
+    @property
+    def healthy(self):
+        return self.state == "healthy"
+
+    def invalidate_session(self, session_id):
+        pass
+
+    def stats(self):
+        uptime = max(time.time() - self.created_at, 1e-6)
+        return {
+            "index": self.index,
+            "kind": self.kind,
+            "state": self.state,
+            "device": self.info.get("device"),
+            "pid": self.info.get("pid"),
+            "threads": self.info.get("threads"),
+            "in_flight": self.in_flight,
+            "total_requests": self.total_requests,
+            "completed": self.completed,
+            "failures": self.failures,
+            "restarts": self.restarts,
+            "avg_latency": round(self.avg_latency, 4) if self.avg_latency is not None else None,
+            "utilization": round(min(1.0, self.busy_time / uptime), 4),
+            "last_error": self.last_error,
+        }
+
+
+class InProcessReplica(BaseReplica):
+    """ 进程内副本（每张 GPU 一个），连续失败后在后台重建 """
+    kind = "device"
+
+    def __init__(self, index, build):
+        super().__init__(index)
+        self.build = build
+        self.engine = build()
+        self.info = describe_engine(self.engine)
+        self.state = "healthy"
+
+    def astream(self, **kwargs):
+        return self.engine.astream(**kwargs)
+
+    def invalidate_session(self, session_id):
+        if self.engine is not None:
+            self.engine.invalidate_session(session_id)
+
+    def prewarm(self):
+        if self.engine is not None:
+            self.engine.prewarm()
+
+    def restart(self):
+        if self.state == "restarting":
+            return
+        self.state = "restarting"
+
+        def rebuild():
+            try:
+                if self.engine is not None:
+                    self.engine.release_memory()
+                self.engine = self.build()
+                self.info = describe_engine(self.engine)
+                self.restarts += 1
+                self.consecutive_failures = 0
+                self.state = "healthy"
+            except Exception as e:
+                self.last_error = str(e)
+                self.state = "dead"
+
+        threading.Thread(target=rebuild, name=f"local-replica-{self.index}-restart", daemon=True).start()
+
+    def stop(self):
+        if self.engine is not None:
+            self.engine.release_memory()
+        self.state = "dead"
+
+
+class ProcessReplica(BaseReplica):
+    """ CPU 工作进程副本；进程退出时在途请求立即失败，按退避时间重启 """
+    kind = "process"
+
+    def __init__(self, index, engine_kwargs, sys_prompts=None, threads=None, cores=None, max_backoff=60.0):
+        super().__init__(index)
+        self.engine_kwargs = engine_kwargs
+        self.sys_prompts = sys_prompts or []
+        self.threads = threads
+        self.cores = cores
+        self.max_backoff = max_backoff
+
+        self.process = None
+        self.conn = None
+        self._pending = {}
+        self._ids = itertools.count()
+        self._send_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stopping = False
+        self._backoff = 1.0
+        self._restart_timer = None
+        self.start()
+
+    def start(self):
+        import multiprocessing
+        context = multiprocessing.get_context("spawn")
+        parent_conn, child_conn = context.Pipe()
+        self._ready.clear()
+        self.process = context.Process(
+            target=worker_main,
+            args=(child_conn, self.index, self.engine_kwargs, self.sys_prompts, self.threads, self.cores),
+            name=f"local-replica-{self.index}",
+            daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        threading.Thread(target=self._read_loop, args=(parent_conn,), name=f"local-replica-{self.index}-reader", daemon=True).start()
+
+    def wait_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def _read_loop(self, conn):
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+
+            kind = message[0]
+            if kind == "ready":
+                self.info = message[1]
+                self.state = "healthy"
+                self.consecutive_failures = 0
+                self._backoff = 1.0
+                self._ready.set()
+            elif kind == "fatal":
+                self.last_error = message[1]
+            else:
+                self._deliver(message[1], message)
+        self._on_exit()
+
+    def _deliver(self, request_id, message):
+        pending = self._pending.get(request_id)
+        if pending is not None:
+            loop, queue = pending
+            loop.call_soon_threadsafe(queue.put_nowait, message)
+
+    def _on_exit(self):
+        exitcode = None
+        if self.process is not None:
+            self.process.join(timeout=5)
+            exitcode = self.process.exitcode
+        self.state = "dead"
+        self._ready.set()
+        if not self._stopping:
+            self.last_error = self.last_error or f"工作进程退出 (exitcode={exitcode})"
+            print(f"本地引擎副本 {self.index} 异常退出: {self.last_error}")
+        # 在途请求立即失败，不等待超时
+        for request_id in list(self._pending):
+            self._deliver(request_id, ("crashed", request_id, self.last_error))
+        if self._stopping:
+            return
+
+        self.state = "restarting"
+        delay = self._backoff
+        self._backoff = min(self._backoff * 2, self.max_backoff)
+
+        def restart():
+            if self._stopping:
+                return
+            self.restarts += 1
+            self.last_error = None
+            self.start()
+
+        # 守护线程，stop() 时取消，不阻塞进程退出
+        self._restart_timer = threading.Timer(delay, restart)
+        self._restart_timer.daemon = True
+        self._restart_timer.start()
+
+    def _send(self, message):
+        with self._send_lock:
+            self.conn.send(message)
+
+    async def astream(self, user_query, history=None, sys_prompt=None, session_id=None, cancel_token=None):
+        if not self.healthy:
+            raise ReplicaError(f"副本 {self.index} 不可用: {self.state}")
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        request_id = next(self._ids)
+        self._pending[request_id] = (loop, queue)
+
+        completed = False
+        try:
+            self._send(("generate", request_id, {
+                "user_query": user_query,
+                "history": history,
+                "sys_prompt": sys_prompt,
+                "session_id": session_id,
+            }))
+            while True:
+                if cancel_token is not None and cancel_token.cancelled:
+                    break
+                try:
+                    message = await asyncio.wait_for(queue.get(), timeout=0.5)
+                except asyncio.TimeoutError:
+                    continue
+
+                kind = message[0]
+                if kind == "token":
+                    yield message[2]
+                elif kind == "done":
+                    completed = True
+                    break
+                elif kind == "error":
+                    completed = True
+                    raise ReplicaError(message[2])
+                elif kind == "crashed":
+                    completed = True
+                    raise ReplicaError(f"副本 {self.index} 崩溃: {message[2]}")
+        except (BrokenPipeError, OSError) as e:
+            completed = True
+            raise ReplicaError(f"副本 {self.index} 通信失败: {e}")
+        finally:
+            self._pending.pop(request_id, None)
+            if not completed and self.healthy:
+                try:
+                    self._send(("cancel", request_id))
+                except (BrokenPipeError, OSError):
+                    pass
+
+    def invalidate_session(self, session_id):
+        if self.healthy:
+            try:
+                self._send(("invalidate", session_id))
+            except (BrokenPipeError, OSError):
+                pass
+
+    def restart(self):
+        # 进程仍在运行但连续出错：结束进程，由读取线程触发重启
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+
+    def stop(self):
+        self._stopping = True
+        if self._restart_timer is not None:
+            self._restart_timer.cancel()
+            self._restart_timer = None
+        try:
+            self._send(("stop",))
+        except (BrokenPipeError, OSError):
+            pass
+        if self.process is not None:
+            self.process.join(timeout=10)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.state = "dead"
+
+
+# ============ 副本池 ============ #
+
+
+class LocalReplicaPool:
+    """
+    多副本本地引擎，接口与 LocalModelChat 的异步接口一致（agenerate / astream / invalidate_session）
+    """
+    def __init__(self, replicas, max_consecutive_failures=3, max_affinity=10000):
+        self.replicas = replicas
+        self.max_consecutive_failures = max_consecutive_failures
+        self.max_affinity = max_affinity
+        self._affinity = OrderedDict()
+        self._round_robin = itertools.count()
+
+        # 缓存键与采样参数取自第一个副本（各副本配置一致）
+        info = next((replica.info for replica in replicas if replica.info), {})
+        self.base_model_path = info.get("base_model_path")
+        self.temperature = info.get("temperature")
+        self.top_p = info.get("top_p")
+        self.max_new_tokens = info.get("max_new_tokens")
+        self.repetition_penalty = info.get("repetition_penalty")
+
+    def pick(self, session_id=None, exclude=()):
+        """ 会话亲和优先，否则选在途请求最少的健康副本 """
+        healthy = [replica for replica in self.replicas if replica.healthy and replica not in exclude]
+        if not healthy:
+            raise ReplicaError("没有可用的本地引擎副本")
+
+        if session_id:
+            replica = self._affinity.get(session_id)
+            if replica in healthy:
+                self._affinity.move_to_end(session_id)
+                return replica
+
+        offset = next(self._round_robin)
+        replica = min(
+            healthy,
+            key=lambda r: (r.in_flight, (r.index - offset) % len(self.replicas))
+        )
+        if session_id:
+            self._affinity[session_id] = replica
+            while len(self._affinity) > self.max_affinity:
+                self._affinity.popitem(last=False)
+        return replica
+
+    async def astream(self, user_query, history=None, sys_prompt=None, session_id=None, cancel_token=None):
+        tried = []
+        while True:
+            try:
+                replica = self.pick(session_id, exclude=tried)
+            except ReplicaError as e:
+                yield f"❌ 本地引擎调用失败: {str(e)}"
+                return
+
+            replica.in_flight += 1
+            replica.total_requests += 1
+            start = time.time()
+            yielded = False
+            stream = replica.astream(
+                user_query=user_query,
+                history=history,
+                sys_prompt=sys_prompt,
+                session_id=session_id,
+                cancel_token=cancel_token
+            )
+            try:
+                async for token in stream:
+                    yielded = True
+                    yield token
+                replica.completed += 1
+                replica.consecutive_failures = 0
+                latency = time.time() - start
+                replica.avg_latency = latency if replica.avg_latency is None else 0.8 * replica.avg_latency + 0.2 * latency
+                return
+            except Exception as e:
+                replica.failures += 1
+                replica.consecutive_failures += 1
+                replica.last_error = str(e)
+                if replica.consecutive_failures >= self.max_consecutive_failures:
+                    print(f"本地引擎副本 {replica.index} 连续失败 {replica.consecutive_failures} 次，重启")
+                    replica.restart()
+                # 尚未输出任何 token 时换一个副本重试，否则只能结束本次回复
+                if yielded:
+                    yield f"❌ 本地引擎调用失败: {str(e)}"
+                    return
+                tried.append(replica)
+                self._affinity.pop(session_id, None)
+            finally:
+                await stream.aclose()
+                replica.in_flight -= 1
+                replica.busy_time += time.time() - start
+
+    async def agenerate(self, user_query, history=None, sys_prompt=None, session_id=None, cancel_token=None):
+        chunks = []
+        async for chunk in self.astream(user_query, history, sys_prompt, session_id=session_id, cancel_token=cancel_token):
+            chunks.append(chunk)
+        return "".join(chunks)
+
+    def invalidate_session(self, session_id):
+        replica = self._affinity.pop(session_id, None)
+        for target in ([replica] if replica is not None else self.replicas):
+            target.invalidate_session(session_id)
+
+    def prewarm(self):
+        for replica in self.replicas:
+            if hasattr(replica, "prewarm"):
+                replica.prewarm()
+
+    def replica_stats(self):
+        """ 各副本健康状态与负载 """
+        return {
+            "replicas": [replica.stats() for replica in self.replicas],
+            "healthy": sum(1 for replica in self.replicas if replica.healthy),
+            "in_flight": sum(replica.in_flight for replica in self.replicas),
+        }
+
+    def release_memory(self):
+        for replica in self.replicas:
+            replica.stop()
+
+
+def split_cores(num_workers, threads=0):
+    """ 将可用 CPU 核平均分给各工作进程，返回 [(线程数, 核列表)] """
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    per_worker = threads or max(1, len(cores) // num_workers)
+
+    plans = []
+    for index in range(num_workers):
+        chunk = cores[index * per_worker:(index + 1) * per_worker]
+        # 核数不足时不绑定，只限制线程数
+        plans.append((per_worker, chunk if len(chunk) == per_worker else None))
+    return plans
+
+
+def build_local_pool(mode, num_replicas, engine_kwargs, sys_prompts=None, worker_threads=0, startup_timeout=None):
+    """
+    构建本地副本池
+    mode=device 时 num_replicas<=0 表示每张可见 GPU 一个副本，且不超过可见 GPU 数（无 GPU 时为 1）；
+    mode=process 时 num_replicas<=0 表示单个工作进程
+    """
+    if mode == "process":
+        num_replicas = max(1, num_replicas)
+        replicas = [
+            ProcessReplica(
+                index,
+                {**engine_kwargs, "gpu_index": -1},
+                sys_prompts=sys_prompts,
+                threads=threads,
+                cores=cores
+            )
+            for index, (threads, cores) in enumerate(split_cores(num_replicas, worker_threads))
+        ]
+        for replica in replicas:
+            replica.wait_ready(startup_timeout)
+        if not any(replica.healthy for replica in replicas):
+            errors = [replica.last_error for replica in replicas]
+            for replica in replicas:
+                replica.stop()
+            raise ReplicaError(f"本地引擎工作进程全部启动失败: {errors}")
+        return LocalReplicaPool(replicas)
+
+    import torch
+    from modules.llm.local_model import LocalModelChat
+    # 每个副本独占一张 GPU；副本数超过 GPU 数时多个副本会落在同一设备（或 CPU）上，只多占内存、并不增加吞吐
+    max_replicas = max(1, torch.cuda.device_count())
+    if num_replicas <= 0:
+        num_replicas = max_replicas
+    elif num_replicas > max_replicas:
+        print(f"LOCAL_REPLICAS={num_replicas} 超过可见 GPU 数 {torch.cuda.device_count()}，按 {max_replicas} 个副本启动（CPU 多副本请使用 LOCAL_REPLICA_MODE=process）")
+        num_replicas = max_replicas
+
+    def builder(gpu_index):
+        def build():
+            engine = LocalModelChat(**{**engine_kwargs, "gpu_index": gpu_index})
+            engine.register_system_prompts(sys_prompts or [])
+            return engine
+        return build
+
+    return LocalReplicaPool([InProcessReplica(index, builder(index)) for index in range(num_replicas)])
@@ -0,0 +1,382 @@
+import threading
+import time
+from collections import deque
+
+from modules.engine.admission import QueueFullError
+
+
+"""
+自动路由（engine_type=auto）：
+    - EngineHealth        : 每个引擎最近的首 token 延迟、生成速度与错误率（EMA / 滑动窗口），由 HealthTrackedEngine 在真实生成时记录
+    - RoutingPolicy       : 路由策略，输入各引擎快照，输出尝试顺序；可通过 ROUTING_POLICIES 扩展或直接传入实例
+    - EngineRouter        : 按策略选择引擎并完成准入；排队已满、未就绪或首 token 前出错时切换到下一个引擎，记录实际服务的引擎
+显式指定 local / openai 时不做切换，行为与之前一致
+"""
+
+
+class EngineHealth:
+    """ 单个引擎的实时健康统计 """
+    def __init__(self, name, window=20, ema_alpha=0.2):
+        self.name = name
+        self.ema_alpha = ema_alpha
+        self.ema_ttft = None
+        self.ema_tokens_per_s = None
+        self.outcomes = deque(maxlen=window)
+        self.consecutive_errors = 0
+        self.requests = 0
+        self.errors = 0
+        self.last_error = None
+        self.last_error_time = None
+        self._lock = threading.Lock()
+
+    def _ema(self, current, value):
+        return value if current is None else (1 - self.ema_alpha) * current + self.ema_alpha * value
+
+    def record_success(self, ttft, tokens, duration):
+        with self._lock:
+            self.requests += 1
+            self.outcomes.append(True)
+            self.consecutive_errors = 0
+            if ttft is not None:
+                self.ema_ttft = self._ema(self.ema_ttft, ttft)
+                generation = duration - ttft
+                if tokens > 1 and generation > 0:
+                    self.ema_tokens_per_s = self._ema(self.ema_tokens_per_s, (tokens - 1) / generation)
+
+    def record_error(self, error):
+        with self._lock:
+            self.requests += 1
+            self.errors += 1
+            self.outcomes.append(False)
+            self.consecutive_errors += 1
+            self.last_error = str(error)[:200]
+            self.last_error_time = time.time()
+
+    @property
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return sum(1 for ok in self.outcomes if not ok) / len(self.outcomes)
+
+    def stats(self):
+        return {
+            "ema_ttft": round(self.ema_ttft, 4) if self.ema_ttft is not None else None,
+            "ema_tokens_per_s": round(self.ema_tokens_per_s, 2) if self.ema_tokens_per_s is not None else None,
+            "error_rate": round(self.error_rate, 4),
+            "consecutive_errors": self.consecutive_errors,
+            "requests": self.requests,
+            "errors": self.errors,
+            "last_error": self.last_error,
+        }
+
+
+def is_error_text(text):
+    """ 引擎以 ❌ 开头的字符串返回错误 """
+    return isinstance(text, str) and text.startswith("❌")
+
+
+class HealthTrackedEngine:
+    """ 包装原始引擎，记录每次真实生成的首 token 延迟、速度与错误；其余属性透传 """
+    def __init__(self, engine, health: EngineHealth):
+        self.engine = engine
+        self.health = health
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    async def astream(self, user_query, history=None, sys_prompt=None, **kwargs):
+        cancel_token = kwargs.get("cancel_token")
+        start = time.perf_counter()
+        ttft = None
+        tokens = 0
+        failed = False
+        completed = False
+        stream = self.engine.astream(user_query, history, sys_prompt, **kwargs)
+        try:
+            async for token in stream:
+                if is_error_text(token):
+                    failed = True
+                    self.health.record_error(token)
+                elif ttft is None:
+                    ttft = time.perf_counter() - start
+                tokens += 1
+                yield token
+            completed = True
+        except Exception as e:
+            failed = True
+            self.health.record_error(e)
+            raise
+        finally:
+            await stream.aclose()
+            # 取消 / 提前退出的请求不计入速度统计
+            if completed and not failed and not (cancel_token is not None and cancel_token.cancelled):
+                self.health.record_success(ttft, tokens, time.perf_counter() - start)
+
+    async def agenerate(self, user_query, history=None, sys_prompt=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            answer = await self.engine.agenerate(user_query, history, sys_prompt, **kwargs)
+        except Exception as e:
+            self.health.record_error(e)
+            raise
+        if is_error_text(answer):
+            self.health.record_error(answer)
+        else:
+            # 非流式无首 token 时间，只更新错误率
+            self.health.record_success(None, 0, time.perf_counter() - start)
+        return answer
+
+
+class RoutingPolicy:
+    """
+    路由策略基类：rank 接收各候选引擎的快照（见 EngineRouter.snapshot），返回按尝试顺序排列的引擎名。
+    不健康的引擎应排在最后而不是直接剔除，其他引擎都不可用时仍可尝试
+    """
+    name = "base"
+
+    def __init__(self, max_error_rate=0.5, max_consecutive_errors=3, error_cooldown=30.0):
+        self.max_error_rate = max_error_rate
+        self.max_consecutive_errors = max_consecutive_errors
+        self.error_cooldown = error_cooldown
+
+    def healthy(self, snapshot):
+        if snapshot["state"] == "failed" or snapshot.get("breaker") == "open":
+            return False
+        if snapshot["saturated"]:
+            return False
+        health = snapshot["health"]
+        recent_error = health["last_error_time"] is not None and time.time() - health["last_error_time"] < self.error_cooldown
+        if recent_error and health["consecutive_errors"] >= self.max_consecutive_errors:
+            return False
+        if recent_error and health["requests"] >= 5 and health["error_rate"] > self.max_error_rate:
+            return False
+        return True
+
+    def score(self, snapshot):
+        return 0.0
+
+    def rank(self, snapshots):
+        healthy = [s for s in snapshots if self.healthy(s)]
+        unhealthy = [s for s in snapshots if not self.healthy(s)]
+        return [s["name"] for s in sorted(healthy, key=self.score)] + [s["name"] for s in unhealthy]
+
+
+class PriorityPolicy(RoutingPolicy):
+    """ 按 ROUTER_ENGINES 的顺序优先，不健康 / 排队已满时切换到下一个 """
+    name = "priority"
+
+    def score(self, snapshot):
+        return snapshot["preference"]
+
+
+class LatencyAwarePolicy(RoutingPolicy):
+    """
+    预估完成时间最短优先：
+        排队等待 (排队数 / 并发上限 x 平均生成时长) + 首 token 延迟 + expected_tokens / 生成速度，
+        按错误率加罚；未加载的引擎加上 load_penalty，避免为了路由而触发模型加载
+    """
+    name = "latency"
+
+    def __init__(self, expected_tokens=256, load_penalty=30.0, error_penalty=4.0, **kwargs):
+        super().__init__(**kwargs)
+        self.expected_tokens = expected_tokens
+        self.load_penalty = load_penalty
+        self.error_penalty = error_penalty
+
+    def score(self, snapshot):
+        health = snapshot["health"]
+        admission = snapshot.get("admission")
+
+        queue_wait = 0.0
+        if admission:
+            waiting = admission["queued"] + admission["in_flight"] + 1 - admission["max_in_flight"]
+            if waiting > 0:
+                queue_wait = waiting / admission["max_in_flight"] * admission["avg_service_time"]
+
+        # 尚无统计的引擎按 0 计，先试探一次再按实测排序
+        ttft = health["ema_ttft"] or 0.0
+        generation = self.expected_tokens / health["ema_tokens_per_s"] if health["ema_tokens_per_s"] else 0.0
+        expected = queue_wait + ttft + generation
+        if snapshot["state"] != "ready":
+            expected += self.load_penalty
+        expected *= 1 + self.error_penalty * health["error_rate"]
+        # 同分时按偏好顺序
+        return expected, snapshot["preference"]
+
+
+ROUTING_POLICIES = {
+    PriorityPolicy.name: PriorityPolicy,
+    LatencyAwarePolicy.name: LatencyAwarePolicy,
+}
+
+
+def build_policy(name, **kwargs):
+    if name not in ROUTING_POLICIES:
+        raise ValueError(f"未知的路由策略: {name}，可选 {list(ROUTING_POLICIES)}")
+    return ROUTING_POLICIES[name](**kwargs)
+
+
+class RouteDecision:
+    """ 单个请求的路由结果：当前引擎、准入凭证，以及已尝试过的引擎 """
+    def __init__(self, engine_type, auto):
+        self.engine_type = engine_type
+        self.auto = auto
+        self.key = None
+        self.engine = None
+        self.ticket = None
+        self.tried = []
+        self.failovers = 0
+
+    @property
+    def served_by(self):
+        return self.key
+
+    def release(self):
+        if self.ticket is not None:
+            self.ticket.release()
+
+
+class EngineRouter:
+    def __init__(self, manager, policy: RoutingPolicy, engines):
+        self.manager = manager
+        self.policy = policy
+        self.engines = list(dict.fromkeys(engines))
+        self.served = {key: 0 for key in self.engines}
+        self.failovers = 0
+        self.auto_requests = 0
+
+    def snapshot(self, key):
+        """ 路由依据：加载状态、准入队列、健康统计 """
+        admission = self.manager.get_admission(key)
+        admission_stats = admission.stats() if admission is not None else None
+        engine = getattr(self.manager, f"{key}_engine")
+        breaker = None
+        if engine is not None and hasattr(engine, "resilience_stats"):
+            breaker = engine.resilience_stats()["breaker"]["state"]
+        health = self.manager.health[key]
+        return {
+            "name": key,
+            "preference": self.engines.index(key),
+            "state": self.manager.state(key),
+            "admission": admission_stats,
+            "saturated": bool(admission_stats) and admission_stats["queued"] >= admission_stats["max_queued"],
+            "breaker": breaker,
+            "health": {**health.stats(), "last_error_time": health.last_error_time},
+        }
+
+    def rank(self, exclude=()):
+        snapshots = [self.snapshot(key) for key in self.engines if key not in exclude]
+        return self.policy.rank(snapshots)
+
+    async def acquire(self, engine_type, priority="batch", decision=None):
+        """
+        选择引擎并提交准入；auto 时依次尝试排序后的引擎，跳过未就绪与排队已满的引擎。
+        显式引擎未就绪时 decision.engine 为 None，排队已满时抛出 QueueFullError
+        """
+        auto = engine_type == "auto"
+        if decision is None:
+            decision = RouteDecision(engine_type, auto)
+            if auto:
+                self.auto_requests += 1
+        candidates = self.rank(exclude=decision.tried) if auto else [self.manager.engine_key(engine_type)]
+
+        queue_full = None
+        for key in candidates:
+            decision.tried.append(key)
+            engine = await self.manager.aget_engine(key)
+            if engine is None:
+                continue
+            admission = self.manager.get_admission(key)
+            try:
+                ticket = admission.submit(priority) if admission else None
+            except QueueFullError as e:
+                if not auto:
+                    raise
+                queue_full = e
+                continue
+            decision.key, decision.engine, decision.ticket = key, engine, ticket
+            return decision
+
+        if queue_full is not None:
+            raise queue_full
+        decision.key, decision.engine, decision.ticket = (candidates[0] if candidates else None), None, None
+        return decision
+
+    async def failover(self, decision, priority, error):
+        """ 当前引擎首 token 前失败：释放准入，切换到下一个可用引擎；没有可用引擎时返回 False """
+        decision.release()
+        previous = decision.key
+        try:
+            await self.acquire(decision.engine_type, priority, decision)
+        except QueueFullError:
+            return False
+        if decision.engine is None:
+            return False
+        decision.failovers += 1
+        self.failovers += 1
+        print(f"自动路由: {previous} 首 token 前失败（{str(error)[:80]}），切换到 {decision.key}")
+        if decision.ticket is not None:
+            await decision.ticket.wait()
+        return True
+
+    def record_served(self, decision):
+        if decision.key in self.served:
+            self.served[decision.key] += 1
+
+    async def astream(self, decision, user_query, history=None, sys_prompt=None, priority="batch", **kwargs):
+        """ 流式生成；auto 时首 token 前出错（异常或 ❌ 错误信息）切换到下一个引擎，首 token 之后不再切换 """
+        while True:
+            stream = decision.engine.astream(user_query, history, sys_prompt, **kwargs)
+            first = True
+            try:
+                async for token in stream:
+                    if first and decision.auto and is_error_text(token):
+                        error = token
+                        break
+                    first = False
+                    yield token
+                else:
+                    self.record_served(decision)
+                    return
+                if not first:
+                    self.record_served(decision)
+                    return
+            except Exception as e:
+                if not (first and decision.auto):
+                    raise
+                error = e
+            finally:
+                await stream.aclose()
+
+            cancel_token = kwargs.get("cancel_token")
+            if (cancel_token is not None and cancel_token.cancelled) or not await self.failover(decision, priority, error):
+                yield error if is_error_text(error) else f"❌ 自动路由失败: {error}"
+                return
+
+    async def agenerate(self, decision, user_query, history=None, sys_prompt=None, priority="batch", **kwargs):
+        while True:
+            try:
+                answer = await decision.engine.agenerate(user_query, history, sys_prompt, **kwargs)
+                error = answer if is_error_text(answer) else None
+            except Exception as e:
+                if not decision.auto:
+                    raise
+                answer, error = None, e
+            if error is None or not decision.auto:
+                self.record_served(decision)
+                return answer
+
+            cancel_token = kwargs.get("cancel_token")
+            if (cancel_token is not None and cancel_token.cancelled) or not await self.failover(decision, priority, error):
+                return answer if answer is not None else f"❌ 自动路由失败: {error}"
+
+    def stats(self):
+        return {
+            "policy": self.policy.name,
+            "engines": self.engines,
+            "auto_requests": self.auto_requests,
+            "served_by": dict(self.served),
+            "failovers": self.failovers,
+            "ranking": self.rank(),
+            "health": {key: self.manager.health[key].stats() for key in self.engines},
+        }
@@ -0,0 +1,150 @@
+import asyncio
+
+from modules.cache.response_cache import CacheKey, engine_identity
+from modules.utils.cancellation import CancellationToken
+
+
+
+def is_deterministic(engine):
+    """ 贪心解码（温度为 0 或关闭采样）时相同输入的输出一致，可安全合并 """
+    return getattr(engine, "temperature", None) == 0 or getattr(engine, "do_sample", True) is False
+
+
+class InflightGeneration:
+    """ 一次进行中的生成：保留已生成的 token，并扇出给所有订阅者 """
+    def __init__(self, key):
+        self.key = key
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.cancel_token = CancellationToken()
+        self.task = None
+        self._condition = asyncio.Condition()
+
+    async def run(self, stream):
+        try:
+            async for token in stream:
+                async with self._condition:
+                    self.chunks.append(token)
+                    self._condition.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            await stream.aclose()
+            async with self._condition:
+                self.done = True
+                self._condition.notify_all()
+
+    async def subscribe(self, cancel_token=None):
+        """ 先回放已生成的前缀，再跟随后续 token """
+        index = 0
+        while True:
+            async with self._condition:
+                while index >= len(self.chunks) and not self.done:
+                    await self._condition.wait()
+                pending = self.chunks[index:]
+                done = self.done
+
+            for chunk in pending:
+                if cancel_token is not None and cancel_token.cancelled:
+                    return
+                yield chunk
+            index += len(pending)
+
+            if done and index >= len(self.chunks):
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+class SingleFlightEngine:
+    """
+    进行中请求合并：相同 (引擎, 角色, 历史, 问题) 的请求共享同一次生成。
+    mode: off 不合并；deterministic 仅在确定性解码时合并；always 总是合并。
+    单个请求也可通过 coalesce=True 主动加入合并。
+    """
+    def __init__(self, engine, engine_type, mode="deterministic"):
+        self.engine = engine
+        self.engine_type = engine_type
+        self.mode = mode
+        self._inflight = {}
+
+        self.coalesced_requests = 0
+        self.total_flights = 0
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    def should_coalesce(self, coalesce=False):
+        if self.mode == "off":
+            return False
+        if coalesce or self.mode == "always":
+            return True
+        return is_deterministic(self.engine)
+
+    def flight_key(self, user_query, history, sys_prompt):
+        model, sampling = engine_identity(self.engine)
+        return CacheKey(self.engine_type, model, sys_prompt, history, user_query, sampling).exact
+
+    def join(self, user_query, history, sys_prompt):
+        """ 加入已有的生成，或发起新的生成 """
+        key = self.flight_key(user_query, history, sys_prompt)
+        flight = self._inflight.get(key)
+        # 所有订阅者已离开、正在停止的生成只剩半截回复，不能再加入
+        if flight is None or flight.cancel_token.cancelled:
+            flight = InflightGeneration(key)
+            self._inflight[key] = flight
+            self.total_flights += 1
+            # 共享生成不绑定单个请求的会话缓存与取消令牌，所有订阅者离开后才取消
+            stream = self.engine.astream(
+                user_query,
+                history,
+                sys_prompt,
+                cancel_token=flight.cancel_token
+            )
+            flight.task = asyncio.create_task(flight.run(stream))
+            flight.task.add_done_callback(lambda _: self._finish(flight))
+        else:
+            self.coalesced_requests += 1
+        flight.subscribers += 1
+        return flight
+
+    def _finish(self, flight):
+        if self._inflight.get(flight.key) is flight:
+            del self._inflight[flight.key]
+
+    async def astream(self, user_query, history=None, sys_prompt=None, coalesce=False, **kwargs):
+        if not self.should_coalesce(coalesce):
+            stream = self.engine.astream(user_query, history, sys_prompt, **kwargs)
+            try:
+                async for token in stream:
+                    yield token
+            finally:
+                await stream.aclose()
+            return
+
+        flight = self.join(user_query, history, sys_prompt)
+        try:
+            async for chunk in flight.subscribe(kwargs.get("cancel_token")):
+                yield chunk
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers <= 0 and not flight.done:
+                flight.cancel_token.cancel("all_subscribers_left")
+
+    async def agenerate(self, user_query, history=None, sys_prompt=None, coalesce=False, **kwargs):
+        if not self.should_coalesce(coalesce):
+            return await self.engine.agenerate(user_query, history, sys_prompt, **kwargs)
+        chunks = []
+        async for chunk in self.astream(user_query, history, sys_prompt, coalesce=True, **kwargs):
+            chunks.append(chunk)
+        return "".join(chunks)
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "active_flights": len(self._inflight),
+            "total_flights": self.total_flights,
+            "coalesced_requests": self.coalesced_requests,
+        }
@@ -0,0 +1,258 @@
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+
+
+"""
+轻量意图识别：在调用大模型之前，用字符 n-gram TF-IDF + 线性模型（多分类 logistic 回归）判断输入属于
+    - off_topic : 与研发 / 产品无关（提示词中的“场景 B”），直接返回固定回复，不再占用引擎
+    - business  : 业务需求描述，适合“译给开发”（to_dev）
+    - technical : 技术方案描述，适合“译给产品”（to_product）
+纯 Python 实现、只用 CPU，短问题单次判断在 1ms 以内；模型为 JSON 文件，由 modules.intent.train_intent 训练。
+只有置信度达到阈值时才拦截，不确定的输入仍交给大模型按提示词自行判断；带历史的追问依赖上下文，不拦截。
+"""
+
+
+LABELS = ["off_topic", "business", "technical"]
+DOMAIN_LABELS = ["business", "technical"]
+
+# 只取问题开头部分判断意图，长文本的耗时不随长度增长
+MAX_CHARS = 256
+
+_ASCII_WORD = re.compile(r"[a-z][a-z0-9_+#.-]*|\d+")
+_CJK = re.compile(r"[一-鿿]+")
+
+
+def extract_features(text):
+    """ 中文按字切分取 1~3 gram，英文 / 数字按词切分（MySQL、QPS、K8s 等术语） """
+    text = (text or "")[:MAX_CHARS].lower()
+    features = Counter()
+    for run in _CJK.findall(text):
+        for n in (1, 2, 3):
+            for i in range(len(run) - n + 1):
+                features[run[i:i + n]] += 1
+    for word in _ASCII_WORD.findall(text):
+        features["w:" + word] += 1
+    return features
+
+
+class TfidfVectorizer:
+    def __init__(self, vocabulary=None, idf=None):
+        self.vocabulary = vocabulary or {}     # feature -> index
+        self.idf = idf or []
+
+    def fit(self, texts, min_df=1, max_features=20000):
+        document_frequency = Counter()
+        for text in texts:
+            document_frequency.update(extract_features(text).keys())
+        kept = [feature for feature, df in document_frequency.most_common(max_features) if df >= min_df]
+        self.vocabulary = {feature: index for index, feature in enumerate(sorted(kept))}
+        total = len(texts)
+        self.idf = [0.0] * len(self.vocabulary)
+        for feature, index in self.vocabulary.items():
+            self.idf[index] = math.log((1 + total) / (1 + document_frequency[feature])) + 1
+        return self
+
+    def transform(self, text):
+        """ 返回稀疏向量 {index: weight}（亚线性 tf * idf，L2 归一化） """
+        vector = {}
+        for feature, count in extract_features(text).items():
+            index = self.vocabulary.get(feature)
+            if index is not None:
+                vector[index] = (1 + math.log(count)) * self.idf[index]
+        norm = math.sqrt(sum(value * value for value in vector.values()))
+        if norm > 0:
+            for index in vector:
+                vector[index] /= norm
+        return vector
+
+
+def softmax(scores):
+    top = max(scores)
+    exps = [math.exp(score - top) for score in scores]
+    total = sum(exps)
+    return [value / total for value in exps]
+
+
+class LinearModel:
+    """ 多分类 logistic 回归：weights[label][feature] 为稀疏字典，只保存非零权重 """
+    def __init__(self, labels, weights=None, bias=None):
+        self.labels = list(labels)
+        self.weights = weights or [{} for _ in self.labels]
+        self.bias = bias or [0.0] * len(self.labels)
+
+    def predict_proba(self, vector):
+        scores = [
+            self.bias[k] + sum(weights.get(index, 0.0) * value for index, value in vector.items())
+            for k, weights in enumerate(self.weights)
+        ]
+        return softmax(scores)
+
+    def fit(self, vectors, targets, epochs=30, learning_rate=0.5, l2=1e-4, seed=0):
+        """ SGD 训练；targets 为标签下标，按类别频率加权平衡 """
+        rng = random.Random(seed)
+        counts = Counter(targets)
+        class_weight = {k: len(targets) / (len(counts) * counts[k]) for k in counts}
+        order = list(range(len(vectors)))
+        self.weights = [{} for _ in self.labels]
+        self.bias = [0.0] * len(self.labels)
+        for epoch in range(epochs):
+            rng.shuffle(order)
+            rate = learning_rate / (1 + epoch * 0.2)
+            for i in order:
+                vector, target = vectors[i], targets[i]
+                probabilities = self.predict_proba(vector)
+                for k, weights in enumerate(self.weights):
+                    gradient = (probabilities[k] - (1.0 if k == target else 0.0)) * class_weight[target]
+                    for index, value in vector.items():
+                        current = weights.get(index, 0.0)
+                        weights[index] = current - rate * (gradient * value + l2 * current)
+                    self.bias[k] -= rate * gradient
+        self.weights = [{index: w for index, w in weights.items() if abs(w) > 1e-6} for weights in self.weights]
+        return self
+
+
+class IntentDecision:
+    """ action: reject(拦截) / accept(确定属于领域内) / defer(不确定，交给大模型) / disabled(未加载模型) """
+    def __init__(self, action, label=None, confidence=0.0, domain_label=None, probabilities=None, elapsed=0.0):
+        self.action = action
+        self.label = label
+        self.confidence = confidence
+        # 领域内两类中概率较高者，用于自动选择翻译方向（不确定时也给出最可能的方向）
+        self.domain_label = domain_label
+        self.probabilities = probabilities or {}
+        self.elapsed = elapsed
+
+    @property
+    def rejected(self):
+        return self.action == "reject"
+
+    def to_dict(self):
+        return {
+            "action": self.action,
+            "label": self.label,
+            "confidence": round(self.confidence, 4),
+            "domain_label": self.domain_label,
+            "elapsed_ms": round(self.elapsed * 1000, 3),
+        }
+
+
+class IntentClassifier:
+    def __init__(self, vectorizer=None, model=None, threshold=0.85, metadata=None):
+        self.vectorizer = vectorizer
+        self.model = model
+        self.threshold = threshold
+        self.metadata = metadata or {}
+        self.log_path = ""
+        self._log_lock = threading.Lock()
+        self.decisions = Counter()
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    @property
+    def enabled(self):
+        return self.model is not None
+
+    @classmethod
+    def load(cls, path, threshold=0.85, log_path=""):
+        """ 模型文件不存在时返回未启用的分类器（所有输入交给大模型） """
+        classifier = cls(threshold=threshold)
+        classifier.log_path = log_path
+        if not path or not os.path.isfile(path):
+            if path:
+                print(f"意图识别模型不存在: {path}，已跳过（python -m modules.intent.train_intent 训练）")
+            return classifier
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        classifier.vectorizer = TfidfVectorizer(data["vocabulary"], data["idf"])
+        classifier.model = LinearModel(
+            data["labels"],
+            [{int(index): w for index, w in weights.items()} for weights in data["weights"]],
+            data["bias"]
+        )
+        classifier.metadata = data.get("metadata", {})
+        print(f"意图识别模型已加载: {path}（{len(data['vocabulary'])} 个特征）")
+        return classifier
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({
+                "labels": self.model.labels,
+                "vocabulary": self.vectorizer.vocabulary,
+                "idf": [round(value, 6) for value in self.vectorizer.idf],
+                "weights": [{str(index): round(w, 6) for index, w in weights.items()} for weights in self.model.weights],
+                "bias": self.model.bias,
+                "metadata": self.metadata,
+            }, f, ensure_ascii=False)
+
+    def predict(self, text):
+        """ 返回 {label: probability} """
+        probabilities = self.model.predict_proba(self.vectorizer.transform(text))
+        return dict(zip(self.model.labels, probabilities))
+
+    def decide(self, text, has_history=False):
+        if not self.enabled:
+            return IntentDecision("disabled")
+        start = time.perf_counter()
+        probabilities = self.predict(text)
+        label = max(probabilities, key=probabilities.get)
+        confidence = probabilities[label]
+        domain_label = max(DOMAIN_LABELS, key=lambda name: probabilities.get(name, 0.0))
+        if confidence < self.threshold:
+            action = "defer"
+        elif label == "off_topic":
+            action = "defer" if has_history else "reject"
+        else:
+            action = "accept"
+        elapsed = time.perf_counter() - start
+
+        self.decisions[action] += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        return IntentDecision(action, label, confidence, domain_label, probabilities, elapsed)
+
+    def log_traffic(self, question, role, answer, decision, has_history=False, entry=""):
+        """ 记录真实流量（INTENT_LOG_PATH），供 train_intent 以大模型的判断结果作为弱标注重新训练 """
+        if not self.log_path or not question:
+            return
+        record = {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "entry": entry,
+            "question": question,
+            "role": role,
+            "answer": answer,
+            "has_history": has_history,
+            "intent": decision.to_dict() if decision is not None else None,
+        }
+        try:
+            with self._log_lock:
+                os.makedirs(os.path.dirname(os.path.abspath(self.log_path)), exist_ok=True)
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"意图识别流量记录失败: {e}")
+
+    async def alog_traffic(self, question, role, answer, decision, has_history=False, entry=""):
+        """ 在线程池中写入流量记录，不阻塞事件循环 """
+        if not self.log_path or not question:
+            return
+        await asyncio.to_thread(self.log_traffic, question, role, answer, decision, has_history, entry)
+
+    def stats(self):
+        total = sum(self.decisions.values())
+        return {
+            "enabled": self.enabled,
+            "threshold": self.threshold,
+            "decisions": dict(self.decisions),
+            "avg_ms": round(self.total_time / total * 1000, 4) if total else 0.0,
+            "max_ms": round(self.max_time * 1000, 4),
+            "trained_at": self.metadata.get("trained_at"),
+            "samples": self.metadata.get("samples"),
+        }
@@ -0,0 +1,187 @@
+import argparse
+import json
+import os
+import random
+import time
+from collections import Counter
+from dotenv import load_dotenv
+
+from modules.intent.classifier import IntentClassifier, LABELS, LinearModel, TfidfVectorizer
+
+
+"""
+训练意图识别模型
+    - 种子数据：modules/intent/seed_intents.jsonl，每行 {"text": ..., "label": off_topic / business / technical}
+    - 线上流量：INTENT_LOG_PATH 记录的请求，用大模型的实际判断作为弱标注：
+        回复中出现“场景 B”的固定话术 -> off_topic；否则 to_dev 请求 -> business，to_product / to_prod 请求 -> technical
+      跳过带历史的追问、出错的回复，以及被分类器直接拦截、没有经过大模型的请求
+先按 eval_ratio 留出验证集评估（准确率、各类精确率 / 召回率、不同阈值下的拦截覆盖率与误拦率），再用全部数据训练并保存。
+用法: python -m modules.intent.train_intent --traffic logs/intent_traffic.jsonl --output modules/checkpoints/intent_classifier.json
+"""
+
+
+# 提示词中“场景 B”固定话术的关键片段（见 prompt_map.dev_refusal / prod_refusal）
+REFUSAL_MARKERS = ["作为研发转译专家", "我是产品价值转译专家"]
+ROLE_LABELS = {"to_dev": "business", "to_product": "technical", "to_prod": "technical"}
+SEED_PATH = os.path.join(os.path.dirname(__file__), "seed_intents.jsonl")
+
+load_dotenv()
+
+
+def read_jsonl(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def label_traffic(record):
+    """ 线上流量的弱标注，无法标注时返回 None """
+    answer = record.get("answer") or ""
+    intent = record.get("intent") or {}
+    if record.get("has_history") or not answer or answer.startswith("❌") or intent.get("action") == "reject":
+        return None
+    if any(marker in answer for marker in REFUSAL_MARKERS):
+        return "off_topic"
+    return ROLE_LABELS.get(record.get("role"))
+
+
+def load_samples(seed_path, traffic_paths):
+    """ 返回 [(text, label)]，同一问题以最后一次出现的标注为准 """
+    samples = {}
+    sources = Counter()
+    if seed_path:
+        for record in read_jsonl(seed_path):
+            if record.get("label") in LABELS and record.get("text"):
+                samples[record["text"]] = record["label"]
+                sources["seed"] += 1
+    for path in traffic_paths:
+        for record in read_jsonl(path):
+            label = label_traffic(record)
+            if label is not None:
+                samples[record["question"]] = label
+                sources["traffic"] += 1
+            else:
+                sources["traffic_skipped"] += 1
+    return list(samples.items()), dict(sources)
+
+
+def fit(samples, args):
+    vectorizer = TfidfVectorizer().fit([text for text, _ in samples], min_df=args.min_df, max_features=args.max_features)
+    model = LinearModel(LABELS).fit(
+        [vectorizer.transform(text) for text, _ in samples],
+        [LABELS.index(label) for _, label in samples],
+        epochs=args.epochs,
+        learning_rate=args.learning_rate,
+        l2=args.l2,
+        seed=args.seed
+    )
+    return IntentClassifier(vectorizer, model, threshold=args.threshold)
+
+
+def evaluate(classifier, samples, thresholds):
+    """ 验证集上的准确率、各类精确率 / 召回率，以及各阈值下的拦截效果 """
+    predictions = []
+    start = time.perf_counter()
+    for text, label in samples:
+        probabilities = classifier.predict(text)
+        predicted = max(probabilities, key=probabilities.get)
+        predictions.append((label, predicted, probabilities[predicted]))
+    elapsed = time.perf_counter() - start
+
+    per_label = {}
+    for name in LABELS:
+        tp = sum(1 for label, predicted, _ in predictions if label == name and predicted == name)
+        predicted_count = sum(1 for _, predicted, _ in predictions if predicted == name)
+        actual_count = sum(1 for label, _, _ in predictions if label == name)
+        per_label[name] = {
+            "precision": round(tp / predicted_count, 3) if predicted_count else None,
+            "recall": round(tp / actual_count, 3) if actual_count else None,
+            "support": actual_count,
+        }
+
+    # 拦截只作用于置信度达到阈值的 off_topic 预测：误拦（领域内输入被拦截）的代价远高于多调用一次大模型
+    in_domain = sum(1 for label, _, _ in predictions if label != "off_topic")
+    off_topic = len(predictions) - in_domain
+    sweep = []
+    for threshold in thresholds:
+        rejected = [(label, confidence) for label, predicted, confidence in predictions if predicted == "off_topic" and confidence >= threshold]
+        wrong = sum(1 for label, _ in rejected if label != "off_topic")
+        sweep.append({
+            "threshold": threshold,
+            "off_topic_caught": round((len(rejected) - wrong) / off_topic, 3) if off_topic else None,
+            "in_domain_rejected": round(wrong / in_domain, 3) if in_domain else None,
+        })
+
+    return {
+        "samples": len(predictions),
+        "accuracy": round(sum(1 for label, predicted, _ in predictions if label == predicted) / len(predictions), 3) if predictions else None,
+        "labels": per_label,
+        "avg_predict_ms": round(elapsed / max(len(predictions), 1) * 1000, 4),
+        "threshold_sweep": sweep,
+    }
+
+
+def split(samples, eval_ratio, seed):
+    """ 按类别分层留出验证集 """
+    rng = random.Random(seed)
+    train, held_out = [], []
+    for name in LABELS:
+        group = [sample for sample in samples if sample[1] == name]
+        rng.shuffle(group)
+        count = int(round(len(group) * eval_ratio))
+        held_out += group[:count]
+        train += group[count:]
+    return train, held_out
+
+
+def cli_default_args():
+    parser = argparse.ArgumentParser(description="训练意图识别模型")
+    parser.add_argument("--seed_data", type=str, default=SEED_PATH, help="种子标注数据，为空则只用线上流量")
+    parser.add_argument("--traffic", type=str, default=os.getenv("INTENT_LOG_PATH", ""), help="线上流量记录（INTENT_LOG_PATH），多个以逗号分隔")
+    parser.add_argument("--output", type=str, default=os.getenv("INTENT_MODEL_PATH", "modules/checkpoints/intent_classifier.json"))
+    parser.add_argument("--threshold", type=float, default=float(os.getenv("INTENT_THRESHOLD", 0.85)), help="评估报告中标注的当前阈值")
+    parser.add_argument("--eval_ratio", type=float, default=0.2, help="留出验证集比例，0 表示不评估")
+    parser.add_argument("--epochs", type=int, default=30)
+    parser.add_argument("--learning_rate", type=float, default=0.5)
+    parser.add_argument("--l2", type=float, default=1e-4)
+    parser.add_argument("--min_df", type=int, default=1, help="特征至少出现在多少条样本中")
+    parser.add_argument("--max_features", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report", type=str, default="", help="评估结果另存为 JSON 文件")
+    return parser.parse_args()
+
+
+def main():
+    args = cli_default_args()
+    traffic_paths = [path.strip() for path in args.traffic.split(",") if path.strip() and os.path.isfile(path.strip())]
+    samples, sources = load_samples(args.seed_data, traffic_paths)
+    counts = Counter(label for _, label in samples)
+    print(f"样本: {len(samples)} {dict(counts)}，来源: {sources}")
+    if len(counts) < len(LABELS):
+        raise SystemExit(f"每个类别至少需要一条样本: {dict(counts)}")
+
+    report = {"sources": sources, "label_counts": dict(counts)}
+    if args.eval_ratio > 0:
+        train, held_out = split(samples, args.eval_ratio, args.seed)
+        report["eval"] = evaluate(fit(train, args), held_out, [0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95])
+        print(json.dumps(report["eval"], ensure_ascii=False, indent=2))
+
+    classifier = fit(samples, args)
+    classifier.metadata = {
+        "trained_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "samples": dict(counts),
+        "sources": sources,
+        "eval": report.get("eval"),
+    }
+    classifier.save(args.output)
+    print(f"意图识别模型已保存: {args.output}（{len(classifier.vectorizer.vocabulary)} 个特征）")
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
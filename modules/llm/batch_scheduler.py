@@ -0,0 +1,467 @@
+import threading
+import queue
+import time
+import torch
+from transformers import (
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from modules.utils.cancellation import cancellation_stats
+from modules.llm.kv_cache import (
+    to_legacy_cache,
+    from_legacy_cache,
+    cache_seq_len,
+    pad_cache_left,
+    concat_cache_batch,
+    select_cache_batch,
+    trim_cache_left,
+    CachedPrefix,
+)
+
+
+def end_streamer(streamer, error=None):
+    """
+    结束流式输出；出错时先把异常对象放入 streamer 再结束，
+    消费方（LocalModelChat.astream、副本进程）据此判定本次回复失败，而不是把截断的回复当作正常结束
+    """
+    if error is not None:
+        streamer.on_finalized_text(error)
+    streamer.end()
+
+
+class GenerationRequest:
+    """
+    调度器中的单个生成请求（对应运行 batch 中的一条序列）
+    """
+    def __init__(
+            self,
+            input_ids,
+            max_new_tokens=512,
+            temperature=0.7,
+            top_p=0.9,
+            top_k=0,
+            repetition_penalty=1.0,
+            eos_token_ids=None,
+            streamer=None,
+            prefix=None,
+            cache_callback=None,
+            cancel_token=None,
+            profile=None
+    ):
+        self.input_ids = list(input_ids)
+        # 可选：已缓存的前缀（CachedPrefix），prefill 只需计算剩余部分
+        self.prefix = prefix if prefix is not None and prefix.matches(self.input_ids) else None
+        # 可选：正常结束时回调本序列完整的 KV cache（CachedPrefix），用于多轮会话复用
+        self.cache_callback = cache_callback
+        # 可选：取消令牌，置位后在下一个解码步移出 batch
+        self.cancel_token = cancel_token
+        # 可选：性能剖析采集（ProfileCapture），在调度线程上随本请求开始 / 结束
+        self.profile = profile
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_ids = set(eos_token_ids or [])
+        self.streamer = streamer
+
+        self.logits_processor = self.build_logits_processor(
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            repetition_penalty=repetition_penalty
+        )
+
+        self.generated_ids = []
+        self.next_token = None                      # 已采样、尚未写入 KV cache 的 token
+        self.finish_reason = None
+        self.error = None
+
+        self.enqueue_time = time.time()
+        self.admit_time = None
+        self.first_token_time = None
+        self.finish_time = None
+        self._done = threading.Event()
+
+
+    @staticmethod
+    def build_logits_processor(temperature, top_p, top_k, repetition_penalty):
+        """ 与 model.generate 的采样链保持一致 """
+        processors = LogitsProcessorList()
+        if repetition_penalty and repetition_penalty != 1.0:
+            processors.append(RepetitionPenaltyLogitsProcessor(penalty=repetition_penalty))
+        if temperature and temperature != 1.0:
+            processors.append(TemperatureLogitsWarper(temperature))
+        if top_k and top_k > 0:
+            processors.append(TopKLogitsWarper(top_k=top_k, min_tokens_to_keep=1))
+        if top_p and top_p < 1.0:
+            processors.append(TopPLogitsWarper(top_p=top_p, min_tokens_to_keep=1))
+        return processors
+
+
+    @property
+    def finished(self):
+        return self._done.is_set()
+
+
+    @property
+    def cancelled(self):
+        return self.cancel_token is not None and self.cancel_token.cancelled
+
+
+    def sample(self, logits):
+        """ 对单条序列最后位置的 logits 进行采样 """
+        seq_ids = torch.tensor(
+            [self.input_ids + self.generated_ids],
+            device=logits.device
+        )
+        scores = self.logits_processor(seq_ids, logits.unsqueeze(0).float())
+        probs = torch.softmax(scores, dim=-1)
+        return int(torch.multinomial(probs, num_samples=1)[0, 0])
+
+
+    def accept_token(self, token_id):
+        """ 处理新采样的 token，返回序列是否仍需继续解码 """
+        if token_id in self.eos_token_ids:
+            self.finish("stop")
+            return False
+
+        if self.first_token_time is None:
+            self.first_token_time = time.time()
+
+        self.generated_ids.append(token_id)
+        if self.streamer is not None:
+            self.streamer.put(torch.tensor([token_id]))
+
+        if len(self.generated_ids) >= self.max_new_tokens:
+            self.finish("length")
+            return False
+
+        self.next_token = token_id
+        return True
+
+
+    def cancel(self):
+        """ 因取消而结束，并记录节省的 token 数 """
+        if self._done.is_set():
+            return
+        cancellation_stats.record(
+            "local",
+            tokens_generated=len(self.generated_ids),
+            tokens_saved=self.max_new_tokens - len(self.generated_ids)
+        )
+        self.finish("cancelled")
+
+
+    def finish(self, reason, error=None):
+        if self._done.is_set():
+            return
+        self.finish_reason = reason
+        self.error = error
+        self.finish_time = time.time()
+        if self.profile is not None and not self.profile.started:
+            # 未进入 batch 就结束（取消 / 调度器停止），放弃采集
+            self.profile.stop()
+        if self.streamer is not None:
+            end_streamer(self.streamer, error)
+        self._done.set()
+
+
+    def wait(self, timeout=None):
+        """ 阻塞等待生成完成（非流式调用） """
+        self._done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.generated_ids
+
+
+
+class ContinuousBatchScheduler:
+    """
+    连续批处理调度器：
+    后台线程维护一个共享的运行 batch，每个解码步之前把排队请求 prefill 后并入 batch，
+    序列结束（eos / max_new_tokens）后立即移出，空出的位置在下一步即可被新请求占用。
+    """
+    def __init__(
+            self,
+            model,
+            device,
+            max_batch_size=8
+    ):
+        self.model = model
+        self.device = device
+        self.max_batch_size = max(1, int(max_batch_size))
+
+        self.waiting = queue.Queue()
+        self.running = []
+
+        # 运行 batch 的共享状态（左侧 padding 对齐）
+        self.past_key_values = None
+        self.attention_mask = None
+
+        # 统计信息
+        self.total_steps = 0
+        self.total_batch_tokens = 0
+        self.total_finished = 0
+
+        # 正在采集性能剖析的请求（同一时间最多一个）
+        self.profiled_request = None
+
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+
+    def submit(self, request: GenerationRequest):
+        """ 提交请求，立即返回；结果通过 request.streamer 或 request.wait() 获取 """
+        self._ensure_worker()
+        self.waiting.put(request)
+        self._wakeup.set()
+        return request
+
+
+    def stats(self):
+        """ batch 占用情况 """
+        running = len(self.running)
+        return {
+            "running": running,
+            "waiting": self.waiting.qsize(),
+            "max_batch_size": self.max_batch_size,
+            "occupancy": running / self.max_batch_size,
+            "total_steps": self.total_steps,
+            "avg_batch_size": self.total_batch_tokens / self.total_steps if self.total_steps else 0.0,
+            "total_finished": self.total_finished,
+        }
+
+
+    def stop(self):
+        """ 停止调度线程，未完成的请求全部结束 """
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+        for request in self.running:
+            request.finish("abort", RuntimeError("调度器已停止"))
+        while not self.waiting.empty():
+            self.waiting.get_nowait().finish("abort", RuntimeError("调度器已停止"))
+        self._check_profile()
+        self._reset_batch()
+
+
+    def _ensure_worker(self):
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(
+                    target=self._loop,
+                    name="continuous-batch-scheduler",
+                    daemon=True
+                )
+                self._thread.start()
+
+
+    def _loop(self):
+        with torch.inference_mode():
+            while not self._stop.is_set():
+                try:
+                    self._admit_waiting()
+
+                    if not self.running:
+                        self._wakeup.wait(timeout=1.0)
+                        self._wakeup.clear()
+                        continue
+
+                    self._decode_step()
+                except Exception as e:
+                    # 出错时结束当前 batch 中的所有序列，调度线程继续服务后续请求
+                    print(f"连续批处理调度出错: {e}")
+                    for request in self.running:
+                        request.finish("error", e)
+                    self._reset_batch()
+                finally:
+                    self._check_profile()
+
+    def _check_profile(self):
+        """ 被采集的请求结束后在调度线程上停止采集，并记录结束时的 batch 大小 """
+        request = self.profiled_request
+        if request is not None and request.finished:
+            request.profile.stop(batch_size_at_end=len(self.running), finish_reason=request.finish_reason)
+            self.profiled_request = None
+
+
+    def _reset_batch(self):
+        self.running = []
+        self.past_key_values = None
+        self.attention_mask = None
+
+
+    def _admit_waiting(self):
+        """ token 粒度准入：只要 batch 有空位就把排队请求 prefill 后并入 """
+        while len(self.running) < self.max_batch_size:
+            try:
+                request = self.waiting.get_nowait()
+            except queue.Empty:
+                return
+
+            if request.finished:
+                continue
+            if request.cancelled:
+                request.cancel()
+                continue
+
+            try:
+                self._prefill(request)
+            except Exception as e:
+                print(f"请求 prefill 失败: {e}")
+                request.finish("error", e)
+
+
+    def _prefill(self, request: GenerationRequest):
+        """ 单独 prefill 新请求（命中前缀缓存时只计算剩余部分），采样首个 token 后合并入运行 batch """
+        request.admit_time = time.time()
+        if request.profile is not None and self.profiled_request is None:
+            request.profile.start()
+            self.profiled_request = request
+
+        input_ids = torch.tensor([request.input_ids], device=self.device)
+
+        past_key_values = None
+        prefix_len = 0
+        if request.prefix is not None:
+            prefix_len = len(request.prefix)
+            past_key_values = from_legacy_cache(request.prefix.past_key_values)
+
+        outputs = self.model(
+            input_ids=input_ids[:, prefix_len:],
+            past_key_values=past_key_values,
+            use_cache=True
+        )
+
+        if request.streamer is not None:
+            # 与 generate 保持一致：先放入 prompt，由 skip_prompt 跳过
+            request.streamer.put(input_ids.cpu())
+
+        seq_cache = to_legacy_cache(outputs.past_key_values)
+        seq_mask = torch.ones(1, input_ids.shape[1], dtype=torch.long, device=self.device)
+
+        token_id = request.sample(outputs.logits[0, -1, :])
+        if not request.accept_token(token_id):
+            self.total_finished += 1
+            self._capture_cache(request, seq_cache, seq_mask, 0)
+            return
+
+        self._merge_into_batch(seq_cache, seq_mask)
+        self.running.append(request)
+
+
+    def _merge_into_batch(self, seq_cache, seq_mask):
+        """ 左侧 padding 对齐后沿 batch 维拼接 """
+        if self.past_key_values is None:
+            self.past_key_values = seq_cache
+            self.attention_mask = seq_mask
+            return
+
+        batch_len = cache_seq_len(self.past_key_values)
+        seq_len = cache_seq_len(seq_cache)
+        target_len = max(batch_len, seq_len)
+
+        batch_cache = pad_cache_left(self.past_key_values, target_len - batch_len)
+        seq_cache = pad_cache_left(seq_cache, target_len - seq_len)
+
+        batch_mask = torch.nn.functional.pad(self.attention_mask, (target_len - batch_len, 0), value=0)
+        seq_mask = torch.nn.functional.pad(seq_mask, (target_len - seq_len, 0), value=0)
+
+        self.past_key_values = concat_cache_batch(batch_cache, seq_cache)
+        self.attention_mask = torch.cat([batch_mask, seq_mask], dim=0)
+
+
+    def _decode_step(self):
+        """ 整个运行 batch 前向一步，每条序列独立采样与停止判断 """
+        # 已取消的序列不再参与前向
+        cancelled = [request for request in self.running if request.cancelled]
+        if cancelled:
+            for request in cancelled:
+                request.cancel()
+                self.total_finished += 1
+            self._evict_finished([i for i, request in enumerate(self.running) if not request.finished])
+            if not self.running:
+                return
+
+        batch_size = len(self.running)
+
+        input_ids = torch.tensor(
+            [[request.next_token] for request in self.running],
+            device=self.device
+        )
+        # 每条序列的真实长度即为新 token 的位置
+        position_ids = self.attention_mask.sum(dim=-1, keepdim=True)
+        self.attention_mask = torch.cat(
+            [self.attention_mask, self.attention_mask.new_ones(batch_size, 1)],
+            dim=-1
+        )
+
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=self.attention_mask,
+            position_ids=position_ids,
+            past_key_values=from_legacy_cache(self.past_key_values),
+            use_cache=True
+        )
+        self.past_key_values = to_legacy_cache(outputs.past_key_values)
+
+        self.total_steps += 1
+        self.total_batch_tokens += batch_size
+
+        keep = []
+        logits = outputs.logits[:, -1, :]
+        for index, request in enumerate(self.running):
+            if request.finished:
+                continue
+            token_id = request.sample(logits[index])
+            if request.accept_token(token_id):
+                keep.append(index)
+            else:
+                self.total_finished += 1
+                self._capture_cache(request, self.past_key_values, self.attention_mask, index)
+
+        if len(keep) < batch_size:
+            self._evict_finished(keep)
+
+
+    def _capture_cache(self, request, legacy_cache, attention_mask, row):
+        """ 从运行 batch 中拷贝出结束序列去掉 padding 后的 KV cache，交给回调保存 """
+        if request.cache_callback is None or request.error is not None:
+            return
+        try:
+            cache_len = int(attention_mask[row].sum())
+            pad_len = attention_mask.shape[1] - cache_len
+            seq_cache = tuple(
+                (k[row:row + 1, :, pad_len:, :].clone(), v[row:row + 1, :, pad_len:, :].clone())
+                for k, v in legacy_cache
+            )
+            all_ids = request.input_ids + request.generated_ids
+            request.cache_callback(CachedPrefix(all_ids[:cache_len], seq_cache))
+        except Exception as e:
+            print(f"保存会话 KV cache 失败: {e}")
+
+
+    def _evict_finished(self, keep):
+        """ 移出已结束序列，并裁掉所有剩余序列共有的左侧 padding """
+        if not keep:
+            self._reset_batch()
+            return
+
+        indices = torch.tensor(keep, device=self.device)
+        self.running = [self.running[i] for i in keep]
+        self.past_key_values = select_cache_batch(self.past_key_values, indices)
+        self.attention_mask = self.attention_mask.index_select(0, indices)
+
+        # 每行第一个有效位置的最小值即为可裁剪的公共 padding 长度
+        first_valid = self.attention_mask.argmax(dim=-1)
+        trim_len = int(first_valid.min())
+        if trim_len > 0:
+            self.past_key_values = trim_cache_left(self.past_key_values, trim_len)
+            self.attention_mask = self.attention_mask[:, trim_len:]
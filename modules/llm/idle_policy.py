@@ -0,0 +1,62 @@
+import threading
+from datetime import datetime
+
+
+"""
+本地模型空闲策略：
+    - 超过 idle_timeout 秒无请求时卸载模型（unload）或将权重下放到 CPU（offload，仅 GPU 有效）
+    - prewarm_at 为每天的预热时间点（如 "08:50,13:30"），到点后在后台重新加载
+"""
+
+
+def parse_prewarm_times(prewarm_at):
+    """ "08:50,13:30" -> [(8, 50), (13, 30)] """
+    times = []
+    for item in (prewarm_at or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        hour, minute = item.split(":")
+        times.append((int(hour), int(minute)))
+    return times
+
+
+class IdleUnloadPolicy:
+    """ 后台线程：定期检查空闲时间并卸载，到预热时间点时提前加载 """
+    def __init__(self, engine, idle_timeout, mode="unload", prewarm_at="", check_interval=30.0):
+        self.engine = engine
+        self.idle_timeout = idle_timeout
+        self.mode = mode
+        self.prewarm_times = parse_prewarm_times(prewarm_at)
+        self.check_interval = check_interval
+
+        self._fired = set()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="idle-unload-policy", daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        while not self._stop.wait(self.check_interval):
+            try:
+                self.check()
+            except Exception as e:
+                print(f"空闲策略执行失败: {e}")
+
+    def check(self, now=None):
+        now = now or datetime.now()
+        for hour, minute in self.prewarm_times:
+            key = (now.date(), hour, minute)
+            if key in self._fired:
+                continue
+            if (now.hour, now.minute) >= (hour, minute):
+                self._fired.add(key)
+                # 启动当天已过的时间点不再补触发
+                if (now.hour * 60 + now.minute) - (hour * 60 + minute) <= self.check_interval / 60 + 1:
+                    print(f"到达预热时间 {hour:02d}:{minute:02d}，后台加载本地模型")
+                    self.engine.prewarm()
+
+        if self.idle_timeout > 0:
+            self.engine.maybe_unload(self.idle_timeout, mode=self.mode)
+
+    def stop(self):
+        self._stop.set()
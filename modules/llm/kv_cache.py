@@ -0,0 +1,292 @@
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+import torch
+
+
+""" KV cache 工具：统一 legacy tuple 与 transformers Cache 对象之间的转换, 并提供按 batch / 序列维度的拼接、裁剪 """
+
+
+def to_legacy_cache(past_key_values):
+    """ 转换为 ((k, v), ...) 形式, k/v 形状为 [batch, kv_heads, seq_len, head_dim] """
+    if past_key_values is None:
+        return None
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    if hasattr(past_key_values, "layers"):
+        # 新版 transformers 移除了 to_legacy_cache，直接读取各层的 keys / values
+        return tuple((layer.keys, layer.values) for layer in past_key_values.layers)
+    return tuple((k, v) for k, v in past_key_values)
+
+
+def from_legacy_cache(legacy_cache):
+    """ legacy tuple 转回模型 forward 所需的 DynamicCache """
+    if legacy_cache is None:
+        return None
+    from transformers import DynamicCache
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(legacy_cache)
+    return DynamicCache(legacy_cache)
+
+
+def cache_seq_len(legacy_cache):
+    """ 缓存中的序列长度（含左侧 padding） """
+    if not legacy_cache:
+        return 0
+    return legacy_cache[0][0].shape[2]
+
+
+def pad_cache_left(legacy_cache, pad_len):
+    """ 在序列维度左侧补零，用于对齐不同长度的序列 """
+    if pad_len <= 0:
+        return legacy_cache
+    padded = []
+    for k, v in legacy_cache:
+        k_pad = k.new_zeros(k.shape[0], k.shape[1], pad_len, k.shape[3])
+        v_pad = v.new_zeros(v.shape[0], v.shape[1], pad_len, v.shape[3])
+        padded.append((torch.cat([k_pad, k], dim=2), torch.cat([v_pad, v], dim=2)))
+    return tuple(padded)
+
+
+def concat_cache_batch(cache_a, cache_b):
+    """ 沿 batch 维拼接两个序列长度相同的缓存 """
+    return tuple(
+        (torch.cat([ka, kb], dim=0), torch.cat([va, vb], dim=0))
+        for (ka, va), (kb, vb) in zip(cache_a, cache_b)
+    )
+
+
+def select_cache_batch(legacy_cache, indices):
+    """ 按 batch 下标挑选保留的序列 """
+    return tuple(
+        (k.index_select(0, indices), v.index_select(0, indices))
+        for k, v in legacy_cache
+    )
+
+
+def trim_cache_left(legacy_cache, trim_len):
+    """ 去掉序列维度左侧 trim_len 个位置（通常是所有序列共有的 padding） """
+    if trim_len <= 0:
+        return legacy_cache
+    return tuple(
+        (k[:, :, trim_len:, :].contiguous(), v[:, :, trim_len:, :].contiguous())
+        for k, v in legacy_cache
+    )
+
+
+
+class CachedPrefix:
+    """ 已 prefill 的前缀：token 序列及其 KV cache（只读，使用方不得原地修改） """
+    def __init__(self, input_ids, past_key_values):
+        self.input_ids = list(input_ids)
+        self.past_key_values = past_key_values
+        self.created_at = time.time()
+
+    def __len__(self):
+        return len(self.input_ids)
+
+    def matches(self, input_ids):
+        """ 是否为 input_ids 的严格前缀（至少留一个 token 给 prefill） """
+        prefix_len = len(self.input_ids)
+        return len(input_ids) > prefix_len and list(input_ids[:prefix_len]) == self.input_ids
+
+    def common_prefix_len(self, input_ids):
+        """ 与 input_ids 的最长公共前缀长度（同样至少留一个 token 给 prefill） """
+        limit = min(len(self.input_ids), len(input_ids) - 1)
+        for index in range(max(limit, 0)):
+            if self.input_ids[index] != input_ids[index]:
+                return index
+        return max(limit, 0)
+
+    def truncate(self, length):
+        """ 截取前 length 个位置（切片视图，不复制） """
+        if length >= len(self.input_ids):
+            return self
+        return CachedPrefix(
+            input_ids=self.input_ids[:length],
+            past_key_values=tuple(
+                (k[:, :, :length, :], v[:, :, :length, :])
+                for k, v in self.past_key_values
+            )
+        )
+
+    def to(self, device):
+        return CachedPrefix(
+            input_ids=self.input_ids,
+            past_key_values=tuple(
+                (k.to(device, non_blocking=True), v.to(device, non_blocking=True))
+                for k, v in self.past_key_values
+            )
+        )
+
+    @property
+    def device(self):
+        return self.past_key_values[0][0].device
+
+    @property
+    def nbytes(self):
+        return sum(
+            k.numel() * k.element_size() + v.numel() * v.element_size()
+            for k, v in self.past_key_values
+        )
+
+
+class PrefixKVCache:
+    """
+    系统提示词前缀 KV cache，按 (模型, 提示词哈希) 索引，LRU 限制常驻数量
+    """
+    def __init__(self, max_entries=4):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model_id, prefix_text):
+        return model_id, hashlib.sha256(prefix_text.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry: CachedPrefix):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "prefix_tokens": [len(entry) for entry in self._entries.values()],
+            }
+
+
+
+class SessionKVCache:
+    """
+    会话级多轮 KV cache：按会话 LRU 管理，
+    显存占用超出预算时最久未用的会话下放到 CPU 内存，CPU 侧再超出预算则直接淘汰
+    """
+    def __init__(
+            self,
+            device,
+            max_device_bytes=1 << 30,
+            max_cpu_bytes=4 << 30
+    ):
+        self.device = device
+        self.max_device_bytes = max_device_bytes
+        self.max_cpu_bytes = max_cpu_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.spills = 0
+        self.evictions = 0
+
+    def get(self, session_id):
+        """ 取出会话缓存，若已下放到 CPU 则搬回计算设备 """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.device != torch.device(self.device):
+                entry = entry.to(self.device)
+                self._entries[session_id] = entry
+            self._entries.move_to_end(session_id)
+            self.hits += 1
+            self._enforce_budget()
+            return entry
+
+    def put(self, session_id, entry: CachedPrefix):
+        if self.max_device_bytes <= 0 and self.max_cpu_bytes <= 0:
+            return
+        with self._lock:
+            self._entries[session_id] = entry
+            self._entries.move_to_end(session_id)
+            self._enforce_budget()
+
+    def invalidate(self, session_id):
+        """ 会话历史被清空 / 截断时调用 """
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _usage(self):
+        device_bytes, cpu_bytes = 0, 0
+        for entry in self._entries.values():
+            if entry.device.type == "cpu":
+                cpu_bytes += entry.nbytes
+            else:
+                device_bytes += entry.nbytes
+        return device_bytes, cpu_bytes
+
+    def _enforce_budget(self):
+        device_bytes, cpu_bytes = self._usage()
+        spill_enabled = not str(self.device).startswith("cpu")
+
+        # 1. 显存超预算：从最久未用的会话开始下放到 CPU
+        if spill_enabled:
+            for session_id in list(self._entries.keys()):
+                if device_bytes <= self.max_device_bytes:
+                    break
+                entry = self._entries[session_id]
+                if entry.device.type == "cpu":
+                    continue
+                size = entry.nbytes
+                self._entries[session_id] = entry.to("cpu")
+                device_bytes -= size
+                cpu_bytes += size
+                self.spills += 1
+
+        # 2. CPU 侧超预算（计算设备为 CPU 时两份预算合并）：淘汰最久未用的会话
+        cpu_budget = self.max_cpu_bytes if spill_enabled else self.max_cpu_bytes + self.max_device_bytes
+        for session_id in list(self._entries.keys()):
+            if cpu_bytes <= cpu_budget:
+                break
+            entry = self._entries[session_id]
+            if entry.device.type != "cpu":
+                continue
+            cpu_bytes -= entry.nbytes
+            del self._entries[session_id]
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            device_bytes, cpu_bytes = self._usage()
+            return {
+                "sessions": len(self._entries),
+                "device_bytes": device_bytes,
+                "cpu_bytes": cpu_bytes,
+                "max_device_bytes": self.max_device_bytes,
+                "max_cpu_bytes": self.max_cpu_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "spills": self.spills,
+                "evictions": self.evictions,
+            }
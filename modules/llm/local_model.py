@@ -1,7 +1,55 @@
 from modules.pipelines.files_pipeline import FilesPathPipelines
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from functools import partial
+import asyncio
+from modules.llm.batch_scheduler import ContinuousBatchScheduler, GenerationRequest, end_streamer
+from modules.llm.kv_cache import (
+    CachedPrefix,
+    PrefixKVCache,
+    SessionKVCache,
+    to_legacy_cache,
+    from_legacy_cache,
+    cache_seq_len,
+)
+from modules.llm.model_loader import ModelLoader
+from modules.llm.idle_policy import IdleUnloadPolicy
+from modules.llm.quantization import cpu_mode_dtype
+from modules.llm.speculative import SpeculativeDecoder
+from modules.utils.cancellation import CancellationToken, cancellation_stats
+from modules.utils.metrics import annotate, current_trace, in_context, span
+from modules.utils.profiling import profiler
+from transformers import StoppingCriteria, StoppingCriteriaList
 import torch
 import gc
+import threading
+import time
+
+
+class CancellationStoppingCriteria(StoppingCriteria):
+    """ 取消令牌置位后停止 model.generate """
+    def __init__(self, cancel_token):
+        self.cancel_token = cancel_token
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full(
+            (input_ids.shape[0],),
+            self.cancel_token.cancelled,
+            dtype=torch.bool,
+            device=input_ids.device
+        )
+
+
+class StreamerProbe:
+    """ 记录 model.generate 是否已向 streamer 输出过内容（prompt 或 token） """
+    def __init__(self, streamer):
+        self.streamer = streamer
+        self.used = False
+
+    def put(self, value):
+        self.used = True
+        self.streamer.put(value)
+
+    def end(self):
+        self.streamer.end()
 
 
 class LocalModelChat:
@@ -12,6 +60,19 @@ class LocalModelChat:
             self,
             base_model_name="Qwen2.5-7B-Instruct",
             gpu_index=0,
+            max_batch_size=8,
+            prefix_cache_size=4,
+            session_cache_mb=1024,
+            session_cpu_cache_mb=4096,
+            load_strategy="fast",
+            load_threads=4,
+            idle_timeout=0,
+            idle_mode="unload",
+            prewarm_at="",
+            cpu_mode="fp32",
+            draft_model_name="",
+            draft_lookahead=5,
+            draft_min_acceptance=0.3,
     ):
         self.file_client = FilesPathPipelines()
 
@@ -19,6 +80,7 @@ class LocalModelChat:
             base_model_name=base_model_name
         )
 
+        self.cpu_mode = cpu_mode
         self.device, self.compute_dtype,self.load_in_4bit = self.check_resource(gpu_index=gpu_index)
 
 
@@ -27,17 +89,81 @@ class LocalModelChat:
         self.max_new_tokens = 512                           # 增加 max_new_tokens 以允许更长的回复
         self.repetition_penalty = 1.1                       # 稍高一点的重复惩罚通常效果更好
 
+        # 连续批处理：max_batch_size <= 1 时退回逐请求 model.generate
+        self.max_batch_size = max_batch_size
+        self.scheduler = None
+
+        # 系统提示词前缀 KV cache：跳过长 system prompt 的重复 prefill
+        self.prefix_cache = PrefixKVCache(max_entries=prefix_cache_size)
+        self.registered_prompts = []
+
+        # 会话级多轮 KV cache：下一轮只需 prefill 新增的用户消息
+        self.session_cache = SessionKVCache(
+            device=self.device,
+            max_device_bytes=session_cache_mb * 1024 * 1024,
+            max_cpu_bytes=session_cpu_cache_mb * 1024 * 1024
+        )
+
+        # 模型加载器：内存映射 + 直接落到目标设备，保留配置与分词器供重新加载复用
+        self.loader = ModelLoader(
+            self.base_model_path,
+            device=self.device,
+            dtype=self.compute_dtype,
+            strategy=load_strategy,
+            num_threads=load_threads,
+            quantize="int8" if self.device == "cpu" and cpu_mode == "int8" else None
+        )
+
+        # 常驻状态：resident(已加载) / offloaded(权重暂存 CPU) / unloaded(已释放) / loading(加载中)
+        self.residency = "loading"
+        self._residency_lock = threading.RLock()
+        self._prewarm_thread = None
+        self.active_requests = 0
+        self.last_used = time.time()
+        self.unload_count = 0
+        self.reload_count = 0
+        self.last_reload_latency = None
+        self.total_reload_latency = 0.0
+
         # 加载基础模型
         self.model, self.model_tokenizer = self.load_models(
             self.base_model_path
         )
+        self.scheduler = self.build_scheduler()
+
+        # 投机解码：可选的同系列小草稿模型（须与主模型共用分词器）
+        self.speculative = None
+        if draft_model_name:
+            self.speculative = SpeculativeDecoder(
+                ModelLoader(
+                    self.file_client.get_base_model_path(base_model_name=draft_model_name),
+                    device=self.device,
+                    dtype=self.compute_dtype,
+                    strategy=load_strategy,
+                    num_threads=load_threads
+                ),
+                lookahead=draft_lookahead,
+                min_acceptance=draft_min_acceptance
+            )
+            self.speculative.ensure_loaded()
+        self.residency = "resident"
+
+        # 空闲策略：idle_timeout 秒无请求后卸载 / 下放，<=0 时关闭
+        self.idle_policy = None
+        if idle_timeout > 0 or prewarm_at:
+            self.idle_policy = IdleUnloadPolicy(
+                self,
+                idle_timeout=idle_timeout,
+                mode=idle_mode,
+                prewarm_at=prewarm_at
+            )
 
 
     def check_resource(self, gpu_index=0):
         """ 确认计算资源 """
 
-        # 1. 动态确定设备和数据类型
-        if torch.cuda.is_available():
+        # 1. 动态确定设备和数据类型（gpu_index < 0 时强制使用 CPU，如 CPU 工作进程副本）
+        if torch.cuda.is_available() and gpu_index >= 0:
             device = f"cuda:{gpu_index}"
             compute_dtype = torch.float16  # GPU通常支持FP16以节省显存和加速
             # 启用4位量化（如果需要）
@@ -45,9 +171,10 @@ class LocalModelChat:
             print(f"GPU (CUDA) is available. Using device: {device}, compute_dtype: {compute_dtype}, load_in_4bit: {load_in_4bit}")
         else:
             device = "cpu"
-            compute_dtype = torch.float32  # CPU通常使用FP32以保持精度
+            # CPU 推理模式：fp32(默认，精度最高) / bf16 / int8(线性层动态量化，见 modules/llm/quantization.py)
+            compute_dtype = cpu_mode_dtype(self.cpu_mode)
             load_in_4bit = False # CPU上通常不使用4位量化，或者效果不明显
-            print(f"GPU (CUDA) is not available. Using device: {device}, compute_dtype: {compute_dtype}, load_in_4bit: {load_in_4bit}")
+            print(f"GPU (CUDA) is not available. Using device: {device}, compute_dtype: {compute_dtype}, cpu_mode: {self.cpu_mode}")
         return device, compute_dtype,load_in_4bit
 
 
@@ -56,25 +183,124 @@ class LocalModelChat:
             base_model_path,
             **kwargs
     ):
-        """ 加载基础模型  """
+        """ 加载基础模型，各阶段耗时与峰值 RSS 见 load_stats """
+        if base_model_path != self.loader.model_path:
+            self.loader = ModelLoader(
+                base_model_path,
+                device=self.device,
+                dtype=self.compute_dtype,
+                strategy=self.loader.strategy,
+                num_threads=self.loader.num_threads,
+                quantize=self.loader.quantize
+            )
+        return self.loader.load()
 
-        base_model = AutoModelForCausalLM.from_pretrained(
-            base_model_path,
-            torch_dtype=self.compute_dtype,
-            # device_map="auto"
-            # trust_remote_code=True
+
+    def load_stats(self):
+        """ 最近一次加载的分阶段耗时与峰值 RSS """
+        return self.loader.stats()
+
+
+    def build_scheduler(self):
+        """ 构建连续批处理调度器 """
+        if not self.max_batch_size or self.max_batch_size <= 1:
+            return None
+        return ContinuousBatchScheduler(
+            model=self.model,
+            device=self.device,
+            max_batch_size=self.max_batch_size
         )
 
-        if str(self.device).lower().startswith("cuda") or str(self.device).lower().startswith("gpu") :
-            base_model.to(self.device)
 
-        # 加载分词器（必须使用Qwen专用设置）
-        tokenizer = AutoTokenizer.from_pretrained(
-            base_model_path,
-            # trust_remote_code=True
+    def sampling_params(self):
+        """ 采样参数：显式设置优先，其余沿用模型 generation_config（与 model.generate 行为一致） """
+        generation_config = self.model.generation_config
+        eos_token_ids = generation_config.eos_token_id
+        if eos_token_ids is None:
+            eos_token_ids = []
+        elif isinstance(eos_token_ids, int):
+            eos_token_ids = [eos_token_ids]
+        eos_token_ids = set(eos_token_ids)
+        if self.model_tokenizer.eos_token_id is not None:
+            eos_token_ids.add(self.model_tokenizer.eos_token_id)
+
+        return {
+            "max_new_tokens": self.max_new_tokens,
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "top_k": generation_config.top_k or 0,
+            "repetition_penalty": generation_config.repetition_penalty or 1.0,
+            "eos_token_ids": eos_token_ids,
+        }
+
+
+    def register_system_prompts(self, sys_prompts):
+        """ 登记常用系统提示词并预先计算其前缀 KV cache """
+        for sys_prompt in sys_prompts:
+            if sys_prompt and sys_prompt not in self.registered_prompts:
+                self.registered_prompts.append(sys_prompt)
+            self.get_prefix(sys_prompt)
+
+
+    def get_prefix(self, sys_prompt):
+        """ 获取系统提示词前缀的 KV cache，未命中时 prefill 并写入 LRU 缓存 """
+        if not sys_prompt or self.prefix_cache.max_entries <= 0:
+            return None
+
+        prefix_text = self.model_tokenizer.apply_chat_template(
+            [{"role": "system", "content": sys_prompt}],
+            tokenize=False,
+            add_generation_prompt=False
         )
+        key = self.prefix_cache.make_key(self.base_model_path, prefix_text)
+
+        prefix = self.prefix_cache.get(key)
+        if prefix is None:
+            input_ids = self.model_tokenizer(
+                prefix_text,
+                return_tensors="pt"
+            )["input_ids"].to(self.device)
+
+            with torch.inference_mode():
+                outputs = self.model(input_ids=input_ids, use_cache=True)
+
+            prefix = CachedPrefix(
+                input_ids=input_ids[0].tolist(),
+                past_key_values=to_legacy_cache(outputs.past_key_values)
+            )
+            self.prefix_cache.put(key, prefix)
+        return prefix
+
 
-        return base_model, tokenizer
+    def select_prefix(self, input_ids, sys_prompt=None, session_id=None):
+        """ 选择可复用的最长已缓存前缀：优先会话上一轮的 KV cache，其次系统提示词前缀 """
+        prefix = self.get_prefix(sys_prompt)
+        if prefix is not None and not prefix.matches(input_ids):
+            prefix = None
+
+        if session_id:
+            session_prefix = self.session_cache.get(session_id)
+            if session_prefix is not None:
+                common_len = session_prefix.common_prefix_len(input_ids)
+                if common_len > (len(prefix) if prefix is not None else 0):
+                    return session_prefix.truncate(common_len)
+                # 历史被清空 / 截断或切换了角色，旧缓存已无复用价值
+                self.session_cache.invalidate(session_id)
+
+        return prefix
+
+
+    def invalidate_session(self, session_id):
+        """ 会话历史被清空或截断时，丢弃该会话的 KV cache """
+        if session_id:
+            self.session_cache.invalidate(session_id)
+
+
+    def batch_stats(self):
+        """ 连续批处理的 batch 占用情况 """
+        if self.scheduler is None:
+            return {"enabled": False}
+        return {"enabled": True, **self.scheduler.stats()}
 
 
     def generate_response(
@@ -82,7 +308,10 @@ class LocalModelChat:
             user_query,
             history=None,
             sys_prompt=None,
-            stream=False  # 新增流式输出开关
+            stream=False,  # 新增流式输出开关
+            streamer=None,  # 可选：外部传入的流式输出器（如异步队列 streamer）
+            session_id=None,  # 可选：会话 id，用于复用上一轮对话的 KV cache
+            cancel_token=None  # 可选：取消令牌，客户端断开后提前停止生成
 
     ):
         """生成符合角色设定的响应"""
@@ -111,24 +340,64 @@ class LocalModelChat:
             }
         )
 
-        if self.model is None or self.model_tokenizer is None:
-            # 模型已释放，需要重新加载
-            self.model, self.model_tokenizer = self.load_models(
-                self.base_model_path
-            )
+        self.ensure_loaded()
 
         # 应用Qwen1.5的对话模板（与训练时一致）
-        text = self.model_tokenizer.apply_chat_template(
-            messages,
-            tokenize=False,
-            add_generation_prompt=True
+        with span("apply_chat_template"):
+            text = self.model_tokenizer.apply_chat_template(
+                messages,
+                tokenize=False,
+                add_generation_prompt=True
+            )
+
+        with span("tokenize"):
+            inputs = self.model_tokenizer(
+                text,
+                return_tensors="pt"
+            )
+
+        # 命中会话 / 系统提示词前缀缓存时，只需 prefill 未缓存的部分
+        with span("prefix_lookup"):
+            prefix = self.select_prefix(
+                inputs["input_ids"][0].tolist(),
+                sys_prompt=sys_prompt,
+                session_id=session_id
+            )
+        annotate(
+            prompt_tokens=inputs["input_ids"].shape[1],
+            cached_prompt_tokens=len(prefix.input_ids) if prefix is not None else 0
         )
 
-        inputs = self.model_tokenizer(
-            text,
-            return_tensors="pt"
+        # 投机解码只支持单序列生成：batch 空闲时使用，繁忙时交给连续批处理
+        speculative = self.use_speculative()
+        if speculative:
+            # 草稿模型没有对应的前缀 KV cache，完整 prefill
+            prefix = None
+
+        # 管理员开启性能剖析时，本请求的生成过程在执行线程上采集
+        trace = current_trace()
+        profile = profiler.claim(
+            engine="local",
+            role=trace.attributes.get("role") if trace is not None else None,
+            prompt_tokens=inputs["input_ids"].shape[1],
+            cached_prompt_tokens=len(prefix) if prefix is not None else 0,
+            batch_size=self.scheduler.stats()["running"] + 1 if self.scheduler is not None and not speculative else 1,
+            speculative=speculative,
+            device=str(self.device)
         )
 
+        # ===== 连续批处理模式：请求进入共享 batch，按 token 粒度调度 =====
+        if self.scheduler is not None and not speculative:
+            return self.generate_with_scheduler(
+                inputs["input_ids"][0].tolist(),
+                stream=stream,
+                streamer=streamer,
+                prefix=prefix,
+                session_id=session_id,
+                cancel_token=cancel_token,
+                profile=profile
+            )
+
         # 将输入数据移动到正确的设备
         inputs = {
             k: v.to(self.device) for k, v in inputs.items()
@@ -140,13 +409,14 @@ class LocalModelChat:
             from threading import Thread
 
             # 创建流式输出器 - 设置为实时输出
-            streamer = TextIteratorStreamer(
-                self.model_tokenizer,
-                skip_prompt=True,
-                skip_special_tokens=True,
-                timeout=60.0,  # 设置超时时间
-                clean_up_tokenization_spaces=True  # 清理空格
-            )
+            if streamer is None:
+                streamer = TextIteratorStreamer(
+                    self.model_tokenizer,
+                    skip_prompt=True,
+                    skip_special_tokens=True,
+                    timeout=60.0,  # 设置超时时间
+                    clean_up_tokenization_spaces=True  # 清理空格
+                )
 
             # 在独立线程中运行生成过程
             generation_kwargs = dict(
@@ -157,13 +427,14 @@ class LocalModelChat:
                 top_p=self.top_p,
                 do_sample=True,
                 eos_token_id=self.model_tokenizer.eos_token_id,
-                pad_token_id=self.model_tokenizer.pad_token_id
+                pad_token_id=self.model_tokenizer.pad_token_id,
+                past_key_values=self.prefix_past(prefix)
             )
 
             # 启动生成线程
             thread = Thread(
-                target=self.model.generate,
-                kwargs=generation_kwargs
+                target=self.run_generate_streaming,
+                kwargs=dict(session_id=session_id, cancel_token=cancel_token, speculative=speculative, profile=profile, **generation_kwargs)
             )
 
             thread.start()
@@ -174,19 +445,25 @@ class LocalModelChat:
         else:
             # 生成响应
             with torch.no_grad():
-                outputs = self.model.generate(
+                outputs = self.run_generate(
+                    session_id=session_id,
+                    cancel_token=cancel_token,
+                    speculative=speculative,
+                    profile=profile,
                     **inputs,
                     max_new_tokens=self.max_new_tokens,
                     temperature=self.temperature,
                     top_p=self.top_p,
                     do_sample=True,
                     eos_token_id=self.model_tokenizer.eos_token_id,
-                    pad_token_id=self.model_tokenizer.pad_token_id
+                    pad_token_id=self.model_tokenizer.pad_token_id,
+                    past_key_values=self.prefix_past(prefix)
                 )
 
 
             # 获取输入ID的长度
             input_length = inputs['input_ids'].shape[1]
+            annotate(completion_tokens=outputs.shape[1] - input_length)
 
             # 解码并提取助手响应
             response = self.model_tokenizer.decode(
@@ -196,11 +473,392 @@ class LocalModelChat:
             return response
 
 
+    def run_generate_streaming(self, **generation_kwargs):
+        """ 流式生成线程：出错时以错误结束 streamer，消费方不必等到超时 """
+        try:
+            self.run_generate(**generation_kwargs)
+        except Exception as e:
+            print(f"本地生成出错: {e}")
+            end_streamer(generation_kwargs["streamer"], e)
+
+
+    def run_generate(self, session_id=None, cancel_token=None, speculative=False, profile=None, **generation_kwargs):
+        """ 执行 model.generate；带会话 id 时保存生成结束后的 KV cache 供下一轮复用 """
+        if profile is None:
+            return self._run_generate(session_id, cancel_token, speculative, **generation_kwargs)
+        profile.start()
+        try:
+            outputs = self._run_generate(session_id, cancel_token, speculative, **generation_kwargs)
+            profile.tags["completion_tokens"] = outputs.shape[1] - generation_kwargs["input_ids"].shape[1]
+            return outputs
+        finally:
+            profile.stop()
+
+
+    def _run_generate(self, session_id=None, cancel_token=None, speculative=False, **generation_kwargs):
+        if cancel_token is not None:
+            generation_kwargs["stopping_criteria"] = StoppingCriteriaList([
+                CancellationStoppingCriteria(cancel_token)
+            ])
+
+        outputs = None
+        if speculative:
+            probe = None
+            if generation_kwargs.get("streamer") is not None:
+                probe = generation_kwargs["streamer"] = StreamerProbe(generation_kwargs["streamer"])
+            try:
+                with torch.no_grad(), self.speculative.track(self.model) as counter:
+                    outputs = self.model.generate(
+                        return_dict_in_generate=True,
+                        **generation_kwargs,
+                        **self.speculative.generation_kwargs()
+                    )
+                self.speculative.record(
+                    new_tokens=outputs.sequences.shape[1] - generation_kwargs["input_ids"].shape[1],
+                    target_steps=counter["steps"]
+                )
+            except Exception as e:
+                # 草稿模型不兼容等错误：停用投机解码，本次请求改用普通解码
+                self.speculative.fail(e)
+                if probe is not None:
+                    if probe.used:
+                        # 已输出过 prompt / token，不能再向同一个 streamer 重新生成，本次请求以错误结束
+                        raise
+                    generation_kwargs["streamer"] = probe.streamer
+                outputs = None
+
+        if outputs is None:
+            with torch.no_grad():
+                outputs = self.model.generate(
+                    return_dict_in_generate=True,
+                    **generation_kwargs
+                )
+
+        if cancel_token is not None and cancel_token.cancelled:
+            generated = outputs.sequences.shape[1] - generation_kwargs["input_ids"].shape[1]
+            cancellation_stats.record(
+                "local",
+                tokens_generated=generated,
+                tokens_saved=generation_kwargs["max_new_tokens"] - generated
+            )
+            # 回复不完整，不会写入对话历史，也就不保存会话缓存
+            return outputs.sequences
+
+        if session_id and outputs.past_key_values is not None:
+            legacy_cache = to_legacy_cache(outputs.past_key_values)
+            cache_len = cache_seq_len(legacy_cache)
+            self.session_cache.put(
+                session_id,
+                CachedPrefix(outputs.sequences[0][:cache_len].tolist(), legacy_cache)
+            )
+        return outputs.sequences
+
+
+    @staticmethod
+    def prefix_past(prefix):
+        """ 为 model.generate 构造新的 Cache 对象（generate 会在其上追加，不能复用缓存中的对象） """
+        if prefix is None:
+            return None
+        return from_legacy_cache(prefix.past_key_values)
+
+
+    def generate_with_scheduler(
+            self,
+            input_ids,
+            stream=False,
+            streamer=None,
+            prefix=None,
+            session_id=None,
+            cancel_token=None,
+            profile=None
+    ):
+        """ 提交到连续批处理调度器，流式返回与 TextIteratorStreamer 路径一致的迭代器 """
+        if stream and streamer is None:
+            from transformers import TextIteratorStreamer
+            streamer = TextIteratorStreamer(
+                self.model_tokenizer,
+                skip_prompt=True,
+                skip_special_tokens=True,
+                timeout=60.0,
+                clean_up_tokenization_spaces=True
+            )
+
+        request = self.scheduler.submit(
+            GenerationRequest(
+                input_ids=input_ids,
+                streamer=streamer if stream else None,
+                prefix=prefix,
+                cache_callback=partial(self.session_cache.put, session_id) if session_id else None,
+                cancel_token=cancel_token,
+                profile=profile,
+                **self.sampling_params()
+            )
+        )
+
+        if stream:
+            return streamer
+
+        output_ids = request.wait()
+        annotate(completion_tokens=len(output_ids))
+        return self.model_tokenizer.decode(
+            output_ids,
+            skip_special_tokens=True
+        )
+
+
+    def ensure_loaded(self):
+        """ 模型已释放 / 下放时重新加载；并发请求在锁上排队，共享同一次加载 """
+        with self._residency_lock:
+            if self.residency == "resident":
+                return
+
+            start = time.time()
+            previous = self.residency
+            self.residency = "loading"
+            try:
+                if previous == "offloaded":
+                    # 权重仍在 CPU 内存中，拷回设备即可
+                    self.model.to(self.device)
+                else:
+                    self.model, self.model_tokenizer = self.load_models(
+                        self.base_model_path
+                    )
+                self.scheduler = self.build_scheduler()
+                if self.speculative is not None:
+                    self.speculative.ensure_loaded()
+                # 重新预热已登记的系统提示词前缀
+                self.register_system_prompts(self.registered_prompts)
+            except Exception:
+                self.residency = previous
+                raise
+
+            self.residency = "resident"
+            self.reload_count += 1
+            self.last_reload_latency = time.time() - start
+            self.total_reload_latency += self.last_reload_latency
+            print(f"本地模型重新加载完成({previous})，耗时 {self.last_reload_latency:.2f}s")
+
+
+    def prewarm(self):
+        """ 后台重新加载，不阻塞调用方；已加载或正在加载时忽略 """
+        if self.residency == "resident":
+            return
+        if self._prewarm_thread is not None and self._prewarm_thread.is_alive():
+            return
+        self._prewarm_thread = threading.Thread(target=self.ensure_loaded, name="local-model-prewarm", daemon=True)
+        self._prewarm_thread.start()
+
+
+    def touch(self, delta=0):
+        """ 记录请求开始(delta=1) / 结束(delta=-1)，用于空闲判断 """
+        self.active_requests += delta
+        self.last_used = time.time()
+
+
+    def is_idle(self, idle_timeout):
+        if self.active_requests > 0:
+            return False
+        if self.scheduler is not None:
+            stats = self.scheduler.stats()
+            if stats["running"] or stats["waiting"]:
+                return False
+        return time.time() - self.last_used >= idle_timeout
+
+
+    def maybe_unload(self, idle_timeout, mode="unload"):
+        """ 空闲超时后卸载（unload）或下放到 CPU（offload），返回是否执行 """
+        with self._residency_lock:
+            if self.residency != "resident" or not self.is_idle(idle_timeout):
+                return False
+            print(f"本地模型空闲超过 {idle_timeout}s，执行 {mode}")
+            if mode == "offload":
+                self.offload_memory()
+            else:
+                self.release_memory()
+            self.unload_count += 1
+            return True
+
+
+    def use_speculative(self):
+        if self.speculative is None:
+            return False
+        if self.scheduler is not None:
+            stats = self.scheduler.stats()
+            if stats["running"] or stats["waiting"]:
+                return False
+        return self.speculative.should_use()
+
+
+    def speculative_stats(self):
+        """ 投机解码接受率与回退情况 """
+        if self.speculative is None:
+            return {"enabled": False}
+        return {"enabled": True, **self.speculative.stats()}
+
+
+    def residency_stats(self):
+        """ 常驻状态与重新加载耗时 """
+        return {
+            "state": self.residency,
+            "active_requests": self.active_requests,
+            "idle_seconds": round(time.time() - self.last_used, 1),
+            "idle_timeout": self.idle_policy.idle_timeout if self.idle_policy else 0,
+            "idle_mode": self.idle_policy.mode if self.idle_policy else None,
+            "unload_count": self.unload_count,
+            "reload_count": self.reload_count,
+            "last_reload_latency": round(self.last_reload_latency, 3) if self.last_reload_latency is not None else None,
+            "avg_reload_latency": round(self.total_reload_latency / self.reload_count, 3) if self.reload_count else None,
+        }
+
+
+    async def agenerate(
+            self,
+            user_query,
+            history=None,
+            sys_prompt=None,
+            session_id=None,
+            cancel_token=None
+    ):
+        """ 异步非流式生成：在线程池中执行，不阻塞事件循环 """
+        loop = asyncio.get_running_loop()
+        self.touch(1)
+        try:
+            with span("generate"):
+                return await loop.run_in_executor(
+                    None,
+                    in_context(partial(
+                        self.generate_response,
+                        user_query=user_query,
+                        history=history,
+                        sys_prompt=sys_prompt,
+                        stream=False,
+                        session_id=session_id,
+                        cancel_token=cancel_token
+                    ))
+                )
+        finally:
+            self.touch(-1)
+
+
+    async def astream(
+            self,
+            user_query,
+            history=None,
+            sys_prompt=None,
+            session_id=None,
+            cancel_token=None
+    ):
+        """ 异步流式生成：生成在后台线程进行，token 经 asyncio 队列逐个吐出 """
+        # 消费方提前退出（客户端断开、任务被取消）时通过令牌停止后台生成
+        cancel_token = cancel_token or CancellationToken()
+
+        from transformers import AsyncTextIteratorStreamer
+
+        loop = asyncio.get_running_loop()
+        self.touch(1)
+        try:
+            # 模型可能已被释放，重新加载同样放到线程池中
+            with span("ensure_loaded"):
+                await loop.run_in_executor(None, self.ensure_loaded)
+
+            streamer = AsyncTextIteratorStreamer(
+                self.model_tokenizer,
+                skip_prompt=True,
+                skip_special_tokens=True,
+                timeout=60.0,
+                clean_up_tokenization_spaces=True
+            )
+
+            # 模板、分词与提交（非批处理模式下还包括启动生成线程）均放到线程池
+            await loop.run_in_executor(
+                None,
+                in_context(partial(
+                    self.generate_response,
+                    user_query=user_query,
+                    history=history,
+                    sys_prompt=sys_prompt,
+                    stream=True,
+                    streamer=streamer,
+                    session_id=session_id,
+                    cancel_token=cancel_token
+                ))
+            )
+
+            # prefill（含调度器排队）到首个 token 为止，之后为 decode；token 循环中只计数
+            trace = current_trace()
+            submitted = time.perf_counter()
+            first_token = None
+            token_count = 0
+            completed = False
+            try:
+                async for token in streamer:
+                    if isinstance(token, Exception):
+                        # 生成中途出错（见 end_streamer）：以 ❌ 错误信息结束，健康统计、自动路由与回复缓存按错误处理
+                        yield f"❌ 本地引擎调用失败: {token}"
+                        completed = True
+                        break
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                    token_count += 1
+                    yield token
+                completed = True
+            finally:
+                if not completed:
+                    cancel_token.cancel("consumer_closed")
+                if trace is not None and first_token is not None:
+                    trace.add_span("prefill", submitted, first_token)
+                    trace.add_span("decode", first_token, time.perf_counter())
+                    trace.set(completion_tokens=token_count)
+        finally:
+            self.touch(-1)
+
+
+    def offload_memory(self):
+        """
+        将权重下放到 CPU 内存并释放显存，重新加载只需拷回设备
+        模型在 CPU 上运行时无显存可释放，等同于 release_memory
+        """
+        if "cuda" not in self.device or self.model is None:
+            return self.release_memory()
+
+        with self._residency_lock:
+            if self.scheduler is not None:
+                self.scheduler.stop()
+                self.scheduler = None
+            # KV cache 在显存中，下放时一并释放；草稿模型较小，直接释放，重新加载时再读取
+            if self.speculative is not None:
+                self.speculative.release()
+            self.prefix_cache.clear()
+            self.session_cache.clear()
+
+            self.model.to("cpu")
+            gc.collect()
+            torch.cuda.empty_cache()
+            self.residency = "offloaded"
+            print(f"模型已下放到 CPU 内存，显存已释放 (Device: {self.device})")
+
+
     def release_memory(self):
         """
         释放模型占用的显存和内存资源
         执行后模型将不可用，需要重新初始化
         """
+        with self._residency_lock:
+            self._release_memory()
+
+
+    def _release_memory(self):
+        # 停止调度线程，释放其持有的模型与 KV cache 引用
+        if self.scheduler is not None:
+            self.scheduler.stop()
+            self.scheduler = None
+
+        # 前缀 / 会话 KV cache 与草稿模型依附于主模型，一并释放
+        if self.speculative is not None:
+            self.speculative.release()
+        self.prefix_cache.clear()
+        self.session_cache.clear()
+
         # 删除模型引用
         del self.model
         del self.model_tokenizer
@@ -218,6 +876,7 @@ class LocalModelChat:
         # 重置模型引用
         self.model = None
         self.model_tokenizer = None
+        self.residency = "unloaded"
 
         # 使用示例
 
@@ -0,0 +1,236 @@
+import gc
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer, GenerationConfig
+
+
+"""
+模型加载：
+    - fast    : 在 meta 设备上构建空模型，按 safetensors 分片内存映射读取，逐个张量直接落到目标设备 / 精度，
+                不再先在 CPU 上构建完整 fp32 模型再整体 .to(device)，可多线程并行读取分片
+    - default : transformers from_pretrained（low_cpu_mem_usage + device_map），fast 失败时也回退到此路径
+每次加载记录各阶段耗时与峰值 RSS；配置与分词器在 release_memory 后保留，重新加载只需读取权重
+"""
+
+
+def current_rss():
+    """ 当前进程常驻内存(bytes) """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        # 非 Linux 平台只能取到进程生命周期内的峰值
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class LoadProfile:
+    """ 单次加载的分阶段耗时与峰值 RSS """
+    def __init__(self, strategy, interval=0.05):
+        self.strategy = strategy
+        self.interval = interval
+        self.phases = OrderedDict()
+        self.start_rss = current_rss()
+        self.peak_rss = self.start_rss
+        self.end_rss = None
+        self.total_time = 0.0
+        self.fallback_reason = None
+        self._stop = threading.Event()
+        self._sampler = None
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = round(time.perf_counter() - start, 3)
+            self.peak_rss = max(self.peak_rss, current_rss())
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, current_rss())
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._sampler.join()
+        self.end_rss = current_rss()
+        self.peak_rss = max(self.peak_rss, self.end_rss)
+        self.total_time = round(time.perf_counter() - self._start, 3)
+        return False
+
+    def report(self):
+        mb = 1024 * 1024
+        return {
+            "strategy": self.strategy,
+            "total_time": self.total_time,
+            "phases": dict(self.phases),
+            "start_rss_mb": round(self.start_rss / mb, 1),
+            "peak_rss_mb": round(self.peak_rss / mb, 1),
+            "end_rss_mb": round((self.end_rss or 0) / mb, 1),
+            "fallback_reason": self.fallback_reason,
+        }
+
+
+def list_safetensors_shards(model_path):
+    """ 返回 {分片文件: [张量名]}，没有 safetensors 权重时返回空 """
+    index_path = os.path.join(model_path, "model.safetensors.index.json")
+    if os.path.exists(index_path):
+        with open(index_path, "r", encoding="utf-8") as f:
+            weight_map = json.load(f)["weight_map"]
+        shards = OrderedDict()
+        for name, shard in weight_map.items():
+            shards.setdefault(os.path.join(model_path, shard), []).append(name)
+        return shards
+
+    single_path = os.path.join(model_path, "model.safetensors")
+    if os.path.exists(single_path):
+        from safetensors import safe_open
+        with safe_open(single_path, framework="pt") as f:
+            return OrderedDict([(single_path, list(f.keys()))])
+    return OrderedDict()
+
+
+class ModelLoader:
+    """ 本地模型加载器，缓存配置与分词器，供 release_memory 后快速重新加载 """
+    def __init__(self, model_path, device, dtype, strategy="fast", num_threads=4, quantize=None, quantized_cache_dir=None):
+        self.model_path = model_path
+        self.device = device
+        self.dtype = dtype
+        self.strategy = strategy
+        self.num_threads = max(1, num_threads)
+        # CPU int8 动态量化：优先加载已持久化的量化模型
+        self.quantize = quantize
+        self.quantized_cache_dir = quantized_cache_dir
+
+        self.config = None
+        self.generation_config = None
+        self.tokenizer = None
+        self.shards = None
+        self.last_profile = None
+
+    def load(self):
+        """ 返回 (model, tokenizer)，加载概况见 last_profile """
+        profile = LoadProfile(f"{self.strategy}+{self.quantize}" if self.quantize else self.strategy)
+        with profile:
+            with profile.phase("tokenizer"):
+                if self.tokenizer is None:
+                    self.tokenizer = AutoTokenizer.from_pretrained(self.model_path)
+
+            model = None
+            checkpoint = None
+            if self.quantize:
+                from modules.llm.quantization import QuantizedCheckpoint
+                checkpoint = QuantizedCheckpoint(self.model_path, self.quantize, self.quantized_cache_dir)
+                with profile.phase("quantized_checkpoint"):
+                    model = checkpoint.load()
+                if model is not None:
+                    checkpoint = None
+
+            if model is None and self.strategy == "fast":
+                try:
+                    model = self.load_fast(profile)
+                except Exception as e:
+                    profile.fallback_reason = str(e)
+                    print(f"快速加载失败，回退到 from_pretrained: {e}")
+                    model = None
+                    gc.collect()
+
+            if model is None:
+                with profile.phase("from_pretrained"):
+                    model = self.load_default()
+
+            if checkpoint is not None:
+                from modules.llm.quantization import quantize_dynamic_int8
+                with profile.phase("quantize"):
+                    model = quantize_dynamic_int8(model)
+                with profile.phase("save_quantized"):
+                    try:
+                        checkpoint.save(model)
+                    except Exception as e:
+                        print(f"量化模型保存失败，下次启动将重新量化: {e}")
+
+        self.last_profile = profile
+        print(f"模型加载完成: {profile.report()}")
+        return model, self.tokenizer
+
+    def load_default(self):
+        on_gpu = str(self.device).lower().startswith("cuda")
+        model = AutoModelForCausalLM.from_pretrained(
+            self.model_path,
+            dtype=self.dtype,
+            low_cpu_mem_usage=True,
+            device_map=self.device if on_gpu else None,
+        )
+        return model.eval()
+
+    def load_fast(self, profile):
+        from accelerate import init_empty_weights
+        from accelerate.utils import set_module_tensor_to_device
+
+        with profile.phase("config"):
+            if self.config is None:
+                self.config = AutoConfig.from_pretrained(self.model_path)
+                try:
+                    self.generation_config = GenerationConfig.from_pretrained(self.model_path)
+                except Exception:
+                    self.generation_config = None
+            if self.shards is None:
+                self.shards = list_safetensors_shards(self.model_path)
+            if not self.shards:
+                raise FileNotFoundError(f"{self.model_path} 下没有 safetensors 权重")
+
+        with profile.phase("init_empty"):
+            # 参数建在 meta 设备上，不分配内存
+            with init_empty_weights():
+                model = AutoModelForCausalLM.from_config(self.config)
+
+        from safetensors import safe_open
+        device = str(self.device)
+        params = dict(model.named_parameters())
+        buffers = dict(model.named_buffers())
+
+        def load_chunk(shard_path, names):
+            # safe_open 以内存映射方式读取，张量直接读到目标设备，逐个转换精度
+            with safe_open(shard_path, framework="pt", device=device) as f:
+                for name in names:
+                    if name not in params and name not in buffers:
+                        continue
+                    set_module_tensor_to_device(model, name, device, value=f.get_tensor(name), dtype=self.dtype)
+            return len(names)
+
+        with profile.phase("weights"):
+            tasks = []
+            for shard_path, names in self.shards.items():
+                step = max(1, (len(names) + self.num_threads - 1) // self.num_threads)
+                tasks.extend((shard_path, names[i:i + step]) for i in range(0, len(names), step))
+            with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+                list(executor.map(lambda task: load_chunk(*task), tasks))
+
+        with profile.phase("finalize"):
+            model.tie_weights()
+            missing = [name for name, param in model.named_parameters() if param.device.type == "meta"]
+            if missing:
+                raise ValueError(f"权重缺失: {missing[:5]}")
+            # 非持久化 buffer（如 rotary inv_freq）在构建时已在 CPU 上，随模型一并移到目标设备
+            model.to(device)
+            if self.generation_config is not None:
+                model.generation_config = self.generation_config
+            model.eval()
+
+        return model
+
+    def stats(self):
+        return self.last_profile.report() if self.last_profile else {}
@@ -1,15 +1,89 @@
+import asyncio
+import time
+
+from modules.llm.resilience import CircuitBreaker, backoff_delay, hedged_call
+from modules.utils.cancellation import cancellation_stats
+from modules.utils.metrics import annotate, current_trace
+
+
+class FirstTokenTimeout(Exception):
+    """ 首个 token 超时 """
+
 
 class OpenAIModel:
-    def __init__(self, api_key, base_url, model):
-        from openai  import OpenAI
-        self.client = OpenAI(api_key=api_key, base_url=base_url)
+    def __init__(
+            self,
+            api_key,
+            base_url,
+            model,
+            connect_timeout=5.0,
+            first_token_timeout=30.0,
+            total_timeout=120.0,
+            max_retries=2,
+            retry_backoff=0.5,
+            hedge_after=0.0,
+            max_connections=100,
+            max_keepalive=20,
+            keepalive_expiry=30.0,
+            breaker_threshold=5,
+            breaker_cooldown=30.0
+    ):
+        import httpx
+        from openai import OpenAI, AsyncOpenAI
+        # 连接超时单独设置；read 超时兜底整体时长，首 token / 整体超时在 astream 中控制
+        timeout = httpx.Timeout(total_timeout, connect=connect_timeout)
+        self.client = OpenAI(api_key=api_key, base_url=base_url, timeout=timeout, max_retries=max_retries)
+        # 异步客户端：供 FastAPI / Chainlit 的 async 路由使用，不阻塞事件循环；
+        # 连接池 + keep-alive 复用 TLS 连接，重试由下方逻辑控制（流式只在首 token 前重试）
+        self.http_client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive,
+                keepalive_expiry=keepalive_expiry
+            )
+        )
+        self.async_client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=self.http_client,
+            max_retries=0
+        )
         self.model = model
 
-    def generate_response(self, user_query, history, sys_prompt, stream=True):
+        self.first_token_timeout = first_token_timeout
+        self.total_timeout = total_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.hedge_after = hedge_after
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+        self.counters = {
+            "requests": 0,
+            "failures": 0,
+            "retries": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "first_token_timeouts": 0,
+            "total_timeouts": 0,
+            "midstream_errors": 0,
+        }
+
+    def build_messages(self, user_query, history, sys_prompt):
         messages = [{"role": "system", "content": sys_prompt}]
-        for h in history:
+        for h in history or []:
             messages.append(h)
         messages.append({"role": "user", "content": user_query})
+        return messages
+
+    @staticmethod
+    def annotate_prompt(messages):
+        """ 流式响应没有用量信息，有 trace 时按字符估算输入 token 数 """
+        if current_trace() is not None:
+            from modules.engine.history import estimate_tokens
+            annotate(prompt_tokens=sum(estimate_tokens(m.get("content")) + 4 for m in messages))
+
+    def generate_response(self, user_query, history, sys_prompt, stream=True):
+        messages = self.build_messages(user_query, history, sys_prompt)
 
         try:
             response = self.client.chat.completions.create(
@@ -29,3 +103,201 @@ class OpenAIModel:
                 yield response.choices[0].message.content
         except Exception as e:
             yield f"❌ 在线引擎调用失败: {str(e)}"
+
+    @staticmethod
+    def is_retryable(error):
+        """ 超时、连接错误、429 与 5xx 可重试；鉴权、参数错误等直接失败 """
+        import openai
+        if isinstance(error, (asyncio.TimeoutError, FirstTokenTimeout, openai.APIConnectionError)):
+            return True
+        if isinstance(error, openai.APIStatusError):
+            return error.status_code in (408, 409, 429) or error.status_code >= 500
+        return False
+
+    @staticmethod
+    def chunk_content(chunk):
+        if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
+            return chunk.choices[0].delta.content
+        return None
+
+    async def open_stream(self, messages):
+        """ 建立流式请求并读到首个有内容的 chunk，返回 (response, 迭代器, 首段内容) """
+        response = await self.async_client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            stream=True
+        )
+        iterator = response.__aiter__()
+        try:
+            while True:
+                try:
+                    chunk = await iterator.__anext__()
+                except StopAsyncIteration:
+                    return response, None, ""
+                content = self.chunk_content(chunk)
+                if content:
+                    return response, iterator, content
+        except BaseException:
+            await response.close()
+            raise
+
+    async def first_attempt(self, factory, attempt_timeout):
+        """ 单次尝试（可对冲），超过 attempt_timeout 未返回视为超时 """
+        async def attempt():
+            try:
+                return await asyncio.wait_for(factory(), timeout=attempt_timeout)
+            except asyncio.TimeoutError:
+                raise FirstTokenTimeout(f"{attempt_timeout}s 内未收到上游响应")
+
+        async def discard(result):
+            if isinstance(result, tuple):
+                await result[0].close()
+
+        def on_hedge():
+            self.counters["hedges"] += 1
+
+        result, hedge_won = await hedged_call(attempt, self.hedge_after, discard=discard, on_hedge=on_hedge)
+        if hedge_won:
+            self.counters["hedge_wins"] += 1
+        return result
+
+    async def call_with_retry(self, factory, attempt_timeout, deadline):
+        """ 熔断检查 + 指数退避重试；用于首 token 之前（流式）或整个请求（非流式） """
+        self.counters["requests"] += 1
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            try:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                result = await self.first_attempt(factory, min(attempt_timeout, remaining))
+                self.breaker.record_success()
+                return result
+            except asyncio.CancelledError:
+                self.breaker.release_trial()
+                raise
+            except Exception as e:
+                retryable = self.is_retryable(e)
+                if retryable:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.release_trial()
+                if isinstance(e, FirstTokenTimeout):
+                    self.counters["first_token_timeouts"] += 1
+
+                delay = backoff_delay(attempt, self.retry_backoff)
+                if not retryable or attempt >= self.max_retries or time.monotonic() + delay >= deadline:
+                    raise
+                attempt += 1
+                self.counters["retries"] += 1
+                print(f"在线引擎第 {attempt} 次重试（{delay:.2f}s 后）: {e}")
+                await asyncio.sleep(delay)
+
+    def error_message(self, error):
+        self.counters["failures"] += 1
+        if isinstance(error, asyncio.TimeoutError):
+            self.counters["total_timeouts"] += 1
+            return f"❌ 在线引擎调用失败: 超过 {self.total_timeout}s 未完成"
+        return f"❌ 在线引擎调用失败: {str(error)}"
+
+    async def agenerate(self, user_query, history=None, sys_prompt=None, session_id=None, cancel_token=None):
+        """ 异步非流式生成，直接返回完整回复；整个请求可安全重试 """
+        messages = self.build_messages(user_query, history, sys_prompt)
+
+        async def request():
+            return await self.async_client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                stream=False
+            )
+
+        deadline = time.monotonic() + self.total_timeout
+        trace = current_trace()
+        started = time.perf_counter()
+        try:
+            response = await self.call_with_retry(request, self.total_timeout, deadline)
+            if trace is not None:
+                trace.add_span("generate", started, time.perf_counter())
+                usage = getattr(response, "usage", None)
+                if usage is not None:
+                    trace.set(completion_tokens=usage.completion_tokens)
+                if usage is not None and usage.prompt_tokens:
+                    trace.set(prompt_tokens=usage.prompt_tokens)
+                else:
+                    self.annotate_prompt(messages)
+            return response.choices[0].message.content
+        except Exception as e:
+            return self.error_message(e)
+
+    async def astream(self, user_query, history=None, sys_prompt=None, session_id=None, cancel_token=None):
+        """
+        异步流式生成；首 token 前的失败按退避重试（可对冲），首 token 之后出错直接报错，避免重复输出。
+        取消或消费方提前退出时关闭上游流，不再继续消费
+        """
+        messages = self.build_messages(user_query, history, sys_prompt)
+        deadline = time.monotonic() + self.total_timeout
+        self.annotate_prompt(messages)
+        # prefill 为发出请求（含重试 / 对冲）到首段内容，之后为 decode
+        trace = current_trace()
+        started = time.perf_counter()
+        first_token = None
+
+        response = None
+        completed = False
+        failed = False
+        chunk_count = 0
+        try:
+            response, iterator, content = await self.call_with_retry(
+                lambda: self.open_stream(messages),
+                self.first_token_timeout,
+                deadline
+            )
+            first_token = time.perf_counter()
+            if content:
+                chunk_count += 1
+                yield content
+
+            while iterator is not None:
+                if cancel_token is not None and cancel_token.cancelled:
+                    break
+                remaining = deadline - time.monotonic()
+                try:
+                    chunk = await asyncio.wait_for(iterator.__anext__(), timeout=max(remaining, 0.001))
+                except StopAsyncIteration:
+                    completed = True
+                    break
+                chunk_count += 1
+                content = self.chunk_content(chunk)
+                if content:
+                    yield content
+            else:
+                completed = True
+        except Exception as e:
+            failed = True
+            if chunk_count:
+                self.counters["midstream_errors"] += 1
+            yield self.error_message(e)
+        finally:
+            if trace is not None and first_token is not None:
+                trace.add_span("prefill", started, first_token)
+                trace.add_span("decode", first_token, time.perf_counter())
+            if response is not None and not completed:
+                await response.close()
+                if not failed:
+                    # 在线引擎无法得知剩余长度，只记录取消次数与已消费的 chunk 数
+                    cancellation_stats.record("openai", tokens_generated=chunk_count)
+
+    def resilience_stats(self):
+        """ 重试 / 对冲 / 超时 / 熔断统计 """
+        return {
+            **self.counters,
+            "breaker": self.breaker.stats(),
+            "hedge_after": self.hedge_after,
+            "max_retries": self.max_retries,
+            "first_token_timeout": self.first_token_timeout,
+            "total_timeout": self.total_timeout,
+        }
+
+    async def aclose(self):
+        await self.http_client.aclose()
@@ -0,0 +1,81 @@
+import glob
+import json
+import os
+
+import torch
+
+
+"""
+CPU 推理模式：
+    - fp32 : 原始精度（默认）
+    - bf16 : 权重与计算使用 bfloat16，内存减半，支持 AVX512-BF16 / AMX 的 CPU 上明显更快
+    - int8 : 线性层动态量化（权重 int8，激活运行时量化），量化结果持久化，下次启动直接加载
+"""
+
+
+CPU_MODES = ["fp32", "bf16", "int8"]
+
+
+def cpu_mode_dtype(cpu_mode):
+    """ 加载权重使用的精度；int8 在 fp32 权重基础上量化 """
+    return torch.bfloat16 if cpu_mode == "bf16" else torch.float32
+
+
+def quantize_dynamic_int8(model):
+    """ 将全部 nn.Linear 替换为动态量化的 int8 线性层 """
+    from torch.ao.quantization import quantize_dynamic
+    return quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class QuantizedCheckpoint:
+    """
+    量化后模型的本地缓存，默认位于原模型目录旁的 <模型名>-cpu-<mode>/
+    原始权重、torch 或 transformers 版本变化时视为失效，重新量化
+    """
+    def __init__(self, model_path, mode, cache_dir=None):
+        self.model_path = model_path
+        self.mode = mode
+        self.cache_dir = cache_dir or f"{os.path.normpath(model_path)}-cpu-{mode}"
+        self.path = os.path.join(self.cache_dir, "model.pt")
+        self.meta_path = os.path.join(self.cache_dir, "meta.json")
+
+    def fingerprint(self):
+        import transformers
+        weights = sorted(
+            glob.glob(os.path.join(self.model_path, "*.safetensors"))
+            + glob.glob(os.path.join(self.model_path, "*.bin"))
+        )
+        return {
+            "mode": self.mode,
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "weights": [
+                [os.path.basename(path), os.path.getsize(path), int(os.path.getmtime(path))]
+                for path in weights
+            ],
+        }
+
+    def load(self):
+        """ 缓存有效时返回量化后的模型，否则返回 None """
+        if not os.path.exists(self.path) or not os.path.exists(self.meta_path):
+            return None
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                if json.load(f) != self.fingerprint():
+                    print(f"量化缓存已过期，重新量化: {self.cache_dir}")
+                    return None
+            # 保存的是完整模块（含量化线性层的打包权重），只加载本机生成的可信文件
+            model = torch.load(self.path, map_location="cpu", weights_only=False)
+            return model.eval()
+        except Exception as e:
+            print(f"量化缓存加载失败，重新量化: {e}")
+            return None
+
+    def save(self, model):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        torch.save(model, tmp_path)
+        os.replace(tmp_path, self.path)
+        with open(self.meta_path, "w", encoding="utf-8") as f:
+            json.dump(self.fingerprint(), f, ensure_ascii=False, indent=2)
+        print(f"量化模型已保存: {self.path}")
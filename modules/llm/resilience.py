@@ -0,0 +1,137 @@
+import asyncio
+import random
+import threading
+import time
+
+
+"""
+在线引擎容错：
+    - CircuitBreaker : 连续失败 failure_threshold 次后熔断，cooldown 秒内直接失败；之后放行一个试探请求(half_open)，成功即恢复
+    - backoff_delay  : 指数退避 + 抖动
+    - hedged_call    : 对冲请求，第一次尝试超过 hedge_after 秒仍未返回时再发一次，取先返回者，另一个取消并清理
+"""
+
+
+class CircuitOpenError(Exception):
+    """ 熔断中，请求未发出 """
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super().__init__(f"上游连续失败已熔断，约 {retry_after} 秒后重试")
+
+
+class CircuitBreaker:
+    """ 连续失败计数熔断器：closed -> open -> half_open -> closed / open """
+    def __init__(self, failure_threshold=5, cooldown=30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self.rejected = 0
+        self._trial_inflight = False
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.failure_threshold > 0
+
+    def before_call(self):
+        """ 请求前检查，熔断中抛出 CircuitOpenError """
+        if not self.enabled:
+            return
+        with self._lock:
+            if self.state == "open":
+                elapsed = time.time() - self.opened_at
+                if elapsed < self.cooldown:
+                    self.rejected += 1
+                    raise CircuitOpenError(max(1, int(round(self.cooldown - elapsed))))
+                self.state = "half_open"
+                self._trial_inflight = False
+            if self.state == "half_open":
+                # 半开状态只放行一个试探请求
+                if self._trial_inflight:
+                    self.rejected += 1
+                    raise CircuitOpenError(1)
+                self._trial_inflight = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._trial_inflight = False
+            if self.state != "closed":
+                print("✅ 在线引擎熔断恢复")
+            self.state = "closed"
+
+    def record_failure(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.failures += 1
+            self._trial_inflight = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.trips += 1
+                    print(f"❌ 在线引擎连续失败 {self.failures} 次，熔断 {self.cooldown}s")
+                self.state = "open"
+                self.opened_at = time.time()
+
+    def release_trial(self):
+        """ 试探请求未产生结果（如被取消）时归还名额 """
+        with self._lock:
+            self._trial_inflight = False
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "trips": self.trips,
+            "rejected": self.rejected,
+        }
+
+
+def backoff_delay(attempt, base=0.5, max_delay=8.0):
+    """ 第 attempt 次重试前的等待时间（full jitter） """
+    return random.uniform(0, min(max_delay, base * (2 ** attempt)))
+
+
+async def hedged_call(factory, hedge_after=0.0, discard=None, on_hedge=None):
+    """
+    调用 factory() 返回的协程；hedge_after > 0 且首个尝试超时未完成时再发起一次，返回 (结果, 是否对冲胜出)。
+    两个尝试都失败时抛出后一个异常；落败尝试的结果交给 discard 清理（如关闭流）
+    """
+    first = asyncio.create_task(factory())
+    if hedge_after <= 0:
+        return await first, False
+
+    tasks = [first]
+    winner = None
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if not done:
+            if on_hedge is not None:
+                on_hedge()
+            tasks.append(asyncio.create_task(factory()))
+
+        error = None
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    winner = task
+                    return task.result(), task is not first
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if task is winner:
+                continue
+            if not task.done():
+                task.cancel()
+            try:
+                result = await task
+            except BaseException:
+                continue
+            if discard is not None:
+                await discard(result)
@@ -0,0 +1,145 @@
+import threading
+from contextlib import contextmanager
+
+
+"""
+投机解码（assisted generation）：
+    小草稿模型（同系列、同分词器，如 Qwen2.5-0.5B-Instruct）每步先起草 lookahead 个 token，
+    大模型一次前向验证全部候选，接受的 token 不再逐个解码。
+    接受率统计：每次大模型前向（验证一步）产出 1 个自有 token + 若干被接受的草稿 token，
+        accepted = new_tokens - target_steps，proposed ≈ target_steps * lookahead
+    自动回退：接受率 EMA 低于 min_acceptance 时停用，普通解码 cooldown 次请求后重新试探
+"""
+
+
+class SpeculativeDecoder:
+    """ 草稿模型管理 + 接受率统计 + 自动回退 """
+    def __init__(
+            self,
+            loader,
+            lookahead=5,
+            min_acceptance=0.3,
+            warmup=3,
+            cooldown=20,
+            ema_alpha=0.2
+    ):
+        self.loader = loader
+        self.draft_model = None
+        self.lookahead = max(1, lookahead)
+        self.min_acceptance = min_acceptance
+        self.warmup = warmup
+        self.cooldown = cooldown
+        self.ema_alpha = ema_alpha
+
+        self.active = True
+        self.skipped = 0
+        self.observed = 0
+        self.ema_acceptance = None
+        self.last_reason = None
+
+        self.total_generations = 0
+        self.total_new_tokens = 0
+        self.total_target_steps = 0
+        self.accepted_tokens = 0
+        self.proposed_tokens = 0
+        self.fallbacks = 0
+        self.failures = 0
+
+        self._lock = threading.Lock()
+
+    def ensure_loaded(self):
+        if self.draft_model is None:
+            self.draft_model, _ = self.loader.load()
+            # 固定每步起草 lookahead 个 token（默认的 heuristic 策略会自行增减）
+            self.draft_model.generation_config.num_assistant_tokens = self.lookahead
+            self.draft_model.generation_config.num_assistant_tokens_schedule = "constant"
+
+    def release(self):
+        self.draft_model = None
+
+    def should_use(self):
+        """ 本次请求是否使用投机解码；停用期间计数，满 cooldown 次后重新试探 """
+        with self._lock:
+            if self.draft_model is None:
+                return False
+            if self.active:
+                return True
+            self.skipped += 1
+            if self.skipped >= self.cooldown:
+                self.active = True
+                self.skipped = 0
+                self.observed = 0
+                self.ema_acceptance = None
+                print("投机解码重新试探")
+                return True
+            return False
+
+    def generation_kwargs(self):
+        return {"assistant_model": self.draft_model}
+
+    @contextmanager
+    def track(self, model):
+        """ 统计当前线程内大模型的前向次数（其他线程 / 连续批处理的前向不计入） """
+        counter = {"steps": 0}
+        thread_id = threading.get_ident()
+
+        def hook(module, args, output):
+            if threading.get_ident() == thread_id:
+                counter["steps"] += 1
+
+        handle = model.register_forward_hook(hook)
+        try:
+            yield counter
+        finally:
+            handle.remove()
+
+    def record(self, new_tokens, target_steps):
+        """ 记录一次生成的接受情况，接受率过低时停用 """
+        if target_steps <= 0 or new_tokens <= 0:
+            return
+        accepted = max(0, new_tokens - target_steps)
+        proposed = target_steps * self.lookahead
+        acceptance = min(1.0, accepted / proposed)
+
+        with self._lock:
+            self.total_generations += 1
+            self.total_new_tokens += new_tokens
+            self.total_target_steps += target_steps
+            self.accepted_tokens += accepted
+            self.proposed_tokens += proposed
+            self.observed += 1
+            if self.ema_acceptance is None:
+                self.ema_acceptance = acceptance
+            else:
+                self.ema_acceptance = (1 - self.ema_alpha) * self.ema_acceptance + self.ema_alpha * acceptance
+
+            if self.active and self.observed >= self.warmup and self.ema_acceptance < self.min_acceptance:
+                self._deactivate(f"接受率 {self.ema_acceptance:.2f} 低于 {self.min_acceptance}")
+
+    def fail(self, error):
+        """ 投机解码出错（如草稿模型与主模型不兼容）时停用 """
+        with self._lock:
+            self.failures += 1
+            self._deactivate(f"生成失败: {error}")
+
+    def _deactivate(self, reason):
+        self.active = False
+        self.skipped = 0
+        self.fallbacks += 1
+        self.last_reason = reason
+        print(f"投机解码已回退到普通解码: {reason}")
+
+    def stats(self):
+        return {
+            "loaded": self.draft_model is not None,
+            "active": self.active,
+            "lookahead": self.lookahead,
+            "min_acceptance": self.min_acceptance,
+            "ema_acceptance": round(self.ema_acceptance, 4) if self.ema_acceptance is not None else None,
+            "acceptance_rate": round(self.accepted_tokens / self.proposed_tokens, 4) if self.proposed_tokens else None,
+            "tokens_per_target_step": round(self.total_new_tokens / self.total_target_steps, 3) if self.total_target_steps else None,
+            "total_generations": self.total_generations,
+            "fallbacks": self.fallbacks,
+            "failures": self.failures,
+            "last_reason": self.last_reason,
+        }
@@ -0,0 +1,79 @@
+import asyncio
+import threading
+
+
+
+_STREAM_END = object()
+
+
+class _StreamError:
+    """ 生产线程中抛出的异常，转交给消费协程重新抛出 """
+    def __init__(self, error):
+        self.error = error
+
+
+async def iterate_in_thread(sync_iterable):
+    """
+    在后台线程中消费阻塞迭代器，通过 asyncio.Queue 异步吐出元素，避免阻塞事件循环
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    def put(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            # 事件循环已关闭，消费方不再读取
+            pass
+
+    def produce():
+        try:
+            for item in sync_iterable:
+                put(item)
+        except Exception as e:
+            put(_StreamError(e))
+        finally:
+            put(_STREAM_END)
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    while True:
+        item = await queue.get()
+        if item is _STREAM_END:
+            break
+        if isinstance(item, _StreamError):
+            raise item.error
+        yield item
+
+
+async def merge_async_iterables(iterables):
+    """
+    并发消费多个异步迭代器，按到达顺序交错产出 (key, item)；任一迭代器出错时取消其余并重新抛出
+    iterables: {key: async iterable}
+    """
+    queue = asyncio.Queue()
+
+    async def pump(key, iterable):
+        try:
+            async for item in iterable:
+                await queue.put((key, item))
+        except Exception as e:
+            await queue.put((key, _StreamError(e)))
+        finally:
+            await queue.put((key, _STREAM_END))
+
+    tasks = [asyncio.create_task(pump(key, iterable)) for key, iterable in iterables.items()]
+    remaining = len(tasks)
+    try:
+        while remaining:
+            key, item = await queue.get()
+            if item is _STREAM_END:
+                remaining -= 1
+                continue
+            if isinstance(item, _StreamError):
+                raise item.error
+            yield key, item
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
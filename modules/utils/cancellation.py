@@ -0,0 +1,47 @@
+import threading
+
+
+
+class CancellationToken:
+    """
+    请求级取消令牌：客户端断开 / 用户离开时置位，生成侧（本地模型、OpenAI 流）据此提前停止
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason = None
+
+    def cancel(self, reason="cancelled"):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+
+class CancellationStats:
+    """ 取消统计：被取消的请求数，以及因提前停止而节省的 token 数（本地引擎按 max_new_tokens 估算） """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.cancelled_requests = {}
+        self.tokens_generated = {}
+        self.tokens_saved = {}
+
+    def record(self, engine, tokens_generated=0, tokens_saved=0):
+        with self._lock:
+            self.cancelled_requests[engine] = self.cancelled_requests.get(engine, 0) + 1
+            self.tokens_generated[engine] = self.tokens_generated.get(engine, 0) + tokens_generated
+            self.tokens_saved[engine] = self.tokens_saved.get(engine, 0) + max(tokens_saved, 0)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "cancelled_requests": dict(self.cancelled_requests),
+                "tokens_generated_before_cancel": dict(self.tokens_generated),
+                "tokens_saved": dict(self.tokens_saved),
+            }
+
+
+# 进程内共享的取消统计
+cancellation_stats = CancellationStats()
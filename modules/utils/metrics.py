@@ -0,0 +1,387 @@
+import contextvars
+import itertools
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from functools import partial
+
+
+"""
+指标与链路追踪：
+    - MetricsRegistry : 计数器 / 直方图，按 Prometheus 文本格式输出；各组件已有的 stats() 在抓取时展开为 gauge
+    - Trace / Tracer  : 每个请求一条 trace，记录各阶段耗时（历史整理、对话模板、分词、prefill、decode、流式写出）
+当前 trace 通过 contextvars 传递，引擎内部用 span() / annotate() 记录，无 trace 时为空操作。
+token 循环中只做计数与累加耗时，直方图在请求结束时一次性记录。
+"""
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+TOKEN_COUNT_BUCKETS = (16, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+_NAME_INVALID = re.compile(r"[^a-zA-Z0-9_]")
+
+
+def metric_name(*parts):
+    return _NAME_INVALID.sub("_", "_".join(str(p) for p in parts if p != "")).strip("_").lower()
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, key)} {format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [各桶计数(非累积), 总和, 总数]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        label_names = self.labels + ("le",)
+        with self._lock:
+            for key, (counts, total, observed) in sorted(self._values.items()):
+                cumulative = list(itertools.accumulate(counts))
+                for bound, count in zip(self.buckets, cumulative):
+                    lines.append(f"{self.name}_bucket{format_labels(label_names, key + (format_value(float(bound)),))} {count}")
+                lines.append(f"{self.name}_bucket{format_labels(label_names, key + ('+Inf',))} {observed}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {format_value(total)}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, key)} {observed}")
+        return lines
+
+
+def flatten_stats(prefix, value):
+    """ 将嵌套的 stats 字典展开为 (指标名, 数值)：数值与布尔保留，字符串 / None 忽略，列表按下标展开 """
+    if isinstance(value, bool):
+        yield metric_name(prefix), int(value)
+    elif isinstance(value, (int, float)):
+        yield metric_name(prefix), value
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            yield from flatten_stats(f"{prefix}_{key}", item)
+    elif isinstance(value, (list, tuple)):
+        for i, item in enumerate(value):
+            if isinstance(item, (dict, list, tuple)):
+                yield from flatten_stats(f"{prefix}_{i}", item)
+
+
+class MetricsRegistry:
+    def __init__(self, namespace="translation"):
+        self.namespace = namespace
+        self._metrics = []
+        # 抓取时调用，返回嵌套的 stats 字典（各组件已有的统计）
+        self._collectors = []
+
+    def counter(self, name, documentation, labels=()):
+        metric = Counter(metric_name(self.namespace, name), documentation, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(metric_name(self.namespace, name), documentation, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        seen = set()
+        for collector in self._collectors:
+            try:
+                stats = collector()
+            except Exception as e:
+                print(f"指标收集失败: {e}")
+                continue
+            for name, value in flatten_stats(self.namespace, stats):
+                if name in seen:
+                    continue
+                seen.add(name)
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# 进程内共享的指标
+metrics = MetricsRegistry()
+
+REQUESTS = metrics.counter("requests_total", "按引擎 / 角色 / 入口 / 结果统计的请求数", ("engine", "role", "entry", "status"))
+PROMPT_TOKENS = metrics.counter("prompt_tokens_total", "输入 token 数（在线引擎无用量信息时按字符估算）", ("engine", "role"))
+COMPLETION_TOKENS = metrics.counter("completion_tokens_total", "输出 token 数（流式按 chunk 计）", ("engine", "role"))
+TTFT = metrics.histogram("time_to_first_token_seconds", "请求开始到首个 token 的耗时（含排队）", ("engine", "role", "entry"))
+QUEUE_TIME = metrics.histogram("queue_seconds", "准入排队耗时", ("engine",))
+REQUEST_TIME = metrics.histogram("request_seconds", "请求总耗时", ("engine", "role", "entry"))
+TOKENS_PER_SECOND = metrics.histogram("tokens_per_second", "首 token 之后的输出速度", ("engine", "role"), TOKEN_RATE_BUCKETS)
+PROMPT_SIZE = metrics.histogram("prompt_tokens", "单个请求的输入 token 数", ("engine",), TOKEN_COUNT_BUCKETS)
+SPAN_TIME = metrics.histogram("span_seconds", "各阶段耗时", ("span", "engine"))
+
+
+# ============ 链路追踪 ============ #
+
+
+_current_trace = contextvars.ContextVar("translation_trace", default=None)
+
+
+class Span:
+    __slots__ = ("trace", "name", "start")
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add_span(self.name, self.start, time.perf_counter())
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Trace:
+    """ 单个请求的阶段耗时与属性；span 记录为相对请求开始的 (名称, 开始, 耗时) """
+    def __init__(self, name, **attributes):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        self.end = None
+        self.first_token = None
+        self.completion_tokens = 0
+        self.status = None
+        self.attributes = attributes
+        self.spans = []
+        # 在 token 循环中累加的耗时（如流式写出），结束时作为一个 span 记录
+        self.accumulated = {}
+
+    def span(self, name):
+        return Span(self, name)
+
+    def add_span(self, name, start, end):
+        self.spans.append((name, start - self.start, end - start))
+
+    def accumulate(self, name, seconds):
+        self.accumulated[name] = self.accumulated.get(name, 0.0) + seconds
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def mark_first_token(self):
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+
+    @property
+    def ttft(self):
+        return None if self.first_token is None else self.first_token - self.start
+
+    @property
+    def duration(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    @property
+    def tokens_per_second(self):
+        if self.first_token is None or self.end is None or self.completion_tokens < 2:
+            return None
+        decode = self.end - self.first_token
+        return (self.completion_tokens - 1) / decode if decode > 0 else None
+
+    def span_totals(self):
+        totals = dict(self.accumulated)
+        for name, _, duration in self.spans:
+            totals[name] = totals.get(name, 0.0) + duration
+        return totals
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "start": self.wall_start,
+            "duration": round(self.duration, 6),
+            "status": self.status,
+            "ttft": round(self.ttft, 6) if self.ttft is not None else None,
+            "completion_tokens": self.completion_tokens,
+            "tokens_per_second": round(self.tokens_per_second, 3) if self.tokens_per_second else None,
+            "attributes": dict(self.attributes),
+            "spans": [
+                {"name": name, "start": round(start, 6), "duration": round(duration, 6)}
+                for name, start, duration in self.spans
+            ] + [
+                {"name": name, "start": None, "duration": round(duration, 6)}
+                for name, duration in self.accumulated.items()
+            ],
+        }
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def activate(trace):
+    """ 在另一个任务中继续记录同一个 trace（如 StreamingResponse 的生成器） """
+    _current_trace.set(trace)
+
+
+def span(name):
+    """ 在当前 trace 中记录一个阶段，无 trace 时为空操作 """
+    trace = _current_trace.get()
+    return _NULL_SPAN if trace is None else Span(trace, name)
+
+
+def annotate(**attributes):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attributes.update(attributes)
+
+
+def in_context(func):
+    """ run_in_executor 不会复制 contextvars，提交到线程池前用它包装以保留当前 trace """
+    return partial(contextvars.copy_context().run, func)
+
+
+class TensorBoardExporter:
+    """ 将每个请求的阶段耗时 / TTFT / 输出速度写入 TensorBoard（SummaryWriter 自带后台写线程） """
+    def __init__(self, log_dir):
+        from torch.utils.tensorboard import SummaryWriter
+        self.writer = SummaryWriter(log_dir=log_dir)
+        self.step = 0
+
+    def export(self, trace):
+        self.step += 1
+        engine = trace.attributes.get("engine", "unknown")
+        for name, seconds in trace.span_totals().items():
+            self.writer.add_scalar(f"span_ms/{engine}/{name}", seconds * 1000, self.step)
+        if trace.ttft is not None:
+            self.writer.add_scalar(f"ttft_ms/{engine}", trace.ttft * 1000, self.step)
+        if trace.tokens_per_second:
+            self.writer.add_scalar(f"tokens_per_second/{engine}", trace.tokens_per_second, self.step)
+        self.writer.add_scalar(f"request_ms/{engine}", trace.duration * 1000, self.step)
+
+    def close(self):
+        self.writer.close()
+
+
+class Tracer:
+    def __init__(self, max_traces=256):
+        self.recent = deque(maxlen=max_traces)
+        self.exporter = None
+
+    def configure(self, max_traces=256, tensorboard_dir=""):
+        self.recent = deque(self.recent, maxlen=max(max_traces, 1))
+        if tensorboard_dir and self.exporter is None:
+            try:
+                self.exporter = TensorBoardExporter(tensorboard_dir)
+                print(f"链路追踪写入 TensorBoard: {tensorboard_dir}")
+            except ImportError as e:
+                print(f"TensorBoard 不可用，跳过导出: {e}")
+
+    def start(self, name, **attributes):
+        """ 开始一个请求的 trace，并设为当前上下文的 trace """
+        trace = Trace(name, **attributes)
+        _current_trace.set(trace)
+        return trace
+
+    def finish(self, trace, status="ok"):
+        """ 结束 trace：记录请求级指标与各阶段耗时，保存到最近列表并导出 """
+        if trace.end is not None:
+            return
+        trace.end = time.perf_counter()
+        trace.status = status
+        attributes = trace.attributes
+        engine = attributes.get("engine", "unknown")
+        role = attributes.get("role", "")
+        entry = attributes.get("entry", "")
+
+        REQUESTS.inc(engine=engine, role=role, entry=entry, status=status)
+        REQUEST_TIME.observe(trace.duration, engine=engine, role=role, entry=entry)
+        if attributes.get("queue_time") is not None:
+            QUEUE_TIME.observe(attributes["queue_time"], engine=engine)
+        if status == "ok":
+            if trace.ttft is not None:
+                TTFT.observe(trace.ttft, engine=engine, role=role, entry=entry)
+            if trace.tokens_per_second:
+                TOKENS_PER_SECOND.observe(trace.tokens_per_second, engine=engine, role=role)
+        if attributes.get("prompt_tokens"):
+            PROMPT_TOKENS.inc(attributes["prompt_tokens"], engine=engine, role=role)
+            PROMPT_SIZE.observe(attributes["prompt_tokens"], engine=engine)
+        completion_tokens = attributes.get("completion_tokens") or trace.completion_tokens
+        if completion_tokens:
+            COMPLETION_TOKENS.inc(completion_tokens, engine=engine, role=role)
+        for name, seconds in trace.span_totals().items():
+            SPAN_TIME.observe(seconds, span=name, engine=engine)
+
+        self.recent.append(trace)
+        if self.exporter is not None:
+            try:
+                self.exporter.export(trace)
+            except Exception as e:
+                print(f"TensorBoard 导出失败: {e}")
+
+    def traces(self, limit=50):
+        return [trace.to_dict() for trace in list(self.recent)[-limit:]]
+
+
+# 进程内共享的链路追踪
+tracer = Tracer()
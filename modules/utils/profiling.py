@@ -0,0 +1,253 @@
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from collections import Counter
+
+
+"""
+按需性能剖析：管理员开启后，对接下来 N 个本地生成请求（或一段时间窗口内的请求）逐个采集
+    - torch profiler：算子耗时与内存（CPU，有 GPU 时加上 CUDA），导出 chrome trace 与算子统计表
+    - Python 采样：后台线程定时采样生成线程的调用栈，输出 folded 格式（speedscope / flamegraph.pl 可直接打开）
+torch profiler 只记录开启它的线程上的算子，因此采集在实际执行生成的线程上开始 / 结束（生成线程或连续批处理调度线程）；
+同一时间只采集一个请求，其余请求照常执行、不计入次数。
+每次采集保存为 <目录>/<时间>_<引擎>_<角色>_p<输入长度>_b<batch>/，附带 meta.json 标签。
+"""
+
+
+class SamplingProfiler:
+    """ 定时采样指定线程的 Python 调用栈，按栈计数 """
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def write_folded(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class ProfileCapture:
+    """ 单个请求的一次采集；start / stop 必须在执行生成的同一线程上调用 """
+    def __init__(self, manager, tags, kinds, interval):
+        self.manager = manager
+        self.tags = tags
+        self.kinds = kinds
+        self.interval = interval
+        self.started = False
+        self.finished = False
+        self.torch_profile = None
+        self.sampler = None
+        self.start_time = None
+
+    def start(self):
+        if self.started or self.finished:
+            return
+        self.started = True
+        self.start_time = time.perf_counter()
+        try:
+            if "torch" in self.kinds:
+                import torch
+                from torch.profiler import profile, ProfilerActivity
+                activities = [ProfilerActivity.CPU]
+                if torch.cuda.is_available():
+                    activities.append(ProfilerActivity.CUDA)
+                self.torch_profile = profile(activities=activities, profile_memory=True, record_shapes=True, with_stack=False)
+                self.torch_profile.start()
+            if "sampling" in self.kinds:
+                self.sampler = SamplingProfiler(threading.get_ident(), self.interval)
+                self.sampler.start()
+        except Exception as e:
+            print(f"性能剖析启动失败: {e}")
+            self.torch_profile = None
+
+    def stop(self, **extra_tags):
+        """ 结束采集并写出结果；未开始的采集直接放弃 """
+        if self.finished:
+            return
+        self.finished = True
+        if not self.started:
+            self.manager.release(self, None)
+            return
+
+        duration = time.perf_counter() - self.start_time
+        if self.sampler is not None:
+            self.sampler.stop()
+        if self.torch_profile is not None:
+            try:
+                self.torch_profile.stop()
+            except Exception as e:
+                print(f"torch profiler 停止失败: {e}")
+                self.torch_profile = None
+
+        self.tags.update(extra_tags)
+        directory = None
+        try:
+            directory = self.manager.new_profile_dir(self.tags)
+            files = []
+            if self.torch_profile is not None:
+                self.torch_profile.export_chrome_trace(os.path.join(directory, "torch_trace.json"))
+                averages = self.torch_profile.key_averages()
+                with open(os.path.join(directory, "torch_ops.txt"), "w", encoding="utf-8") as f:
+                    f.write("# 按 CPU 自身耗时排序\n")
+                    f.write(averages.table(sort_by="self_cpu_time_total", row_limit=40))
+                    f.write("\n\n# 按 CPU 内存分配排序\n")
+                    f.write(averages.table(sort_by="self_cpu_memory_usage", row_limit=20))
+                files += ["torch_trace.json", "torch_ops.txt"]
+            if self.sampler is not None:
+                self.sampler.write_folded(os.path.join(directory, "sampling.folded"))
+                files.append("sampling.folded")
+            meta = {
+                "tags": self.tags,
+                "duration": round(duration, 4),
+                "samples": self.sampler.samples if self.sampler is not None else 0,
+                "files": files,
+                "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            }
+            with open(os.path.join(directory, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False, indent=2)
+            print(f"性能剖析已保存: {directory}")
+        except Exception as e:
+            print(f"性能剖析保存失败: {e}")
+        finally:
+            self.manager.release(self, directory)
+
+
+class ProfileManager:
+    def __init__(self, directory="profiles"):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self.remaining = 0
+        self.deadline = None
+        self.kinds = ()
+        self.interval = 0.005
+        self.active = None
+        self.captured = 0
+
+    def configure(self, directory):
+        self.directory = directory
+
+    @property
+    def armed(self):
+        if self.deadline is not None and time.time() >= self.deadline:
+            return False
+        return self.remaining > 0 or (self.deadline is not None and self.remaining < 0)
+
+    def arm(self, requests=1, duration=0, kinds=("torch", "sampling"), interval=0.005):
+        """ 采集接下来 requests 个请求；duration > 0 时在该时间窗口内采集（requests <= 0 表示不限个数） """
+        with self._lock:
+            self.remaining = requests if requests > 0 else (-1 if duration > 0 else 0)
+            self.deadline = time.time() + duration if duration > 0 else None
+            self.kinds = tuple(kind for kind in kinds if kind in ("torch", "sampling"))
+            self.interval = max(interval, 0.001)
+        return self.status()
+
+    def disarm(self):
+        with self._lock:
+            self.remaining = 0
+            self.deadline = None
+        return self.status()
+
+    def claim(self, **tags):
+        """ 生成开始前调用：已开启且当前没有进行中的采集时返回一个采集对象，否则返回 None """
+        if self.remaining == 0:
+            return None
+        with self._lock:
+            if not self.armed or self.active is not None or not self.kinds:
+                return None
+            if self.remaining > 0:
+                self.remaining -= 1
+            self.active = ProfileCapture(self, tags, self.kinds, self.interval)
+            return self.active
+
+    def release(self, capture, directory):
+        with self._lock:
+            if self.active is capture:
+                self.active = None
+            if directory is not None:
+                self.captured += 1
+
+    def new_profile_dir(self, tags):
+        name = "_".join([
+            time.strftime("%Y%m%d-%H%M%S"),
+            str(tags.get("engine", "local")),
+            str(tags.get("role") or "unknown"),
+            f"p{tags.get('prompt_tokens', 0)}",
+            f"b{tags.get('batch_size', 1)}",
+        ])
+        name = re.sub(r"[^a-zA-Z0-9_.-]", "_", name)
+        directory = os.path.join(self.directory, name)
+        suffix = 1
+        while os.path.exists(directory):
+            suffix += 1
+            directory = os.path.join(self.directory, f"{name}-{suffix}")
+        os.makedirs(directory)
+        return directory
+
+    def list_profiles(self):
+        if not os.path.isdir(self.directory):
+            return []
+        profiles = []
+        for name in sorted(os.listdir(self.directory), reverse=True):
+            meta_path = os.path.join(self.directory, name, "meta.json")
+            if not os.path.isfile(meta_path):
+                continue
+            with open(meta_path, "r", encoding="utf-8") as f:
+                profiles.append({"name": name, **json.load(f)})
+        return profiles
+
+    def archive(self, name):
+        """ 将一次采集打包为 zip 供下载；名称不合法或不存在时返回 None """
+        if not re.fullmatch(r"[a-zA-Z0-9_.-]+", name or "") or name.startswith("."):
+            return None
+        directory = os.path.join(self.directory, name)
+        if not os.path.isfile(os.path.join(directory, "meta.json")):
+            return None
+        archive_path = os.path.join(self.directory, ".archives", name)
+        os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+        return shutil.make_archive(archive_path, "zip", directory)
+
+    def status(self):
+        return {
+            "armed": self.armed,
+            "remaining_requests": self.remaining if self.remaining >= 0 else None,
+            "window_remaining": round(self.deadline - time.time(), 1) if self.deadline is not None else None,
+            "kinds": list(self.kinds),
+            "interval": self.interval,
+            "active": self.active.tags if self.active is not None else None,
+            "captured": self.captured,
+            "directory": os.path.abspath(self.directory),
+        }
+
+
+# 进程内共享的性能剖析开关
+profiler = ProfileManager()
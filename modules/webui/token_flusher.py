@@ -0,0 +1,91 @@
+import asyncio
+import time
+
+
+"""
+流式输出合并写出：消费引擎 token 的一方只把 token 放入缓冲，由后台任务按时间窗口 / 字节数合并后写出
+    - 距上一帧超过 interval 时立即写出（首个 token 不等待）
+    - 否则等到窗口结束再把期间积累的 token 合成一帧；缓冲达到 max_bytes 时提前写出
+    - 写出较慢（网络拥塞）时，写出期间到达的 token 自然并入下一帧，引擎侧不被阻塞
+"""
+
+
+class TokenFlusher:
+    def __init__(self, send, interval=0.05, max_bytes=1024):
+        """ send: async (text) -> None，如 chainlit 的 msg.stream_token """
+        self.send = send
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self._buffer = []
+        self._size = 0
+        self._pending = asyncio.Event()
+        self._urgent = asyncio.Event()
+        self._closed = False
+        self._last_flush = float("-inf")
+        self._task = None
+
+        self.frames = 0
+        self.tokens = 0
+        self.send_time = 0.0
+        self.first_flush_at = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    def push(self, token):
+        """ 放入一个 token（不等待写出） """
+        if not token:
+            return
+        self._buffer.append(token)
+        self._size += len(token.encode("utf-8"))
+        self.tokens += 1
+        self._pending.set()
+        if self._size >= self.max_bytes:
+            self._urgent.set()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._pending.wait()
+            # 距上一帧不足 interval 时等待凑批；缓冲已满或已关闭时立即写出
+            delay = self._last_flush + self.interval - loop.time()
+            if delay > 0 and not self._urgent.is_set():
+                try:
+                    await asyncio.wait_for(self._urgent.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            self._pending.clear()
+            self._urgent.clear()
+
+            if self._buffer:
+                text = "".join(self._buffer)
+                self._buffer.clear()
+                self._size = 0
+                start = time.perf_counter()
+                await self.send(text)
+                self.send_time += time.perf_counter() - start
+                self.frames += 1
+                if self.first_flush_at is None:
+                    self.first_flush_at = time.perf_counter()
+                self._last_flush = loop.time()
+
+            if self._closed and not self._buffer:
+                return
+
+    async def aclose(self):
+        """ 写出剩余缓冲并结束后台任务；写出出错时在此抛出 """
+        self._closed = True
+        self._urgent.set()
+        self._pending.set()
+        if self._task is not None:
+            await self._task
+
+    def abort(self):
+        """ 任务被取消时直接停止，不再写出 """
+        self._closed = True
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    def stats(self):
+        return {"frames": self.frames, "tokens": self.tokens, "send_time": round(self.send_time, 4)}
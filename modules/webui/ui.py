@@ -1,15 +1,19 @@
 import chainlit as cl
-import asyncio
-from chainlit.input_widget import Select
-from modules.engine.engine_factory import engine_manager
-from modules.prompts.prompt_map import prod_prompt,dev_prompt
+from chainlit.input_widget import Select, Switch
+from modules.engine.engine_factory import engine_manager, CONFIG
+from modules.engine.admission import QueueFullError
+from modules.engine.dual_perspective import DualPerspective
+from modules.utils.cancellation import CancellationToken
+from modules.utils.metrics import tracer
+from modules.webui.token_flusher import TokenFlusher
+from modules.prompts.prompt_map import prod_prompt,dev_prompt,prod_refusal,dev_refusal
 
 
 ui_exe_file_path = __file__
 
 
-ROLE_NAME_TO_KEY = {"产品视角 -> 译给开发": "to_dev", "开发视角 -> 译给产品": "to_prod"}
-MODEL_OPTIONS = {"在线引擎 (OpenAI)": "openai","本地引擎": "local" }
+ROLE_NAME_TO_KEY = {"产品视角 -> 译给开发": "to_dev", "开发视角 -> 译给产品": "to_prod", "自动识别方向": "auto"}
+MODEL_OPTIONS = {"在线引擎 (OpenAI)": "openai","本地引擎": "local", "自动选择": "auto" }
 
 
 
@@ -17,6 +21,10 @@ ROLE_MAP = {
     "to_dev": {"name": "研发技术视角", "icon": "⚙️", "description": "业务->技术", "prompt": dev_prompt},
     "to_prod": {"name": "产品业务视角", "icon": "📈", "description": "技术->业务", "prompt": prod_prompt}
 }
+OPPOSITE_ROLE = {"to_dev": "to_prod", "to_prod": "to_dev"}
+ROLE_REFUSALS = {"to_dev": dev_refusal, "to_prod": prod_refusal}
+# 自动识别方向：业务描述译给开发，技术方案译给产品
+INTENT_ROLES = {"business": "to_dev", "technical": "to_prod"}
 
 
 
@@ -28,12 +36,15 @@ async def start_chat():
     cl.user_session.set("history", [])
     cl.user_session.set("role", "to_dev")
     cl.user_session.set("engine_type", "openai") # 默认在线
+    cl.user_session.set("dual", False)
+    cl.user_session.set("auto_role", False)
 
 
     # 设置侧边栏：角色切换 + 模型切换
     await cl.ChatSettings([
         Select(id="role_select", label="🔄 翻译方向", values=list(ROLE_NAME_TO_KEY.keys()), initial_index=0),
-        Select(id="engine_select", label="🤖 推理引擎", values=list(MODEL_OPTIONS.keys()), initial_index=0)
+        Select(id="engine_select", label="🤖 推理引擎", values=list(MODEL_OPTIONS.keys()), initial_index=0),
+        Switch(id="dual_select", label="🔀 同时生成两个视角", initial=False)
     ]).send()
 
     # 发送欢迎语和快捷按钮
@@ -72,6 +83,7 @@ async def start_chat():
 async def update_role_status(new_role_key):
     """同步角色状态并发送 UI 反馈"""
     cl.user_session.set("role", new_role_key)
+    cl.user_session.set("auto_role", False)
     role_info = ROLE_MAP[new_role_key]
 
     status_text = f"✨ **当前模式：{role_info['name']}** ({role_info['description']})"
@@ -95,11 +107,18 @@ async def on_suggest_click(action):
 async def on_settings_update(settings):
     if "role_select" in settings:
         role_key = ROLE_NAME_TO_KEY[settings["role_select"]]
-        await update_role_status(role_key)
+        if role_key == "auto":
+            cl.user_session.set("auto_role", True)
+            await cl.Message(content="✨ **当前模式：自动识别方向**（按输入内容选择译给开发 / 译给产品）", author="系统").send()
+        else:
+            await update_role_status(role_key)
 
     if "engine_select" in settings:
         cl.user_session.set("engine_type", MODEL_OPTIONS[settings["engine_select"]])
 
+    if "dual_select" in settings:
+        cl.user_session.set("dual", bool(settings["dual_select"]))
+
     await cl.Message(content=f"⚙️ 配置已更新：{settings.get('role_select', '')} | {settings.get('engine_select', '')}", author="系统").send()
 
 
@@ -107,11 +126,39 @@ async def on_settings_update(settings):
 @cl.action_callback("switch")
 async def on_action_switch(action):
     cl.user_session.set("role", action.payload["v"])
+    cl.user_session.set("auto_role", False)
     await cl.Message(content=f"✅ 已切换至：{ROLE_MAP[action.payload['v']]['name']}", author="系统").send()
 
+def invalidate_session_cache():
+    """ 历史被清空 / 截断后，本地引擎中该会话的 KV cache 与历史裁剪位置不再可用 """
+    engine_manager.history.forget_session(cl.user_session.get("id"))
+    if engine_manager.local_engine:
+        engine_manager.local_engine.invalidate_session(cl.user_session.get("id"))
+
+
+def cancel_generation(reason):
+    """ 停止当前会话正在进行的生成 """
+    cancel_token = cl.user_session.get("cancel_token")
+    if cancel_token is not None:
+        cancel_token.cancel(reason)
+
+
+@cl.on_stop
+async def on_stop():
+    cancel_generation("user_stopped")
+
+
+@cl.on_chat_end
+async def on_chat_end():
+    cancel_generation("user_left")
+    invalidate_session_cache()
+
+
 @cl.action_callback("clear")
 async def on_action_clear(action):
     cl.user_session.set("history", [])
+    cl.user_session.set("alternate", None)
+    invalidate_session_cache()
 
     await cl.Message(content="🗑️ 对话历史已清空", author="系统").send()
 
@@ -135,6 +182,16 @@ async def on_switch_retry(action):
 
     await action.remove()
 
+    # 双视角模式下另一视角的回答已生成，直接展示，无需重新生成
+    alternate = cl.user_session.get("alternate")
+    if last_query and alternate and alternate["q"] == last_query and alternate["role"] == target_role:
+        cl.user_session.set("alternate", None)
+        role_config = ROLE_MAP[target_role]
+        await cl.Message(content=alternate["answer"], author=f"{role_config['icon']} {role_config['name']} (已生成)").send()
+        append_history(last_query, alternate["answer"])
+        await send_quick_actions(target_role, last_query)
+        return
+
     #  自动触发重新翻译
     if last_query:
         # 发送一个小提示告知用户正在重译
@@ -145,49 +202,167 @@ async def on_switch_retry(action):
         await handle_message(retry_msg)
 
 
+def append_history(question, answer):
+    """ 只限制会话内保存的历史条数；送入模型的上下文由引擎外层按 token 预算裁剪（HISTORY_BUDGET_*） """
+    max_history = 100
+    history = cl.user_session.get("history", [])
+    history.append({"role": "user", "content": question})
+    history.append({"role": "assistant", "content": answer})
+    if len(history) > max_history * 2:
+        history = history[-(max_history * 2):]
+        invalidate_session_cache()
+    cl.user_session.set("history", history)
+
+
+async def send_quick_actions(current_role, question, alternate_ready=False):
+    """ 回复下方的快捷操作：换另一视角（双视角模式下已生成，可直接切换）+ 清空上下文 """
+    role_actions = []
+    suffix = "（已生成）" if alternate_ready else ""
+    if current_role == "to_dev":
+        role_actions.append(cl.Action(name= "switch_and_retry", payload={"v": "to_prod", "q": question}, label="📈 换成产品视角看这个需求" + suffix ))
+    else:
+        role_actions.append(cl.Action(name= "switch_and_retry", payload={"v": "to_dev", "q": question}, label="⚙️ 换成研发视角看这个方案" + suffix ))
+
+    # 添加一个清空按钮，随时可以重置
+    role_actions.append(cl.Action(name= "clear", payload={"v": "clear"}, label="🗑️ 清空上下文" ))
+
+    # 发送状态栏（它会紧跟在回复下面）
+    await cl.Message( content= "--- \n**💡 快捷操作：**" , actions=role_actions ).send()
+
+
+async def reply_off_topic(intent):
+    """ 意图识别判定为无关输入：直接给出当前角色的固定回复，不写入会话历史 """
+    role_key = cl.user_session.get("role", "to_dev")
+    role_config = ROLE_MAP[role_key]
+    trace = tracer.start("ui_message", entry="ui", role=role_key, engine="intent", stream=True)
+    trace.set(intent=intent.label, intent_confidence=round(intent.confidence, 4))
+    await cl.Message(content=ROLE_REFUSALS[role_key], author=f"{role_config['icon']} {role_config['name']}").send()
+    tracer.finish(trace, "off_topic")
+
+
 @cl.on_message
 async def handle_message(message: cl.Message):
 
-    max_history = 10
+    # 新问题到来后，上一问题另一视角的回答不再适用
+    cl.user_session.set("alternate", None)
+    history = cl.user_session.get("history", [])
+    has_history = bool(history)
+
+    # 轻量意图识别：自动识别方向时按识别结果选择角色；明显无关的输入直接回复，不再调用大模型
+    intent = engine_manager.intent.decide(message.content, has_history=has_history)
+    if cl.user_session.get("auto_role") and intent.domain_label in INTENT_ROLES:
+        cl.user_session.set("role", INTENT_ROLES[intent.domain_label])
+    if intent.rejected:
+        await reply_off_topic(intent)
+        return
+
+    if cl.user_session.get("dual", False):
+        await handle_dual_message(message)
+        return
+
     # 1. 获取当前状态
     role_key = cl.user_session.get("role", "to_dev")
     engine_type = cl.user_session.get("engine_type", "local")
     role_config = ROLE_MAP[role_key]
-    history = cl.user_session.get("history", [])
+    trace = tracer.start(
+        "ui_message",
+        entry="ui",
+        role=role_key,
+        engine=engine_type if engine_type == "auto" else engine_manager.engine_key(engine_type),
+        stream=True
+    )
+    if intent.label is not None:
+        trace.set(intent=intent.label, intent_confidence=round(intent.confidence, 4))
 
-    # 2. 匹配引擎
-    engine = engine_manager.local_engine if engine_type == "local" else engine_manager.openai_engine
-    sleep_time = 0.005 if engine_type == "local" else  0.01
+    # 2. 匹配引擎（首次使用时加载）+ 准入控制：UI 请求按交互优先级排队；auto 时按负载与健康状况选择引擎
+    if engine_type != "auto" and engine_manager.state(engine_type) != "ready":
+        await cl.Message(content="⏳ 引擎加载中，请稍候...", author="系统").send()
+    try:
+        decision = await engine_manager.router.acquire(engine_type, "interactive")
+    except QueueFullError as e:
+        tracer.finish(trace, "rejected")
+        await cl.Message(content=f"⏳ 当前使用人数较多，请约 {e.retry_after} 秒后重试。", author="系统").send()
+        return
 
-    if not engine:
+    if decision.engine is None:
+        tracer.finish(trace, "unavailable")
         await cl.Message(content="❌ 该引擎未就绪，请检查 API 配置。", author="系统").send()
         return
+    ticket = decision.ticket
+    engine_label = decision.key.upper() if engine_type != "auto" else f"AUTO → {decision.key.upper()}"
 
     # 准备 UI
-    msg = cl.Message(content= "", author=f"{role_config['icon']} {role_config['name']} ({engine_type.upper()}) " )
+    msg = cl.Message(content= "", author=f"{role_config['icon']} {role_config['name']} ({engine_label}) " )
     await msg.send()
 
     # 生成回复时，在前缀中再次强调
     prefix = f"---\n  **当前视角：** {role_config['name']} {role_config['description']} 转译中...\n\n"
     await msg.stream_token(prefix)
 
+    cancel_token = CancellationToken()
+    cl.user_session.set("cancel_token", cancel_token)
+    status = "cancelled"
+
     try:
+        # 排队期间展示排队位置
+        if ticket is not None and not ticket.admitted:
+            queue_msg = cl.Message(content="", author="系统")
+            queue_msg_sent = False
+            async for position in ticket.positions():
+                if cancel_token.cancelled:
+                    return
+                queue_msg.content = f"⏳ 排队中，前面还有 {position - 1} 个请求..."
+                if queue_msg_sent:
+                    await queue_msg.update()
+                else:
+                    await queue_msg.send()
+                    queue_msg_sent = True
+            if queue_msg_sent:
+                await queue_msg.remove()
+
         # todo 这里需要优化不同角色针对不同问题的提示词
-        stream = engine.generate_response(
+        stream = engine_manager.router.astream(
+            decision,
             user_query=message.content,
             history=history,
             sys_prompt=role_config["prompt"],
-            stream=True
+            priority="interactive",
+            session_id=cl.user_session.get("id"),
+            cancel_token=cancel_token
         )
 
-        full_response = ""
-        for token in stream:
-            if token:
-                await msg.stream_token(token)
-                full_response += token
-                await asyncio.sleep(sleep_time)
+        trace.set(queue_time=ticket.queue_wait_time if ticket else 0.0)
+        # token 只放入缓冲，由后台任务按时间窗口 / 字节数合并成帧写出，不再逐 token 发送与等待
+        flusher = TokenFlusher(
+            msg.stream_token,
+            interval=CONFIG["ui_flush_interval"],
+            max_bytes=CONFIG["ui_flush_max_bytes"]
+        ).start()
+        chunks = []
+        try:
+            async for token in stream:
+                if cancel_token.cancelled:
+                    break
+                if token:
+                    trace.mark_first_token()
+                    flusher.push(token)
+                    chunks.append(token)
+            await flusher.aclose()
+        finally:
+            # 用户停止 / 离开导致任务被取消时，同样停止引擎侧的生成
+            flusher.abort()
+            await stream.aclose()
+            trace.completion_tokens = flusher.tokens
+            trace.accumulate("stream_write", flusher.send_time)
+            trace.set(stream_frames=flusher.frames)
+        full_response = "".join(chunks)
+
+        if cancel_token.cancelled:
+            await msg.update()
+            return
 
         await msg.update()
+        status = "error" if any(chunk.startswith("❌") for chunk in chunks) else "ok"
 
         current_role = cl.user_session.get(
             "role"
@@ -216,28 +391,135 @@ async def handle_message(message: cl.Message):
         # await cl.Message(content="**您可能还想了解：**",actions=actions).send()
 
 
-        role_actions = []
-        if current_role == "to_dev":
-            role_actions.append(cl.Action(name= "switch_and_retry", payload={"v": "to_prod", "q": message.content}, label="📈 换成产品视角看这个需求" ))
-        else:
-            role_actions.append(cl.Action(name= "switch_and_retry", payload={"v": "to_dev", "q": message.content}, label="⚙️ 换成研发视角看这个方案" ))
+        # 3. 发送状态栏（它会紧跟在回复下面）
+        await send_quick_actions(current_role, message.content)
 
-        # 添加一个清空按钮，随时可以重置
-        role_actions.append(cl.Action(name= "clear", payload={"v": "clear"}, label="🗑️ 清空上下文" ))
+        # 5. 更新历史
+        append_history(message.content, full_response)
+        await engine_manager.intent.alog_traffic(message.content, role_key, full_response, intent, has_history, "ui")
 
-        # 3. 发送状态栏（它会紧跟在回复下面）
-        await cl.Message( content= "--- \n**💡 快捷操作：**" , actions=role_actions ).send()
+    except Exception as e:
+        status = "error"
+        await cl.Message(content=f"❌ 翻译出错: {str(e)}", author="系统").send()
+    finally:
+        decision.release()
+        trace.set(engine=decision.served_by or decision.key)
+        tracer.finish(trace, status)
+
+async def handle_dual_message(message: cl.Message):
+    """
+    双视角模式：当前视角与另一视角同时生成，分别写入两条消息；
+    会话历史沿当前视角继续，另一视角的回答暂存，点击切换时直接展示
+    """
+    role_key = cl.user_session.get("role", "to_dev")
+    other_key = OPPOSITE_ROLE[role_key]
+    engine_type = cl.user_session.get("engine_type", "local")
+    history = cl.user_session.get("history", [])
+    trace = tracer.start(
+        "ui_message",
+        entry="ui",
+        role="both",
+        engine=engine_type if engine_type == "auto" else engine_manager.engine_key(engine_type),
+        stream=True
+    )
 
+    if engine_type != "auto" and engine_manager.state(engine_type) != "ready":
+        await cl.Message(content="⏳ 引擎加载中，请稍候...", author="系统").send()
+    try:
+        pair = await DualPerspective.acquire(engine_manager.router, engine_type, [role_key, other_key], "interactive")
+    except QueueFullError as e:
+        tracer.finish(trace, "rejected")
+        await cl.Message(content=f"⏳ 当前使用人数较多，请约 {e.retry_after} 秒后重试。", author="系统").send()
+        return
 
-        # 5. 更新历史
-        history.append({"role": "user", "content": message.content})
-        history.append({"role": "assistant", "content": full_response})
-        if len(history) > max_history * 2:
-            history = history[-(max_history * 2):]
-        cl.user_session.set("history", history)
+    if pair.unavailable is not None:
+        pair.release()
+        tracer.finish(trace, "unavailable")
+        await cl.Message(content="❌ 该引擎未就绪，请检查 API 配置。", author="系统").send()
+        return
+
+    messages = {}
+    for key in (role_key, other_key):
+        role_config = ROLE_MAP[key]
+        engine_label = pair.decisions[key].key.upper() if engine_type != "auto" else f"AUTO → {pair.decisions[key].key.upper()}"
+        messages[key] = cl.Message(content="", author=f"{role_config['icon']} {role_config['name']} ({engine_label}) ")
+        await messages[key].send()
+        await messages[key].stream_token(f"---\n  **{role_config['name']}** {role_config['description']} 转译中...\n\n")
+
+    cancel_token = CancellationToken()
+    cl.user_session.set("cancel_token", cancel_token)
+    status = "cancelled"
+    flushers = {}
+
+    try:
+        if not pair.admitted:
+            queue_msg = cl.Message(content="", author="系统")
+            queue_msg_sent = False
+            async for position in pair.positions():
+                if cancel_token.cancelled:
+                    return
+                queue_msg.content = f"⏳ 排队中，前面还有 {position - 1} 个请求..."
+                if queue_msg_sent:
+                    await queue_msg.update()
+                else:
+                    await queue_msg.send()
+                    queue_msg_sent = True
+            if queue_msg_sent:
+                await queue_msg.remove()
+
+        stream = pair.astream(
+            message.content,
+            prompts={key: ROLE_MAP[key]["prompt"] for key in (role_key, other_key)},
+            history=history,
+            priority="interactive",
+            session_id=cl.user_session.get("id"),
+            cancel_token=cancel_token
+        )
+        trace.set(queue_time=pair.queue_wait_time)
+        flushers = {
+            key: TokenFlusher(msg.stream_token, interval=CONFIG["ui_flush_interval"], max_bytes=CONFIG["ui_flush_max_bytes"]).start()
+            for key, msg in messages.items()
+        }
+        chunks = {key: [] for key in messages}
+        try:
+            async for key, token in stream:
+                if cancel_token.cancelled:
+                    break
+                if token:
+                    trace.mark_first_token()
+                    flushers[key].push(token)
+                    chunks[key].append(token)
+            for flusher in flushers.values():
+                await flusher.aclose()
+        finally:
+            for flusher in flushers.values():
+                flusher.abort()
+            await stream.aclose()
+            trace.completion_tokens = sum(flusher.tokens for flusher in flushers.values())
+            trace.accumulate("stream_write", sum(flusher.send_time for flusher in flushers.values()))
+            trace.set(stream_frames=sum(flusher.frames for flusher in flushers.values()))
+        answers = {key: "".join(chunks[key]) for key in chunks}
+
+        for msg in messages.values():
+            await msg.update()
+        if cancel_token.cancelled:
+            return
+        status = "error" if any(answer.startswith("❌") for answer in answers.values()) else "ok"
+
+        append_history(message.content, answers[role_key])
+        alternate_ready = not answers[other_key].startswith("❌")
+        if alternate_ready:
+            cl.user_session.set("alternate", {"q": message.content, "role": other_key, "answer": answers[other_key]})
+        await send_quick_actions(role_key, message.content, alternate_ready)
 
     except Exception as e:
+        status = "error"
         await cl.Message(content=f"❌ 翻译出错: {str(e)}", author="系统").send()
+    finally:
+        pair.release()
+        trace.set(engine=",".join(f"{key}:{served}" for key, served in pair.served_by.items()))
+        tracer.finish(trace, status)
+
 
 if __name__ == "__main__":
     from chainlit.cli import run_chainlit
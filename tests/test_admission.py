@@ -0,0 +1,190 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from modules.api.api import chat_with_translation, router
+from modules.api.api_params import ChatWithTranslationParams
+from modules.benchmark.fake_engine import FakeEngine
+from modules.benchmark.routing import reset_manager
+from modules.engine.admission import AdmissionController, QueueFullError
+
+
+"""
+准入控制测试：优先级排序、排队已满时 429 + Retry-After、引擎未就绪时 503、排队中取消让出位置、排队时间与生成时间分开统计
+运行: python -m pytest -q tests
+"""
+
+
+def test_interactive_admitted_before_batch():
+    async def main():
+        controller = AdmissionController("local", max_in_flight=1, max_queued=8)
+        running = controller.submit("batch")
+        batch = controller.submit("batch")
+        interactive = controller.submit("interactive")
+        assert running.admitted and not batch.admitted and not interactive.admitted
+        # 后到的交互请求排在批量请求前面
+        assert interactive.position == 1 and batch.position == 2
+
+        running.release()
+        assert interactive.admitted and not batch.admitted
+        interactive.release()
+        assert batch.admitted
+        batch.release()
+        return controller.stats()
+
+    stats = asyncio.run(main())
+    assert stats["in_flight"] == 0 and stats["admitted_total"] == 3
+
+
+def test_same_priority_is_fifo():
+    async def main():
+        controller = AdmissionController("local", max_in_flight=1, max_queued=8)
+        running = controller.submit("batch")
+        first, second = controller.submit("batch"), controller.submit("batch")
+        running.release()
+        return first.admitted, second.admitted
+
+    assert asyncio.run(main()) == (True, False)
+
+
+def test_queue_full_raises_with_retry_after():
+    async def main():
+        controller = AdmissionController("local", max_in_flight=1, max_queued=1, initial_service_time=4.0)
+        controller.submit("batch")
+        controller.submit("batch")
+        with pytest.raises(QueueFullError) as e:
+            controller.submit("batch")
+        return e.value, controller.stats()
+
+    error, stats = asyncio.run(main())
+    assert error.queued == 1
+    # 1 个排队 + 本请求，按每个名额平均 4s 估算
+    assert error.retry_after == 8
+    assert stats["rejected_total"] == 1
+
+
+def test_cancel_while_queued_frees_position():
+    async def main():
+        controller = AdmissionController("local", max_in_flight=1, max_queued=2)
+        running = controller.submit("batch")
+        first, second = controller.submit("batch"), controller.submit("batch")
+        assert second.position == 2
+        first.release()
+        assert second.position == 1
+        # 取消后空出的排队位置可以再次提交
+        third = controller.submit("batch")
+        running.release()
+        return first, second, third, controller.stats()
+
+    first, second, third, stats = asyncio.run(main())
+    assert not first.admitted and second.admitted and not third.admitted
+    assert stats["cancelled_total"] == 1 and stats["in_flight"] == 1 and stats["queued"] == 1
+
+
+def test_queue_wait_reported_separately_from_service_time():
+    async def main():
+        controller = AdmissionController("local", max_in_flight=1, max_queued=1)
+        running = controller.submit("batch")
+        queued = controller.submit("batch")
+        asyncio.get_running_loop().call_later(0.2, running.release)
+        await queued.wait()
+        await asyncio.sleep(0.1)
+        queued.release()
+        return queued
+
+    ticket = asyncio.run(main())
+    assert 0.15 < ticket.queue_wait_time < 0.3
+    assert 0.05 < ticket.service_time < 0.2
+
+
+# ============ 接口 ============ #
+
+
+@pytest.fixture
+def manager():
+    manager = reset_manager(
+        "priority",
+        local=FakeEngine(num_tokens=4, token_latency=0.001, name="local"),
+        openai=FakeEngine(num_tokens=4, token_latency=0.001, name="openai"),
+        local_max_in_flight=1,
+        local_max_queued=0
+    )
+    yield manager
+    manager.__dict__.pop("aget_engine", None)
+
+
+def post(body):
+    app = FastAPI()
+    app.include_router(router, prefix="/api")
+
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return await client.post("/api/chat_with_translation_agent", json={"role": "to_dev", "user_question": "q", **body})
+
+    return asyncio.run(main())
+
+
+def test_api_returns_429_with_retry_after_when_queue_full(manager):
+    # 唯一的名额被占用且不允许排队
+    manager.get_admission("local").submit("batch")
+    response = post({"engine_type": "local"})
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert response.json()["data"]["retry_after"] == int(response.headers["Retry-After"])
+
+
+def test_api_returns_503_when_engine_unavailable(manager):
+    async def unavailable(engine_type):
+        return None
+
+    manager.aget_engine = unavailable
+    response = post({"engine_type": "openai"})
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+
+
+def test_api_reports_queue_time_separately(manager):
+    async def main():
+        manager.admission["local"] = AdmissionController("local", max_in_flight=1, max_queued=4)
+        hog = manager.admission["local"].submit("batch")
+        asyncio.get_running_loop().call_later(0.3, hog.release)
+        app = FastAPI()
+        app.include_router(router, prefix="/api")
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return await client.post("/api/chat_with_translation_agent", json={"engine_type": "local", "role": "to_dev", "user_question": "q"})
+
+    timing = asyncio.run(main()).json()["data"]["timing"]
+    assert timing["queue_time"] >= 0.25
+    assert timing["generation_time"] < 0.25
+
+
+class DisconnectedRequest:
+    """ 排队期间已断开的客户端 """
+    headers = {}
+
+    async def is_disconnected(self):
+        return True
+
+
+def test_non_stream_disconnect_while_queued_cancels_ticket(manager):
+    async def main():
+        controller = manager.admission["local"] = AdmissionController("local", max_in_flight=1, max_queued=4)
+        hog = controller.submit("batch")
+        start = time.perf_counter()
+        result = await asyncio.wait_for(
+            chat_with_translation(ChatWithTranslationParams(engine_type="local", role="to_dev", user_question="q"), DisconnectedRequest()),
+            timeout=5
+        )
+        elapsed = time.perf_counter() - start
+        stats = controller.stats()
+        hog.release()
+        return result, elapsed, stats
+
+    result, elapsed, stats = asyncio.run(main())
+    assert result["status_code"] == 499
+    # 不必等到准入：断开后立即取消排队、让出位置
+    assert elapsed < 1.0
+    assert stats["queued"] == 0 and stats["cancelled_total"] == 1 and stats["in_flight"] == 1
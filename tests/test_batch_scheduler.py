@@ -0,0 +1,194 @@
+import threading
+
+import pytest
+import torch
+from transformers import Qwen2Config, Qwen2ForCausalLM, StoppingCriteriaList
+
+from modules.llm.batch_scheduler import ContinuousBatchScheduler, GenerationRequest
+from modules.llm.kv_cache import CachedPrefix, to_legacy_cache
+from modules.llm.local_model import CancellationStoppingCriteria
+from modules.utils.cancellation import CancellationToken
+
+
+"""
+连续批处理调度器测试：随机初始化的小 Qwen2 模型（CPU），贪心解码结果与 model.generate 逐 token 一致
+（覆盖不同长度 prompt 的左侧 padding 合并、序列结束后移出、token 粒度准入与前缀缓存），以及取消与出错时的行为
+运行: python -m pytest -q tests
+"""
+
+
+EOS = 2
+PROMPTS = [
+    [5, 17, 42, 8, 99, 23, 61],
+    [7, 3],
+    [11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22],
+    [250, 31, 77, 4, 9],
+]
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    config = Qwen2Config(
+        vocab_size=256,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=256,
+        eos_token_id=EOS,
+        pad_token_id=0,
+    )
+    # float64 避免不同 batch 组合下的数值误差改变贪心结果
+    return Qwen2ForCausalLM(config).double().eval()
+
+
+def reference(model, prompt, max_new_tokens):
+    """ model.generate 的贪心结果（去掉 eos） """
+    with torch.no_grad():
+        output = model.generate(
+            torch.tensor([prompt]),
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            eos_token_id=EOS,
+            pad_token_id=0,
+        )
+    generated = output[0, len(prompt):].tolist()
+    return generated[:generated.index(EOS)] if EOS in generated else generated
+
+
+class CollectingStreamer:
+    """ 记录调度器写入 streamer 的内容；收到 cancel_after 个 token 后置位取消令牌 """
+    def __init__(self, cancel_token=None, cancel_after=None):
+        self.tokens = []
+        self.errors = []
+        self.prompt_received = False
+        self.ended = threading.Event()
+        self.cancel_token = cancel_token
+        self.cancel_after = cancel_after
+
+    def put(self, value):
+        if not self.prompt_received:
+            self.prompt_received = True
+            return
+        self.tokens.extend(value.tolist())
+        if self.cancel_after is not None and len(self.tokens) >= self.cancel_after:
+            self.cancel_token.cancel("test")
+
+    def on_finalized_text(self, text, stream_end=False):
+        self.errors.append(text)
+
+    def end(self):
+        self.ended.set()
+
+
+def greedy_request(prompt, max_new_tokens, **kwargs):
+    return GenerationRequest(
+        input_ids=prompt,
+        max_new_tokens=max_new_tokens,
+        temperature=1.0,
+        top_p=1.0,
+        top_k=1,
+        eos_token_ids=[EOS],
+        **kwargs
+    )
+
+
+def run_scheduler(model, requests, max_batch_size=4):
+    scheduler = ContinuousBatchScheduler(model, "cpu", max_batch_size=max_batch_size)
+    try:
+        for request in requests:
+            scheduler.submit(request)
+        for request in requests:
+            request.wait(timeout=60)
+            assert request.finished
+        return scheduler.stats()
+    finally:
+        scheduler.stop()
+
+
+@pytest.mark.parametrize("max_batch_size", [4, 2])
+def test_greedy_output_matches_generate(model, max_batch_size):
+    # 不同的 max_new_tokens 让序列在不同步结束，覆盖移出与空位上的 token 粒度准入
+    lengths = [12, 5, 9, 16]
+    requests = [greedy_request(prompt, n) for prompt, n in zip(PROMPTS, lengths)]
+    stats = run_scheduler(model, requests, max_batch_size)
+    for request, prompt, n in zip(requests, PROMPTS, lengths):
+        assert request.generated_ids == reference(model, prompt, n)
+    assert stats["total_finished"] == len(requests)
+    assert stats["avg_batch_size"] > 1
+
+
+def test_prefix_cache_matches_generate(model):
+    prompt = PROMPTS[2]
+    with torch.no_grad():
+        outputs = model(input_ids=torch.tensor([prompt[:8]]), use_cache=True)
+    prefix = CachedPrefix(prompt[:8], to_legacy_cache(outputs.past_key_values))
+    cached = greedy_request(prompt, 10, prefix=prefix)
+    assert cached.prefix is not None
+
+    requests = [cached, greedy_request(PROMPTS[0], 10), greedy_request(PROMPTS[1], 10)]
+    run_scheduler(model, requests)
+    assert cached.generated_ids == reference(model, prompt, 10)
+    assert requests[1].generated_ids == reference(model, PROMPTS[0], 10)
+
+
+def test_cancelled_sequence_leaves_others_intact(model):
+    cancel_token = CancellationToken()
+    streamer = CollectingStreamer(cancel_token, cancel_after=3)
+    cancelled = greedy_request(PROMPTS[0], 30, streamer=streamer, cancel_token=cancel_token)
+    others = [greedy_request(prompt, 16) for prompt in PROMPTS[1:]]
+
+    run_scheduler(model, [cancelled] + others)
+    assert cancelled.finish_reason == "cancelled"
+    # 令牌在调度线程写出第 3 个 token 时置位，下一个解码步即移出 batch
+    assert cancelled.generated_ids == reference(model, PROMPTS[0], 30)[:3]
+    assert streamer.ended.is_set() and not streamer.errors
+    for request, prompt in zip(others, PROMPTS[1:]):
+        assert request.finish_reason in ("stop", "length")
+        assert request.generated_ids == reference(model, prompt, 16)
+
+
+def test_error_is_surfaced_through_streamer(model, monkeypatch):
+    original = ContinuousBatchScheduler._decode_step
+    calls = {"steps": 0}
+
+    def failing_step(self):
+        calls["steps"] += 1
+        if calls["steps"] == 3:
+            raise RuntimeError("simulated decode failure")
+        return original(self)
+
+    monkeypatch.setattr(ContinuousBatchScheduler, "_decode_step", failing_step)
+    streamer = CollectingStreamer()
+    request = greedy_request(PROMPTS[0], 20, streamer=streamer)
+    scheduler = ContinuousBatchScheduler(model, "cpu", max_batch_size=4)
+    try:
+        scheduler.submit(request)
+        with pytest.raises(RuntimeError, match="simulated decode failure"):
+            request.wait(timeout=60)
+        assert request.finish_reason == "error"
+        # 异常对象先于结束放入 streamer，消费方据此判定失败而不是截断的正常回复
+        assert streamer.ended.is_set()
+        assert len(streamer.errors) == 1 and isinstance(streamer.errors[0], RuntimeError)
+
+        # 调度线程继续服务后续请求
+        monkeypatch.setattr(ContinuousBatchScheduler, "_decode_step", original)
+        follow_up = greedy_request(PROMPTS[1], 8)
+        scheduler.submit(follow_up)
+        assert follow_up.wait(timeout=60) == reference(model, PROMPTS[1], 8)
+    finally:
+        scheduler.stop()
+
+
+def test_cancellation_stopping_criteria(model):
+    cancel_token = CancellationToken()
+    criteria = StoppingCriteriaList([CancellationStoppingCriteria(cancel_token)])
+    with torch.no_grad():
+        full = model.generate(torch.tensor([PROMPTS[0]]), max_new_tokens=8, min_new_tokens=8, do_sample=False, pad_token_id=0, stopping_criteria=criteria)
+        cancel_token.cancel("test")
+        stopped = model.generate(torch.tensor([PROMPTS[0]]), max_new_tokens=8, min_new_tokens=8, do_sample=False, pad_token_id=0, stopping_criteria=criteria)
+    assert full.shape[1] == len(PROMPTS[0]) + 8
+    # 取消后第一步即停止
+    assert stopped.shape[1] == len(PROMPTS[0]) + 1
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from modules.benchmark.fake_engine import FakeEngine
+from modules.benchmark.routing import reset_manager
+from modules.engine.dual_perspective import DualPerspective
+
+
+"""
+双视角生成测试：两路各自准入、各自释放，准入名额不足或多个双视角请求并发时不会死锁
+运行: python -m pytest -q tests
+"""
+
+
+ROLES = ["to_dev", "to_product"]
+PROMPTS = {"to_dev": "dev", "to_product": "product"}
+
+
+def manager_with(max_in_flight, load_delay=0.0):
+    manager = reset_manager(
+        "priority",
+        local=FakeEngine(num_tokens=4, token_latency=0.001, name="local"),
+        openai=FakeEngine(num_tokens=4, token_latency=0.001, name="openai"),
+        local_max_in_flight=max_in_flight
+    )
+    if load_delay:
+        # 模拟引擎加载：两个角色的准入之间让出事件循环，并发请求的准入交错进行
+        get_engine = manager.aget_engine
+
+        async def slow_get_engine(engine_type):
+            await asyncio.sleep(load_delay)
+            return await get_engine(engine_type)
+
+        manager.aget_engine = slow_get_engine
+    return manager
+
+
+async def run_pair(manager, question, stream=True):
+    pair = await DualPerspective.acquire(manager.router, "local", ROLES, "batch")
+    try:
+        if not stream:
+            return await pair.agenerate(question, PROMPTS, history=[])
+        answers = {role: "" for role in ROLES}
+        async for role, token in pair.astream(question, PROMPTS, history=[]):
+            answers[role] += token
+        return answers
+    finally:
+        pair.release()
+
+
+def run_all(manager, count, stream=True):
+    async def main():
+        results = await asyncio.wait_for(
+            asyncio.gather(*[run_pair(manager, f"q{i}", stream) for i in range(count)]),
+            timeout=10
+        )
+        return results, manager.get_admission("local").stats()
+
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_single_slot_does_not_deadlock(stream):
+    results, stats = run_all(manager_with(max_in_flight=1), 1, stream)
+    assert all(results[0][role] for role in ROLES)
+    assert stats["in_flight"] == 0 and stats["queued"] == 0
+
+
+@pytest.mark.parametrize("max_in_flight", [1, 2, 3])
+def test_concurrent_pairs_do_not_deadlock(max_in_flight):
+    # 每个请求先拿到一个名额后再去准入第二个角色，旧实现在此持有名额互相等待
+    results, stats = run_all(manager_with(max_in_flight, load_delay=0.01), 4)
+    assert len(results) == 4
+    assert all(answers[role] for answers in results for role in ROLES)
+    assert stats["in_flight"] == 0 and stats["queued"] == 0
+    assert stats["admitted_total"] == 8
+
+
+def test_both_roles_run_together_when_slots_allow():
+    async def main():
+        manager = manager_with(max_in_flight=2)
+        pair = await DualPerspective.acquire(manager.router, "local", ROLES, "batch")
+        try:
+            assert pair.admitted and all(ticket.admitted for ticket in pair.tickets)
+            assert manager.get_admission("local").stats()["in_flight"] == 2
+        finally:
+            pair.release()
+        return manager.get_admission("local").stats()
+
+    assert asyncio.run(main())["in_flight"] == 0
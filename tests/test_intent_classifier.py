@@ -0,0 +1,108 @@
+import argparse
+import asyncio
+import json
+
+import pytest
+
+from modules.intent.classifier import IntentClassifier, LABELS, extract_features
+from modules.intent.train_intent import SEED_PATH, evaluate, fit, load_samples, split
+
+
+"""
+意图识别测试：TF-IDF + SGD logistic 回归的训练、预测、拦截阈值、模型保存 / 加载与流量记录
+运行: python -m pytest -q tests
+"""
+
+
+def train_args(threshold=0.85):
+    return argparse.Namespace(min_df=1, max_features=20000, epochs=30, learning_rate=0.5, l2=1e-4, seed=0, threshold=threshold)
+
+
+@pytest.fixture(scope="module")
+def samples():
+    samples, sources = load_samples(SEED_PATH, [])
+    assert sources["seed"] == len(samples)
+    return samples
+
+
+@pytest.fixture(scope="module")
+def classifier(samples):
+    return fit(samples, train_args())
+
+
+def test_features_cover_cjk_ngrams_and_ascii_terms():
+    features = extract_features("优化MySQL慢查询")
+    assert features["优化"] == 1 and features["慢查询"] == 1
+    assert features["w:mysql"] == 1
+
+
+def test_fits_training_data(classifier, samples):
+    correct = 0
+    for text, label in samples:
+        probabilities = classifier.predict(text)
+        assert set(probabilities) == set(LABELS)
+        assert abs(sum(probabilities.values()) - 1.0) < 1e-6
+        correct += max(probabilities, key=probabilities.get) == label
+    assert correct / len(samples) > 0.95
+
+
+def test_generalizes_to_held_out_split(samples):
+    train, held_out = split(samples, 0.2, seed=0)
+    report = evaluate(fit(train, train_args()), held_out, [0.5, 0.85])
+    assert report["samples"] == len(held_out)
+    assert report["accuracy"] >= 0.7
+
+
+def test_rejection_threshold(classifier):
+    question = "今天天气怎么样？"
+    decision = classifier.decide(question)
+    assert decision.label == "off_topic"
+
+    classifier.threshold = decision.confidence - 1e-6
+    assert classifier.decide(question).action == "reject"
+    # 带历史的追问依赖上下文，不拦截
+    assert classifier.decide(question, has_history=True).action == "defer"
+    # 置信度不足阈值时交给大模型
+    classifier.threshold = decision.confidence + 1e-6
+    assert classifier.decide(question).action == "defer"
+    classifier.threshold = 0.85
+
+
+def test_in_domain_is_never_rejected_and_picks_direction(classifier):
+    classifier.threshold = 0.0
+    try:
+        business = classifier.decide("希望用户下单后能收到短信提醒，提升复购率")
+        technical = classifier.decide("接口 QPS 上来后 Redis 缓存击穿导致 MySQL 压力过大")
+    finally:
+        classifier.threshold = 0.85
+    assert business.action == "accept" and business.domain_label == "business"
+    assert technical.action == "accept" and technical.domain_label == "technical"
+
+
+def test_save_and_load_round_trip(classifier, tmp_path):
+    path = tmp_path / "intent.json"
+    classifier.save(str(path))
+    loaded = IntentClassifier.load(str(path), threshold=0.85)
+    assert loaded.enabled
+    for text in ("怎么做红烧肉", "订单表需要按用户 id 分库分表"):
+        expected, actual = classifier.predict(text), loaded.predict(text)
+        assert all(abs(expected[k] - actual[k]) < 1e-4 for k in LABELS)
+
+
+def test_missing_model_disables_gate(tmp_path):
+    classifier = IntentClassifier.load(str(tmp_path / "missing.json"))
+    assert not classifier.enabled
+    assert classifier.decide("今天天气怎么样？").action == "disabled"
+
+
+def test_traffic_log_written_off_loop(classifier, tmp_path):
+    classifier.log_path = str(tmp_path / "traffic.jsonl")
+    decision = classifier.decide("接口超时怎么排查")
+    try:
+        asyncio.run(classifier.alog_traffic("接口超时怎么排查", "to_product", "回答", decision, entry="test"))
+    finally:
+        classifier.log_path = ""
+    with open(tmp_path / "traffic.jsonl", encoding="utf-8") as f:
+        record = json.loads(f.readline())
+    assert record["question"] == "接口超时怎么排查" and record["role"] == "to_product"
+    assert record["intent"]["label"] == decision.label
@@ -0,0 +1,96 @@
+import asyncio
+import socket
+
+import pytest
+
+from modules.benchmark.openai_stub import DEFAULT_BEHAVIOUR, StubServer
+from modules.benchmark.openai_resilience import build_model
+
+
+"""
+在线引擎容错（重试 / 对冲 / 熔断 / 断流）测试：对本地 OpenAI 兼容桩服务发起真实请求，断言结果与统计
+运行: python -m pytest -q tests
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture(scope="module")
+def stub():
+    with StubServer(port=free_port()) as server:
+        yield server
+
+
+def run(stub, behaviour, questions, **model_kwargs):
+    """ 按给定桩行为依次发起流式请求，返回 (回复列表, 客户端统计) """
+    stub.configure(**{**DEFAULT_BEHAVIOUR, "num_tokens": 8, "token_latency": 0.001, **behaviour})
+
+    async def main():
+        model = build_model(stub.base_url, **model_kwargs)
+        try:
+            answers = []
+            for question in questions:
+                answers.append("".join([chunk async for chunk in model.astream(question, [], "stub")]))
+            return answers, model.resilience_stats()
+        finally:
+            await model.aclose()
+
+    return asyncio.run(main())
+
+
+def test_retry_before_first_token(stub):
+    answers, stats = run(stub, {"fail_first": 2}, ["q"], max_retries=2, retry_backoff=0.01)
+    assert not answers[0].startswith("❌")
+    assert stats["retries"] == 2
+    assert stats["failures"] == 0
+    assert stub.state.requests == 3
+
+
+def test_retry_exhausted(stub):
+    answers, stats = run(stub, {"fail_first": 5}, ["q"], max_retries=1, retry_backoff=0.01)
+    assert answers[0].startswith("❌")
+    assert stats["retries"] == 1
+    assert stats["failures"] == 1
+    assert stub.state.requests == 2
+
+
+def test_hedge_wins_over_slow_first_attempt(stub):
+    # seed=2：第一个请求首 token 长尾 2s，对冲请求正常
+    behaviour = {"slow_rate": 0.5, "slow_delay": 2.0, "seed": 2}
+    answers, stats = run(stub, behaviour, ["q"], first_token_timeout=5.0, hedge_after=0.2)
+    assert not answers[0].startswith("❌")
+    assert stats["hedges"] == 1
+    assert stats["hedge_wins"] == 1
+    assert stub.state.requests == 2
+
+
+def test_first_token_timeout(stub):
+    answers, stats = run(stub, {"hang_rate": 1.0}, ["q"], first_token_timeout=0.3, max_retries=0)
+    assert answers[0].startswith("❌")
+    assert stats["first_token_timeouts"] == 1
+
+
+def test_midstream_error_is_not_retried(stub):
+    answers, stats = run(stub, {"drop_after": 3}, ["q"])
+    # 已输出的内容保留，以错误信息结尾，不重新请求（避免重复输出）
+    assert "❌" in answers[0] and not answers[0].startswith("❌")
+    assert stats["midstream_errors"] == 1
+    assert stats["retries"] == 0
+    assert stub.state.requests == 1
+
+
+def test_breaker_opens_and_fails_fast(stub):
+    answers, stats = run(
+        stub, {"error_rate": 1.0}, [f"q{i}" for i in range(5)],
+        max_retries=0, breaker_threshold=3, breaker_cooldown=30
+    )
+    assert all(answer.startswith("❌") for answer in answers)
+    assert stats["breaker"]["state"] == "open"
+    assert stats["breaker"]["trips"] == 1
+    assert stats["breaker"]["rejected"] == 2
+    # 熔断后不再请求上游
+    assert stub.state.requests == 3
@@ -0,0 +1,203 @@
+import asyncio
+
+from modules.benchmark.fake_engine import FakeEngine
+from modules.cache.response_cache import ResponseCache, ResponseCachedEngine, is_cacheable
+from modules.utils.cancellation import CancellationToken
+
+
+"""
+回复缓存测试：缓存键组成（引擎、模型、采样参数、角色提示词、历史、问题）、内存 LRU 淘汰后落到 SQLite 命中、出错 / 取消的回复不缓存
+运行: python -m pytest -q tests
+"""
+
+
+class CountingEngine(FakeEngine):
+    """ 记录实际调用次数的假引擎 """
+    def __init__(self, answer=None, **kwargs):
+        super().__init__(num_tokens=4, token_latency=0.001, **kwargs)
+        self.answer = answer
+        self.calls = 0
+
+    async def agenerate(self, user_query, history=None, sys_prompt=None, session_id=None, cancel_token=None):
+        self.calls += 1
+        if self.answer is not None:
+            return self.answer
+        return await super().agenerate(user_query, history, sys_prompt, session_id, cancel_token)
+
+    async def astream(self, user_query, history=None, sys_prompt=None, session_id=None, cancel_token=None):
+        self.calls += 1
+        if self.answer is not None:
+            yield self.answer
+            return
+        async for token in super().astream(user_query, history, sys_prompt, session_id, cancel_token):
+            yield token
+
+
+class ModelEngine:
+    def __init__(self, base_model_path, temperature=0.7):
+        self.base_model_path = base_model_path
+        self.temperature = temperature
+
+
+HISTORY = [{"role": "user", "content": "你好"}, {"role": "assistant", "content": "你好！"}]
+
+
+def key(cache, engine_type="local", engine=None, sys_prompt="translator", history=None, question="hello"):
+    engine = engine or ModelEngine("Qwen2.5-1.5B")
+    return cache.make_key(engine_type, engine, sys_prompt, HISTORY if history is None else history, question)
+
+
+def test_key_changes_with_every_component():
+    cache = ResponseCache()
+    base = key(cache)
+    variants = [
+        key(cache, engine_type="openai"),
+        key(cache, engine=ModelEngine("Qwen2.5-7B")),
+        key(cache, engine=ModelEngine("Qwen2.5-1.5B", temperature=0.0)),
+        key(cache, sys_prompt="reviewer"),
+        key(cache, history=[]),
+        key(cache, history=HISTORY + [{"role": "user", "content": "再见"}]),
+        key(cache, question="goodbye"),
+    ]
+    exact = {base.exact} | {v.exact for v in variants}
+    assert len(exact) == len(variants) + 1
+    # 只有问题不同时仍在同一作用域，近似查找依赖于此
+    assert key(cache, question="goodbye").scope == base.scope
+    assert key(cache, sys_prompt="reviewer").scope != base.scope
+
+
+def test_key_ignores_whitespace_and_width():
+    cache = ResponseCache()
+    base = key(cache, question="hello world")
+    assert key(cache, question="  hello   world \n").exact == base.exact
+    # 全角字母经 NFKC 归一化后与半角一致
+    assert key(cache, question="ｈｅｌｌｏ world").exact == base.exact
+    spaced = [{"role": "user", "content": " 你好 "}, {"role": "assistant", "content": "你好！"}]
+    assert key(cache, history=spaced).exact == key(cache).exact
+
+
+def test_engine_identity_falls_back_to_class_name():
+    cache = ResponseCache()
+    a = cache.make_key("local", FakeEngine(), "", [], "q")
+    b = cache.make_key("local", CountingEngine(), "", [], "q")
+    assert a.exact != b.exact
+
+
+def test_memory_lru_evicts_least_recently_used():
+    cache = ResponseCache(max_entries=2)
+    a, b, c = (key(cache, question=q) for q in "abc")
+    cache.put(a, "A")
+    cache.put(b, "B")
+    # 访问 a 后 b 成为最久未使用的条目
+    assert cache.get(a).answer == "A"
+    cache.put(c, "C")
+    assert cache.get(b) is None
+    assert cache.get(a).answer == "A" and cache.get(c).answer == "C"
+    stats = cache.stats()
+    assert stats["entries"] == 2
+    assert stats["hits"]["memory"] == 3 and stats["misses"] == 1
+
+
+def test_evicted_entry_falls_through_to_sqlite(tmp_path):
+    cache = ResponseCache(max_entries=2, db_path=str(tmp_path / "cache.db"))
+    a, b, c = (key(cache, question=q) for q in "abc")
+    cache.put(a, "A", ["A"])
+    cache.put(b, "B")
+    cache.put(c, "C")
+
+    entry = cache.get(a)
+    assert entry.answer == "A" and entry.chunks == ["A"]
+    assert cache.stats()["hits"] == {"memory": 0, "disk": 1, "semantic": 0}
+    # 磁盘命中后回填内存，再次读取走内存
+    cache.get(a)
+    assert cache.stats()["hits"]["memory"] == 1
+
+
+def test_sqlite_survives_restart_and_expires(tmp_path):
+    db_path = str(tmp_path / "cache.db")
+    cache = ResponseCache(db_path=db_path)
+    cache.put(key(cache), "answer")
+
+    restarted = ResponseCache(db_path=db_path, ttl=3600)
+    assert restarted.get(key(restarted)).answer == "answer"
+    assert restarted.stats()["hits"]["disk"] == 1
+
+    expired = ResponseCache(db_path=db_path, ttl=3600)
+    expired.disk._conn.execute("UPDATE response_cache SET created_at = created_at - 7200")
+    expired.disk._conn.commit()
+    assert expired.get(key(expired)) is None
+
+
+def test_semantic_hit_stays_within_scope():
+    cache = ResponseCache(semantic=True, semantic_threshold=0.8)
+    cache.put(key(cache, question="how do I reset my password"), "answer")
+    entry = cache.get(key(cache, question="how do I reset my password?"))
+    assert entry is not None and entry.answer == "answer"
+    assert cache.stats()["hits"]["semantic"] == 1
+    # 相同问题、不同角色提示词不命中
+    assert cache.get(key(cache, sys_prompt="reviewer", question="how do I reset my password?")) is None
+
+
+def test_is_cacheable():
+    assert is_cacheable("ok", ["o", "k"])
+    assert not is_cacheable("")
+    assert not is_cacheable("❌ local 引擎调用失败")
+    # 流式生成中途出错：错误信息是其中一个 chunk
+    assert not is_cacheable("partial❌ boom", ["partial", "❌ boom"])
+
+
+def test_cached_engine_serves_repeat_from_cache():
+    async def main():
+        engine = CountingEngine()
+        cached = ResponseCachedEngine(engine, ResponseCache(), "local", replay_interval=0)
+        first = await cached.agenerate("q", [], "p")
+        second = await cached.agenerate("q", [], "p")
+        streamed = [chunk async for chunk in cached.astream("q", [], "p")]
+        return engine.calls, first, second, streamed
+
+    calls, first, second, streamed = asyncio.run(main())
+    assert calls == 1
+    assert first == second == "".join(streamed)
+
+
+def test_cached_engine_replays_stream_chunks():
+    async def main():
+        engine = CountingEngine()
+        cached = ResponseCachedEngine(engine, ResponseCache(), "local", replay_interval=0)
+        live = [chunk async for chunk in cached.astream("q", [], "p")]
+        replayed = [chunk async for chunk in cached.astream("q", [], "p")]
+        return engine.calls, live, replayed
+
+    calls, live, replayed = asyncio.run(main())
+    assert calls == 1
+    assert replayed == live
+
+
+def test_cached_engine_skips_errors():
+    async def main():
+        engine = CountingEngine(answer="❌ local 引擎调用失败: boom")
+        cached = ResponseCachedEngine(engine, ResponseCache(), "local", replay_interval=0)
+        await cached.agenerate("q", [], "p")
+        await cached.agenerate("q", [], "p")
+        [chunk async for chunk in cached.astream("q", [], "p")]
+        return engine.calls, cached.cache.stats()["entries"]
+
+    assert asyncio.run(main()) == (3, 0)
+
+
+def test_cached_engine_skips_cancelled_stream():
+    async def main():
+        engine = CountingEngine()
+        cached = ResponseCachedEngine(engine, ResponseCache(), "local", replay_interval=0)
+        token = CancellationToken()
+        chunks = []
+        async for chunk in cached.astream("q", [], "p", cancel_token=token):
+            chunks.append(chunk)
+            token.cancel("client_disconnected")
+        full = [chunk async for chunk in cached.astream("q", [], "p")]
+        return engine.calls, chunks, full
+
+    calls, chunks, full = asyncio.run(main())
+    # 被取消的半截回复没有写入缓存，第二次请求重新生成完整回复
+    assert calls == 2
+    assert len(chunks) < len(full) == 4
@@ -0,0 +1,116 @@
+import asyncio
+
+from modules.benchmark.fake_engine import FakeEngine
+from modules.benchmark.routing import FlakyEngine, reset_manager
+
+
+"""
+自动路由（engine_type=auto）测试：用假引擎替换 local / openai，断言路由策略的排序与首 token 前失败的切换
+运行: python -m pytest -q tests
+"""
+
+
+def fake(name, **kwargs):
+    return FakeEngine(num_tokens=4, token_latency=0.001, name=name, **kwargs)
+
+
+def stream(manager, engine_type="auto", question="q"):
+    """ 完整走一次 acquire -> astream -> release，返回 (回复, 路由结果) """
+    async def main():
+        decision = await manager.router.acquire(engine_type, "batch")
+        try:
+            if decision.ticket is not None:
+                await decision.ticket.wait()
+            chunks = [token async for token in manager.router.astream(decision, question, [], "", priority="batch")]
+        finally:
+            decision.release()
+        return "".join(chunks), decision
+
+    return asyncio.run(main())
+
+
+def test_priority_policy_follows_engine_order():
+    manager = reset_manager("priority", local=fake("local"), openai=fake("openai"))
+    assert manager.router.rank() == ["local", "openai"]
+    manager.router.engines = ["openai", "local"]
+    assert manager.router.rank() == ["openai", "local"]
+
+
+def test_unhealthy_engine_ranked_last():
+    manager = reset_manager("priority", local=fake("local"), openai=fake("openai"))
+    for _ in range(3):
+        manager.health["local"].record_error("❌ boom")
+    # 不健康的引擎排在最后而不是被剔除
+    assert manager.router.rank() == ["openai", "local"]
+
+
+def test_latency_policy_prefers_faster_engine():
+    manager = reset_manager("latency", local=fake("local"), openai=fake("openai"))
+    for _ in range(3):
+        manager.health["local"].record_success(ttft=1.0, tokens=65, duration=3.0)
+        manager.health["openai"].record_success(ttft=0.1, tokens=65, duration=0.5)
+    assert manager.router.rank() == ["openai", "local"]
+
+
+def test_latency_policy_penalizes_unloaded_engine():
+    manager = reset_manager("latency", local=None, openai=fake("openai"))
+    manager.engine_state["local"] = "unloaded"
+    assert manager.router.rank() == ["openai", "local"]
+
+
+def test_saturated_engine_ranked_last():
+    async def main():
+        manager = reset_manager("priority", local=fake("local"), openai=fake("openai"), local_max_in_flight=1, local_max_queued=1)
+        admission = manager.get_admission("local")
+        running, queued = admission.submit("batch"), admission.submit("batch")
+        try:
+            return manager.router.rank()
+        finally:
+            queued.release()
+            running.release()
+
+    assert asyncio.run(main()) == ["openai", "local"]
+
+
+def test_failover_before_first_token():
+    manager = reset_manager(
+        "priority",
+        local=fake("local"),
+        openai=FlakyEngine(error_rate=1.0, num_tokens=4, name="openai")
+    )
+    manager.router.engines = ["openai", "local"]
+    answer, decision = stream(manager)
+    assert not answer.startswith("❌")
+    assert decision.served_by == "local"
+    assert decision.failovers == 1
+    # 切换后准入凭证随之更换为本地引擎的凭证
+    assert decision.ticket is not None and decision.ticket.admitted
+    assert manager.router.stats()["failovers"] == 1
+    assert manager.health["openai"].errors == 1
+
+
+def test_failing_engine_demoted_after_repeated_errors():
+    manager = reset_manager(
+        "priority",
+        local=fake("local"),
+        openai=FlakyEngine(error_rate=1.0, num_tokens=4, name="openai")
+    )
+    manager.router.engines = ["openai", "local"]
+    for i in range(3):
+        stream(manager, question=f"q{i}")
+    assert manager.router.rank() == ["local", "openai"]
+    answer, decision = stream(manager, question="q3")
+    assert decision.served_by == "local"
+    assert decision.failovers == 0
+
+
+def test_explicit_engine_does_not_fail_over():
+    manager = reset_manager(
+        "priority",
+        local=fake("local"),
+        openai=FlakyEngine(error_rate=1.0, num_tokens=4, name="openai")
+    )
+    answer, decision = stream(manager, engine_type="openai")
+    assert answer.startswith("❌")
+    assert decision.served_by == "openai"
+    assert decision.failovers == 0
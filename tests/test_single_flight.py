@@ -0,0 +1,179 @@
+import asyncio
+
+import pytest
+
+from modules.engine.single_flight import SingleFlightEngine
+from modules.utils.cancellation import CancellationToken
+
+
+"""
+进行中请求合并测试：相同请求共享一次生成并扇出给所有订阅者，发起者出错 / 被取消时跟随者的表现
+运行: python -m pytest -q tests
+"""
+
+
+class StepEngine:
+    """ 逐 token 异步生成的假引擎：记录生成次数与取消情况，可在第 fail_at 个 token 处抛出异常 """
+    def __init__(self, num_tokens=6, interval=0.01, fail_at=None):
+        self.num_tokens = num_tokens
+        self.interval = interval
+        self.fail_at = fail_at
+        self.temperature = 0
+        self.starts = 0
+        self.cancelled = 0
+
+    async def astream(self, user_query, history=None, sys_prompt=None, session_id=None, cancel_token=None):
+        self.starts += 1
+        for i in range(self.num_tokens):
+            if cancel_token is not None and cancel_token.cancelled:
+                self.cancelled += 1
+                return
+            if i == self.fail_at:
+                raise RuntimeError("boom")
+            await asyncio.sleep(self.interval)
+            yield f"{user_query}{i} "
+
+    async def agenerate(self, user_query, history=None, sys_prompt=None, session_id=None, cancel_token=None):
+        return "".join([token async for token in self.astream(user_query, history, sys_prompt, session_id, cancel_token)])
+
+
+EXPECTED = "".join(f"q{i} " for i in range(6))
+
+
+async def collect(engine, question="q", cancel_token=None, delay=0.0):
+    await asyncio.sleep(delay)
+    return "".join([chunk async for chunk in engine.astream(question, [], "p", cancel_token=cancel_token)])
+
+
+def test_identical_requests_share_one_generation():
+    async def main():
+        engine = StepEngine()
+        flight = SingleFlightEngine(engine, "local")
+        # 后到的请求从已生成的前缀开始回放
+        results = await asyncio.gather(*[collect(flight, delay=i * 0.015) for i in range(4)])
+        return engine.starts, results, flight.stats()
+
+    starts, results, stats = asyncio.run(main())
+    assert starts == 1
+    assert results == [EXPECTED] * 4
+    assert stats["total_flights"] == 1 and stats["coalesced_requests"] == 3
+    assert stats["active_flights"] == 0
+
+
+def test_different_requests_not_coalesced():
+    async def main():
+        engine = StepEngine()
+        flight = SingleFlightEngine(engine, "local")
+        results = await asyncio.gather(collect(flight, "a"), collect(flight, "b"))
+        return engine.starts, results
+
+    starts, results = asyncio.run(main())
+    assert starts == 2
+    assert results[0].startswith("a0") and results[1].startswith("b0")
+
+
+def test_mode_controls_coalescing():
+    engine = StepEngine()
+    assert SingleFlightEngine(engine, "local").should_coalesce()
+    assert not SingleFlightEngine(engine, "local", mode="off").should_coalesce(coalesce=True)
+    engine.temperature = 0.7
+    assert not SingleFlightEngine(engine, "local").should_coalesce()
+    assert SingleFlightEngine(engine, "local").should_coalesce(coalesce=True)
+    assert SingleFlightEngine(engine, "local", mode="always").should_coalesce()
+
+
+def test_leader_error_reaches_every_follower():
+    async def main():
+        engine = StepEngine(fail_at=3)
+        flight = SingleFlightEngine(engine, "local")
+        results = await asyncio.gather(
+            *[collect(flight, delay=i * 0.01) for i in range(3)],
+            return_exceptions=True
+        )
+        # 出错的生成结束后不再被复用，重试会重新发起
+        engine.fail_at = None
+        retry = await collect(flight)
+        return engine.starts, results, retry
+
+    starts, results, retry = asyncio.run(main())
+    assert all(isinstance(r, RuntimeError) and str(r) == "boom" for r in results)
+    assert starts == 2
+    assert retry == EXPECTED
+
+
+def test_leader_cancel_keeps_followers_running():
+    async def main():
+        engine = StepEngine()
+        flight = SingleFlightEngine(engine, "local")
+        leader = asyncio.create_task(collect(flight))
+        followers = [asyncio.create_task(collect(flight, delay=0.005)) for _ in range(2)]
+        await asyncio.sleep(0.025)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return engine.starts, engine.cancelled, await asyncio.gather(*followers)
+
+    starts, cancelled, results = asyncio.run(main())
+    assert starts == 1 and cancelled == 0
+    assert results == [EXPECTED] * 2
+
+
+def test_leader_cancel_token_only_stops_its_own_subscription():
+    async def main():
+        engine = StepEngine()
+        flight = SingleFlightEngine(engine, "local")
+        token = CancellationToken()
+        leader = asyncio.create_task(collect(flight, cancel_token=token))
+        follower = asyncio.create_task(collect(flight, delay=0.005))
+        await asyncio.sleep(0.025)
+        token.cancel("client_disconnected")
+        return engine.starts, await leader, await follower
+
+    starts, partial, full = asyncio.run(main())
+    assert starts == 1
+    assert EXPECTED.startswith(partial) and len(partial) < len(EXPECTED)
+    assert full == EXPECTED
+
+
+def test_generation_cancelled_when_all_subscribers_leave():
+    async def main():
+        engine = StepEngine(num_tokens=50)
+        flight = SingleFlightEngine(engine, "local")
+        tasks = [asyncio.create_task(collect(flight)) for _ in range(2)]
+        await asyncio.sleep(0.025)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.sleep(0.05)
+        return engine.cancelled, flight.stats()["active_flights"]
+
+    assert asyncio.run(main()) == (1, 0)
+
+
+def test_new_request_does_not_join_cancelled_generation():
+    async def main():
+        engine = StepEngine(interval=0.02)
+        flight = SingleFlightEngine(engine, "local")
+        task = asyncio.create_task(collect(flight))
+        await asyncio.sleep(0.03)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        # 上一次生成已被取消但尚未结束，新请求不能拿到半截回复
+        result = await collect(flight)
+        return engine.starts, result
+
+    starts, result = asyncio.run(main())
+    assert starts == 2
+    assert result == EXPECTED
+
+
+def test_agenerate_coalesces_through_stream():
+    async def main():
+        engine = StepEngine()
+        flight = SingleFlightEngine(engine, "local")
+        results = await asyncio.gather(*[flight.agenerate("q", [], "p") for _ in range(3)])
+        return engine.starts, results
+
+    starts, results = asyncio.run(main())
+    assert starts == 1
+    assert results == [EXPECTED] * 3